@@ -0,0 +1,277 @@
+import os, glob, json, time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import instrument, run_dirs
+
+"""
+Batch mode: many experiment (study or plate) directories through one local worker queue.
+
+Every experiment goes through four stages, each a task on a process pool:
+
+    ingest   raw Ct export -> shared delta Ct matrix (plus raw_qc with --qc / --drop-flagged)
+    stats    every comparison fitted, adj_pvals.npz and the pval_less_than_* folders
+    summary  results store and the FDR x consensus surface table
+    render   heatmaps, p-value sweep plots, bar charts and the surface figure
+
+Stages of one experiment run in order; stages of different experiments run side by
+side. When a worker frees up, the queue starts the most advanced ready stage, so
+finished experiments come out steadily instead of every ingest running first.
+
+Each experiment records finished stages in SavedObjects/batch_state.json with a
+fingerprint of the raw file and the settings that stage reads (STAGE_SETTINGS), so an
+interrupted batch resumes where it stopped and a new --dpi only redraws the figures
+(--restart ignores the state). Per-experiment stage times and throughput
+are printed and written to a CSV report.
+
+    python pipeline.py batch '/data/plates/*' /data/LIMMA09-2018 [--workers 4] [--report batch.csv]
+
+"""
+
+STAGES = ['ingest', 'stats', 'summary', 'render']
+STATE_NAME = 'batch_state.json'
+## the settings each stage adds to the ones of the stages before it
+STAGE_SETTINGS = {'ingest': ['qc', 'drop_flagged'], 'stats': ['pvals', 'resamples'], 'summary': [],
+                  'render': ['dpi']}
+RAW_PATTERN = 'FullDataFrameRawCT*.csv'
+
+
+def find_experiments(patterns, raw_pattern=RAW_PATTERN):
+    """
+    Experiment directories matching `patterns` (directories or globs) that have a
+    SavedObjects/<raw_pattern> export. Returns [{'directory', 'raw_data_file'}]
+    and the list of patterns or directories that had none.
+    """
+    experiments, missing = [], []
+    seen = set()
+    for pattern in patterns:
+        directories = sorted(d for d in glob.glob(pattern) if os.path.isdir(d))
+        found = False
+        for directory in directories:
+            directory = os.path.abspath(directory)
+            raw = sorted(glob.glob(os.path.join(directory, 'SavedObjects', raw_pattern)))
+            if not raw or directory in seen:
+                continue
+            seen.add(directory)
+            found = True
+            experiments.append({'directory': directory, 'raw_data_file': raw[0]})
+        if not found:
+            missing.append(pattern)
+    return experiments, missing
+
+
+def read_experiment_list(fname):
+    """
+    Directories or globs from a file, one per line; blank lines and # comments ignored
+    """
+    with open(fname) as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+
+
+def experiment_pvals(directory, pvals=None):
+    if pvals:
+        return [str(p) for p in pvals]
+    import pipeline
+    pval = pipeline.read_pval_file(directory)
+    if pval is None:
+        raise ValueError('no --pval given and no `pval` settings file in {}'.format(directory))
+    return [pval]
+
+
+def fingerprint(experiment, settings, stage):
+    """
+    Key of the raw file and the settings `stage` and the stages before it read
+    """
+    names = [name for s in STAGES[:STAGES.index(stage) + 1] for name in STAGE_SETTINGS[s]]
+    return run_dirs.run_key(dict(run_dirs.file_params(experiment['raw_data_file']),
+                                 **{name: settings[name] for name in names}))
+
+
+def state_fname(experiment):
+    return os.path.join(experiment['directory'], 'SavedObjects', STATE_NAME)
+
+
+def load_state(experiment):
+    fname = state_fname(experiment)
+    if not os.path.isfile(fname):
+        return {}
+    with open(fname) as f:
+        return json.load(f)
+
+
+def save_state(experiment, state):
+    with run_dirs.atomic_file(state_fname(experiment)) as tmp:
+        with open(tmp, 'w') as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+
+
+def _ingest(saved_objects_path, experiment, settings):
+    import limma_stats, shared_dct
+    drop, qc = [], {}
+    if settings['qc'] or settings['drop_flagged']:
+        drop, qc = limma_stats.quality_checks(saved_objects_path, experiment['raw_data_file'],
+                                              drop_flagged=settings['drop_flagged'])
+    path = limma_stats.ingest_shared(saved_objects_path, experiment['raw_data_file'], drop)
+    with open(os.path.join(path, shared_dct.MANIFEST)) as f:
+        manifest = json.load(f)
+    return {'samples': len(manifest['samples']), 'genes': len(manifest['genes']), 'dropped': len(drop),
+            'flagged': qc.get('flagged', 0), 'wells': len(manifest['samples']) * len(manifest['genes'])}
+
+
+def _stats(saved_objects_path, experiment, settings):
+    import limma_stats, shared_dct, pval_thresholds
+    dct, factors = shared_dct.open_dct(run_dirs.resolve(os.path.join(saved_objects_path, shared_dct.DCT_NAME)))
+    with instrument.stage('fit', workers=1):
+        adj_pvals = limma_stats.fit_comparisons(dct, factors)
+    with instrument.stage('write_thresholds'):
+        pval_thresholds.save_adj_pvals(adj_pvals, os.path.join(saved_objects_path, pval_thresholds.ADJ_PVALS_FNAME))
+        pval_thresholds.write_thresholds(adj_pvals, [float(p) for p in settings['pvals']], saved_objects_path,
+                                         n_resamples=settings['resamples'])
+    return {'comparisons': adj_pvals.shape[1]}
+
+
+def _summary(saved_objects_path, experiment, settings):
+    import limma_stats, pval_thresholds, results_store, threshold_sweep
+    adj_pvals = pval_thresholds.load_adj_pvals(os.path.join(saved_objects_path, pval_thresholds.ADJ_PVALS_FNAME))
+    with instrument.stage('build_store'):
+        results_store.build_store(adj_pvals, os.path.join(saved_objects_path, results_store.STORE_NAME),
+                                  thresholds=limma_stats.store_thresholds(settings['pvals']))
+    with instrument.stage('surface'):
+        counts, keys, fdrs = threshold_sweep.load_surface(saved_objects_path)
+        threshold_sweep.surface_table(counts, keys, fdrs).to_csv(
+            os.path.join(saved_objects_path, 'threshold_surface.csv'), index=False)
+    return {}
+
+
+def _render(saved_objects_path, experiment, settings):
+    import render, incremental, plot_stats_as_heatmap, plot_statistics_as_bar_charts, threshold_sweep
+    render.use_headless_backend()
+    jobs = plot_stats_as_heatmap.figure_jobs(saved_objects_path, settings['pvals'], pval_graph=True)
+    jobs += plot_statistics_as_bar_charts.sweep_jobs(saved_objects_path, settings['pvals'], dpi=settings['dpi'])
+    jobs += threshold_sweep.figure_jobs(saved_objects_path)
+    reports, skipped = incremental.build(jobs, os.path.join(saved_objects_path, incremental.MANIFEST_NAME),
+                                         workers=1)
+    errors = [r['error'] for r in reports if r['error']]
+    if errors:
+        raise RuntimeError('{} of {} figure jobs failed, first: {}'.format(len(errors), len(reports), errors[0]))
+    return {'figures': sum(len(r['outputs']) for r in reports), 'figures_up_to_date': skipped}
+
+
+_STAGE_FUNCTIONS = {'ingest': _ingest, 'stats': _stats, 'summary': _summary, 'render': _render}
+
+
+def run_stage(experiment, stage, settings):
+    """
+    Run one stage of one experiment (in a worker). Returns a report dict; errors are
+    reported rather than raised so the rest of the batch carries on.
+    """
+    saved_objects_path = os.path.join(experiment['directory'], 'SavedObjects')
+    start, cpu_start = time.time(), time.process_time()
+    counts, error = {}, None
+    try:
+        with instrument.stage(stage, fname=experiment['directory']):
+            counts = _STAGE_FUNCTIONS[stage](saved_objects_path, experiment, settings)
+        state = load_state(experiment)
+        state[stage] = {'fingerprint': fingerprint(experiment, settings, stage), 'seconds': time.time() - start,
+                        'finished': time.strftime('%Y-%m-%dT%H:%M:%S'), 'counts': counts}
+        save_state(experiment, state)
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+    return {'directory': experiment['directory'], 'stage': stage, 'start': start, 'end': time.time(),
+            'cpu_seconds': time.process_time() - cpu_start, 'counts': counts, 'error': error,
+            'trace': instrument.drain()}
+
+
+def pending_stages(experiment, settings, restart=False):
+    """
+    The stages still to run: everything from the first stage whose recorded
+    fingerprint doesn't match the current raw file and the settings it reads
+    """
+    if restart:
+        return list(STAGES)
+    state = load_state(experiment)
+    for i, stage in enumerate(STAGES):
+        if state.get(stage, {}).get('fingerprint') != fingerprint(experiment, settings, stage):
+            return STAGES[i:]
+    return []
+
+
+def run_batch(experiments, workers=None, pvals=None, restart=False, qc=False, drop_flagged=False,
+              resamples=10000, dpi=350):
+    """
+    Push every experiment's pending stages through a pool of `workers` processes.
+    Returns one report per experiment (see `throughput`).
+    """
+    workers = workers or os.cpu_count() or 1
+    queue = {}
+    results = {e['directory']: {'experiment': e, 'stages': [], 'skipped': [], 'counts': {}, 'error': None}
+               for e in experiments}
+    for e in experiments:
+        try:
+            settings = {'pvals': experiment_pvals(e['directory'], pvals), 'qc': qc,
+                        'drop_flagged': drop_flagged, 'resamples': resamples, 'dpi': dpi}
+        except ValueError as error:
+            results[e['directory']]['error'] = str(error)
+            continue
+        stages = pending_stages(e, settings, restart)
+        skipped = [s for s in STAGES if s not in stages]
+        results[e['directory']]['skipped'] = skipped
+        ## sizes recorded by the stages that already ran, for the throughput figures
+        state = load_state(e)
+        for stage in skipped:
+            results[e['directory']]['counts'].update(state[stage].get('counts', {}))
+        if stages:
+            queue[e['directory']] = (e, settings, stages)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        running = {}
+        while queue or running:
+            ## the most advanced ready stage first, then experiment order
+            ready = sorted((d for d in queue if d not in {r[0] for r in running.values()}),
+                           key=lambda d: -STAGES.index(queue[d][2][0]))
+            for directory in ready[:workers - len(running)]:
+                e, settings, stages = queue[directory]
+                running[pool.submit(run_stage, e, stages[0], settings)] = (directory, stages[0])
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                directory, stage = running.pop(future)
+                report = future.result()
+                instrument.add_events(report.pop('trace'))
+                result = results[directory]
+                result['stages'].append(report)
+                e, settings, stages = queue.pop(directory)
+                status = 'FAILED {}'.format(report['error']) if report['error'] else 'done'
+                print('{:<8} {:>8.2f}s  {}  {}'.format(stage, report['end'] - report['start'], directory, status))
+                if report['error']:
+                    result['error'] = '{}: {}'.format(stage, report['error'])
+                elif stages[1:]:
+                    queue[directory] = (e, settings, stages[1:])
+    return [results[e['directory']] for e in experiments]
+
+
+def throughput(results):
+    """
+    Per-experiment frame of stage times, wall time from the first stage start to
+    the last stage end, and wells and comparisons per second
+    """
+    import pandas
+    rows = []
+    for result in results:
+        row = {'directory': result['experiment']['directory'], 'status': result['error'] or 'ok',
+               'resumed': ','.join(result['skipped'])}
+        counts = dict(result['counts'])
+        for report in result['stages']:
+            row['{}_s'.format(report['stage'])] = report['end'] - report['start']
+            counts.update(report['counts'] or {})
+        if result['stages']:
+            wall = max(r['end'] for r in result['stages']) - min(r['start'] for r in result['stages'])
+            row['wall_s'] = wall
+            for name in ['wells', 'comparisons']:
+                if name in counts and wall > 0:
+                    row['{}_per_s'.format(name)] = counts[name] / wall
+        row.update({k: counts[k] for k in ['samples', 'genes', 'flagged', 'dropped', 'comparisons', 'figures']
+                    if k in counts})
+        rows.append(row)
+    columns = ['directory', 'status', 'resumed'] + ['{}_s'.format(s) for s in STAGES] + [
+        'wall_s', 'samples', 'genes', 'flagged', 'dropped', 'comparisons', 'figures', 'wells_per_s',
+        'comparisons_per_s']
+    table = pandas.DataFrame(rows)
+    return table.reindex(columns=[c for c in columns if c in table.columns])
@@ -0,0 +1,234 @@
+import os, time, json, string, shutil, tempfile, subprocess, datetime, contextlib
+import numpy, pandas
+import limma_stats, pval_thresholds, ingest
+
+"""
+Scaling benchmarks on synthetic data.
+
+Generates Ct data in the long FullDataFrameRawCT format and a SavedObjects tree of
+pval_less_than_* folders at any number of genes, cell lines, time points and
+replicates, then times each stage of the pipeline separately:
+
+    load      - read_raw_ct / reading the statistics CSVs
+    ingest    - the chunked float32 load and normalisation in ingest.py
+    fit       - limma_stats.fit_comparisons on the whole comparison grid
+    reshape   - the ResultsCube within/between tables in plot_stats_as_heatmap
+    counts    - the >60% count tables
+    render    - one heatmap and one bar chart (optional, slow at large sizes), drawn
+                into SavedObjects/figures like `pipeline.py within` and `bars`
+
+Every run is appended as one JSON line to a history file so regressions and the
+point where a stage stops scaling can be seen over time.
+
+"""
+
+HISTORY_FNAME = 'benchmark_history.jsonl'
+
+TIME_POINTS = [0.5, 1, 2, 3, 4, 8, 12, 24, 48, 72, 96]
+
+
+def cell_line_names(n):
+    names = list(string.ascii_uppercase)
+    names += [a + b for a in string.ascii_uppercase for b in string.ascii_uppercase]
+    return names[:n]
+
+
+def cell_line_groups(n_cell_lines):
+    """
+    Split n cell lines into neonatal, senescent and adult thirds like A-C, D-F, G-I
+    """
+    lines = cell_line_names(n_cell_lines)
+    third = max(1, n_cell_lines // 3)
+    return {
+        'neonatal': lines[:third],
+        'senescent': lines[third:2 * third],
+        'adult': lines[2 * third:],
+    }
+
+
+def comparison_grid(n_cell_lines):
+    """
+    The between/within comparison grid of limma_stats generalised to any number of cell lines
+    """
+    groups = cell_line_groups(n_cell_lines)
+    between = {
+        'adult': [(i, j) for i in groups['neonatal'] for j in groups['adult']],
+        'sen': [(i, j) for i in groups['neonatal'] for j in groups['senescent']],
+    }
+    grid = []
+    for treatment in limma_stats.TREATMENTS:
+        for group, pairs in between.items():
+            grid += [('between', treatment, group, pair) for pair in pairs]
+    for group, lines in groups.items():
+        pairs = [(a, b) for k, a in enumerate(lines) for b in lines[k + 1:]]
+        for treatment in limma_stats.TREATMENTS:
+            grid += [('within', treatment, group, pair) for pair in pairs]
+    return grid
+
+
+def synthetic_ct(n_genes=68, n_cell_lines=9, n_time_points=11, n_replicates=2, seed=0):
+    """
+    Long (Assay, Sample, Ct) frame. A fifth of the genes respond to TGFb over
+    time, with a cell line specific amplitude.
+    """
+    rng = numpy.random.default_rng(seed)
+    genes = ['GENE{}'.format(i) for i in range(n_genes - 1)] + ['PPIA']
+    lines = cell_line_names(n_cell_lines)
+    times = numpy.interp(numpy.linspace(0, len(TIME_POINTS) - 1, n_time_points),
+                         numpy.arange(len(TIME_POINTS)), TIME_POINTS).round(2)
+
+    samples, sample_time, sample_treat, sample_line = [], [], [], []
+    for treatment, treatment_times in [('Baseline', [0]), ('Control', times), ('TGFb', times)]:
+        for t in treatment_times:
+            for k, line in enumerate(lines):
+                for r in range(1, n_replicates + 1):
+                    samples.append('{}_{:g}_{}_{}'.format(treatment, t, line, r))
+                    sample_time.append(t)
+                    sample_treat.append(treatment == 'TGFb')
+                    sample_line.append(k)
+
+    base = rng.uniform(18, 30, size=(len(genes), 1))
+    responsive = (rng.random(len(genes)) < 0.2)[:, None]
+    amplitude = rng.normal(1.5, 0.5, size=(len(genes), n_cell_lines))[:, sample_line]
+    response = responsive * numpy.array(sample_treat) * amplitude * numpy.log1p(sample_time)
+    ct = base - response + rng.normal(0, 0.3, size=(len(genes), len(samples)))
+    ct[-1] = 20 + rng.normal(0, 0.1, size=len(samples))
+
+    return pandas.DataFrame({
+        'Assay': numpy.repeat(genes, len(samples)),
+        'Sample': numpy.tile(samples, len(genes)),
+        'Ct': ct.ravel().astype(numpy.float32),
+    })
+
+
+def synthetic_saved_objects(path, n_genes=68, n_cell_lines=9, thresholds=pval_thresholds.THRESHOLDS, seed=0):
+    """
+    Write a SavedObjects style tree of pval_less_than_* folders from random
+    adjusted p-values over the comparison grid of `n_cell_lines` cell lines
+    """
+    rng = numpy.random.default_rng(seed)
+    genes = ['GENE{}'.format(i) for i in range(n_genes)]
+    columns = limma_stats.comparison_columns(comparison_grid(n_cell_lines))
+    adj = 10 ** -rng.exponential(3, size=(n_genes, len(columns)))
+    adj_pvals = pandas.DataFrame(adj, index=pandas.Index(genes, name='gene'), columns=columns)
+    pval_thresholds.write_thresholds(adj_pvals, thresholds, path)
+    return adj_pvals
+
+
+class Timer(object):
+
+    def __init__(self):
+        self.times = {}
+
+    @contextlib.contextmanager
+    def __call__(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0) + time.perf_counter() - start
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(n_genes=68, n_cell_lines=9, n_time_points=11, n_replicates=2, render=False, seed=0):
+    """
+    Time every stage once at the given size. Returns a dict of stage -> seconds.
+    """
+    timer = Timer()
+    workdir = tempfile.mkdtemp(prefix='wafergen_bench_')
+    try:
+        _run_stages(timer, workdir, n_genes, n_cell_lines, n_time_points, n_replicates, render, seed)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return timer.times
+
+
+def _run_stages(timer, workdir, n_genes, n_cell_lines, n_time_points, n_replicates, render, seed):
+
+    raw_fname = os.path.join(workdir, 'FullDataFrameRawCT.csv')
+    synthetic_ct(n_genes, n_cell_lines, n_time_points, n_replicates, seed=seed).to_csv(raw_fname, index=False)
+
+    with timer('load_raw'):
+        ct = limma_stats.read_raw_ct(raw_fname)
+    with timer('normalise'):
+        dct = limma_stats.calc_dct(ct)
+        factors = limma_stats.sample_factors(dct.index)
+    with timer('ingest'):
+        dct, factors = ingest.ingest(raw_fname)
+        keep = (factors['treatment'] != 'Baseline').values
+    with timer('fit'):
+        limma_stats.fit_comparisons(dct[keep], factors[keep], grid=comparison_grid(n_cell_lines))
+
+    saved_objects_path = os.path.join(workdir, 'SavedObjects')
+    with timer('write_thresholds'):
+        synthetic_saved_objects(saved_objects_path, n_genes, n_cell_lines, seed=seed)
+
+    import render as render_module
+    render_module.use_headless_backend()
+    import plot_stats_as_heatmap
+    pval = pval_thresholds.THRESHOLDS[1]
+    pval_path = os.path.join(saved_objects_path, limma_stats.pval_dir_name(pval))
+    with timer('load_statistics'):
+        cube = plot_stats_as_heatmap.read_statistics(pval_path)
+    with timer('reshape'):
+        within = plot_stats_as_heatmap.within_table(cube)
+        between = plot_stats_as_heatmap.between_table(cube)
+    with timer('counts'):
+        plot_stats_as_heatmap.count_greater_than(within)
+        plot_stats_as_heatmap.count_greater_than(between)
+
+    if render:
+        import plot_statistics_as_bar_charts
+        ## pval_path is an immutable run; figures go next to it as in pipeline.py
+        out = plot_stats_as_heatmap.output_dir(saved_objects_path, pval)
+        os.makedirs(out)
+        with timer('render_heatmap'):
+            plot_stats_as_heatmap.plot_within(cube, pval, out)
+        with timer('render_bars'):
+            data = plot_statistics_as_bar_charts.read_statistics(os.path.join(pval_path, 'within_adult.csv'))
+            plot_statistics_as_bar_charts.plot(data, 'tgfb_perc', fname=os.path.join(out, 'within_adult_control.png'),
+                                               show=False)
+
+
+def record(result, history_fname=HISTORY_FNAME):
+    with open(history_fname, 'a') as f:
+        f.write(json.dumps(result) + '\n')
+
+
+def load_history(history_fname=HISTORY_FNAME):
+    """
+    Benchmark history as a frame with one row per run and one column per stage
+    """
+    with open(history_fname) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    rows = [dict(r['params'], timestamp=r['timestamp'], revision=r['revision'], **r['seconds']) for r in records]
+    return pandas.DataFrame(rows)
+
+
+def run_suite(gene_counts=(68, 500, 5000), n_cell_lines=9, n_time_points=11, n_replicates=2,
+              render=False, history_fname=HISTORY_FNAME):
+    results = []
+    for n_genes in gene_counts:
+        params = dict(n_genes=n_genes, n_cell_lines=n_cell_lines,
+                      n_time_points=n_time_points, n_replicates=n_replicates, render=render)
+        seconds = run_benchmark(**params)
+        result = {
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'revision': git_revision(),
+            'params': params,
+            'seconds': seconds,
+        }
+        if history_fname:
+            record(result, history_fname)
+        print('{:>6} genes  '.format(n_genes) + '  '.join(
+            '{} {:.3f}s'.format(stage, s) for stage, s in seconds.items()))
+        results.append(result)
+    return results
@@ -0,0 +1,155 @@
+import os, functools
+import numpy, pandas
+import results_store, run_dirs
+
+"""
+Hierarchical row ordering of genes by their consensus percentage profiles, shared by
+the within/between heatmaps and the bar charts.
+
+A gene's profile is its percentage in every group and treatment at every stored
+threshold, so one ordering serves every threshold. The full O(n^2) distance matrix
+of a naive linkage is avoided in two steps:
+
+  * genes with identical profiles are collapsed first. Percentages are multiples of
+    100 / n for a handful of comparisons per group, so these are most of them;
+  * if more than MAX_LEAVES distinct profiles remain they are summarised by
+    weighted k-means (distances computed CHUNK_SIZE rows at a time), and only the
+    centres are clustered. Genes within a centre are ordered along the first
+    principal axis of the centres.
+
+The ordering is cached as a run directory (see run_dirs.py) keyed on the store's
+percentages and the clustering parameters:
+
+    SavedObjects/gene_order -> runs/gene_order-<key>/gene_order.csv, linkage.npy
+
+    python pipeline.py within --input-dir DIR/SavedObjects --pval 0.001 --row-order cluster
+
+"""
+
+ORDER_NAME = 'gene_order'
+ORDER_FNAME = 'gene_order.csv'
+LINKAGE_FNAME = 'linkage.npy'
+METHOD = 'ward'
+MAX_LEAVES = 2000
+CHUNK_SIZE = 4096
+
+
+def profiles(store):
+    """
+    (genes, gene x (threshold, group) float32 matrix). Missing percentages count as 0.
+    """
+    percentages = numpy.asarray(store.array('percentages'), dtype=numpy.float32)
+    n_thresholds, n_genes, n_groups = percentages.shape
+    matrix = numpy.nan_to_num(percentages.transpose(1, 0, 2).reshape(n_genes, n_thresholds * n_groups))
+    return store.genes, matrix
+
+
+def nearest(points, centres, chunk_size=CHUNK_SIZE):
+    """
+    Index of the closest centre for every point, chunk_size x n_centres distances at a time
+    """
+    centres_sq = (centres ** 2).sum(axis=1)
+    labels = numpy.empty(len(points), dtype=numpy.intp)
+    for start in range(0, len(points), chunk_size):
+        block = points[start:start + chunk_size]
+        labels[start:start + chunk_size] = (centres_sq - 2 * block @ centres.T).argmin(axis=1)
+    return labels
+
+
+def kmeans(points, weights, k, seed=0, iterations=20, chunk_size=CHUNK_SIZE):
+    """
+    Weighted Lloyd's k-means. Returns (centres, labels).
+    """
+    from scipy import sparse
+    rng = numpy.random.RandomState(seed)
+    centres = points[rng.choice(len(points), k, replace=False)].astype(numpy.float32)
+    membership_shape = (k, len(points))
+    for _ in range(iterations):
+        labels = nearest(points, centres, chunk_size)
+        membership = sparse.csr_matrix((weights, (labels, numpy.arange(len(points)))), shape=membership_shape)
+        totals = numpy.asarray(membership.sum(axis=1)).ravel()
+        filled = totals > 0
+        updated = centres.copy()
+        ## empty clusters keep their old centre
+        updated[filled] = (membership @ points)[filled] / totals[filled, None]
+        if numpy.allclose(updated, centres):
+            break
+        centres = updated
+    return centres, nearest(points, centres, chunk_size)
+
+
+def cluster_order(matrix, method=METHOD, max_leaves=MAX_LEAVES, seed=0):
+    """
+    Row order of a hierarchical clustering of `matrix`. Returns the order, each
+    row's leaf (in leaf order) and the linkage of the clustered leaves.
+    """
+    from scipy.cluster import hierarchy
+    n_rows = matrix.shape[0]
+    unique, inverse, counts = numpy.unique(matrix, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+    if len(unique) > max_leaves:
+        centres, labels = kmeans(unique, counts.astype(numpy.float32), max_leaves, seed=seed)
+    else:
+        centres, labels = unique, numpy.arange(len(unique))
+
+    if len(centres) > 1:
+        linkage = hierarchy.linkage(centres, method=method)
+        leaf_rank = numpy.empty(len(centres), dtype=numpy.intp)
+        leaf_rank[hierarchy.leaves_list(linkage)] = numpy.arange(len(centres))
+    else:
+        linkage = numpy.empty((0, 4))
+        leaf_rank = numpy.zeros(len(centres), dtype=numpy.intp)
+
+    ## first principal axis of the centres, to order the profiles sharing a centre
+    centred = centres - centres.mean(axis=0)
+    axis = numpy.linalg.svd(centred, full_matrices=False)[2][0] if len(centres) > 1 else numpy.zeros(unique.shape[1])
+    within = unique @ axis
+
+    leaves = leaf_rank[labels[inverse]]
+    order = numpy.lexsort((numpy.arange(n_rows), within[inverse], leaves))
+    return order, leaves, linkage
+
+
+def build_order(saved_objects_path, method=METHOD, max_leaves=MAX_LEAVES, seed=0):
+    """
+    Cluster the genes of the results store in saved_objects_path, or reuse the
+    cached ordering. Returns the run directory holding it.
+    """
+    store = results_store.open_store(saved_objects_path)
+    genes, matrix = profiles(store)
+    params = {'percentages': run_dirs.array_digest(matrix, numpy.asarray(genes, dtype=str)),
+              'method': method, 'max_leaves': max_leaves, 'seed': seed}
+    path = run_dirs.completed(saved_objects_path, ORDER_NAME, params)
+    if path is not None:
+        run_dirs.point_link(os.path.join(saved_objects_path, ORDER_NAME), path)
+        return path
+    order, leaves, linkage = cluster_order(matrix, method=method, max_leaves=max_leaves, seed=seed)
+    with run_dirs.atomic_run(saved_objects_path, ORDER_NAME, params) as tmp:
+        pandas.DataFrame({'gene': numpy.asarray(genes)[order], 'leaf': leaves[order]}).to_csv(
+            os.path.join(tmp, ORDER_FNAME), index=False)
+        numpy.save(os.path.join(tmp, LINKAGE_FNAME), linkage)
+    return run_dirs.completed(saved_objects_path, ORDER_NAME, params)
+
+
+@functools.lru_cache(maxsize=8)
+def _read_order(path):
+    return list(pandas.read_csv(os.path.join(path, ORDER_FNAME), dtype={'gene': str})['gene'])
+
+
+def read_order(path):
+    """
+    Genes in cluster order, from a directory written by build_order
+    """
+    return _read_order(run_dirs.resolve(path))
+
+
+def apply_order(genes, order_path):
+    """
+    `genes` rearranged into the cached order. Genes the ordering doesn't know keep
+    their relative order at the end.
+    """
+    genes = list(genes)
+    present = set(genes)
+    ordered = [g for g in read_order(order_path) if g in present]
+    known = set(ordered)
+    return ordered + [g for g in genes if g not in known]
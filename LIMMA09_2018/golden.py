@@ -0,0 +1,347 @@
+import os, glob, time, shutil, tempfile
+import numpy, pandas
+import limma_stats, pval_thresholds, results_store, run_dirs
+
+"""
+Golden-output checks: rerun a code path and compare what it writes against the
+published pval_less_than_* folders, so performance work can't quietly change the
+numbers behind the paper's figures.
+
+Every path writes the files of a pval_less_than_* folder (the between/within
+statistics and the *_count_greater_than_60_percent.csv tables) into a scratch
+SavedObjects. Each file that also exists in the golden folder for the same
+threshold is compared cell by cell over the union of genes and columns, numbers
+with numpy.isclose(rtol, atol) and NaN equal to NaN. Every differing cell is one
+mismatch row (path, implementation, folder, file, gene, column, golden, candidate);
+a gene or column found on one side only gives a row per cell it is missing from.
+
+Paths come as a reference and a candidate implementation, timed side by side:
+
+    counts      the >60% tables: the original plotting script's pandas stack, pivot
+                and count over each folder's statistics vs one vectorised count
+                over the results store
+    tables      between statistics tables: percentages recomputed from the
+                indicator columns by limma_stats vs from the store's hits array.
+                The within tables carry no indicators, so only the fitting paths
+                below check them
+    thresholds  folders from adj_pvals.npz: the per-threshold indicators /
+                write_statistics / original count loop vs
+                pval_thresholds.write_thresholds (needs adj_pvals.npz)
+    stats       the whole fit from the raw export: read_raw_ct, calc_dct and
+                fit_comparisons vs limma_stats.run with ingest.py and --workers
+                (needs a FullDataFrameRawCT*.csv)
+
+Paths whose inputs are missing are skipped. The counts and tables paths only read
+the CSVs and take a few seconds on the published folders. The published tree has no
+raw export or adj_pvals.npz, so tests/test_golden.py runs the two fitting paths on
+a small synthetic study instead.
+
+The golden folders must be the published ones: real directories, not links into
+runs/. After `stats` has run in a SavedObjects the pval_less_than_* names point at
+its own runs, and comparing against those would only check the code against itself,
+so `golden_dirs` refuses them.
+
+    python pipeline.py golden --input-dir DIR/SavedObjects [--paths counts tables] [--report mismatches.csv]
+
+"""
+
+RTOL = 1e-9
+ATOL = 1e-9
+RAW_PATTERN = 'FullDataFrameRawCT*.csv'
+IMPLEMENTATIONS = ['reference', 'candidate']
+MISMATCH_COLUMNS = ['path', 'implementation', 'folder', 'file', 'gene', 'column', 'golden', 'candidate',
+                    'difference', 'problem']
+
+
+def read_table(fname):
+    """
+    A statistics or count CSV as a frame of floats. The two header rows of the count
+    tables become `Count.<treatment>` columns.
+    """
+    if '_count_greater_than_' in os.path.basename(fname):
+        df = pandas.read_csv(fname, header=[0, 1], index_col=0)
+        df.columns = ['.'.join(c) for c in df.columns]
+    else:
+        df = pandas.read_csv(fname, index_col=0)
+    df.index = df.index.astype(str)
+    return df.apply(pandas.to_numeric, errors='coerce')
+
+
+def compare_tables(golden, candidate, rtol=RTOL, atol=ATOL):
+    """
+    Cells that differ between two frames, as a (gene, column, golden, candidate,
+    difference, problem) frame. `problem` is 'value', or 'missing'/'extra' when the
+    gene or column is only in the golden/candidate frame.
+    """
+    genes = golden.index.union(candidate.index, sort=False)
+    columns = golden.columns.union(candidate.columns, sort=False)
+    g = golden.reindex(index=genes, columns=columns).values.astype(float)
+    c = candidate.reindex(index=genes, columns=columns).values.astype(float)
+    in_golden = genes.isin(golden.index)[:, None] & columns.isin(golden.columns)[None, :]
+    in_candidate = genes.isin(candidate.index)[:, None] & columns.isin(candidate.columns)[None, :]
+
+    problem = numpy.full(g.shape, '', dtype=object)
+    problem[~numpy.isclose(g, c, rtol=rtol, atol=atol, equal_nan=True)] = 'value'
+    problem[in_golden & ~in_candidate] = 'missing'
+    problem[~in_golden & in_candidate] = 'extra'
+    rows, cols = numpy.nonzero(problem != '')
+    return pandas.DataFrame({
+        'gene': genes[rows], 'column': columns[cols], 'golden': g[rows, cols], 'candidate': c[rows, cols],
+        'difference': c[rows, cols] - g[rows, cols], 'problem': problem[rows, cols],
+    }, columns=['gene', 'column', 'golden', 'candidate', 'difference', 'problem'])
+
+
+def compare_dirs(golden_dirs, candidate_dirs, rtol=RTOL, atol=ATOL):
+    """
+    Compare every CSV of the candidate folders with the golden folder of the same
+    threshold ({threshold: folder} mappings, see results_store.find_threshold_dirs).
+    Returns (mismatches, files compared, cells compared).
+    """
+    frames, n_files, n_cells = [], 0, 0
+    for threshold in sorted(set(golden_dirs) & set(candidate_dirs), reverse=True):
+        golden_dir = golden_dirs[threshold]
+        candidate_dir = run_dirs.resolve(candidate_dirs[threshold])
+        for fname in sorted(glob.glob(os.path.join(candidate_dir, '*.csv'))):
+            golden_fname = os.path.join(golden_dir, os.path.basename(fname))
+            if not os.path.isfile(golden_fname):
+                continue
+            golden, candidate = read_table(golden_fname), read_table(fname)
+            mismatches = compare_tables(golden, candidate, rtol, atol)
+            mismatches.insert(0, 'file', os.path.basename(fname))
+            mismatches.insert(0, 'folder', os.path.basename(os.path.normpath(golden_dirs[threshold])))
+            frames.append(mismatches)
+            n_files += 1
+            n_cells += golden.size
+    if not frames:
+        return pandas.DataFrame(columns=MISMATCH_COLUMNS[2:]), n_files, n_cells
+    return pandas.concat(frames, ignore_index=True), n_files, n_cells
+
+
+def golden_dirs(golden_path):
+    """
+    {threshold: folder} of the published folders in golden_path. Raises ValueError
+    when there are none, or when one is a link or resolves into a runs/ directory.
+    """
+    dirs = results_store.find_threshold_dirs(golden_path)
+    if not dirs:
+        raise ValueError('no pval_less_than_* folders in {}'.format(golden_path))
+    for d in dirs.values():
+        parent = os.path.basename(os.path.dirname(os.path.realpath(d)))
+        if os.path.islink(d) or parent == run_dirs.RUNS_DIR:
+            raise ValueError('{} resolves to {}, a pipeline run rather than a published folder. Point '
+                             '--input-dir at a copy of the published pval_less_than_* folders'.format(
+                                 d, os.path.realpath(d)))
+    return dirs
+
+
+def _out_dir(work_path, threshold):
+    path = os.path.join(work_path, limma_stats.pval_dir_name(threshold))
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+def _write_baseline_counts(statistics_path, pval_path):
+    """
+    The >60% count tables the way the original plotting script made them: the five
+    statistics tables stacked into one long frame, pivoted back per kind and counted
+    with pandas. No ResultsCube or results store code is involved.
+    """
+    tables = []
+    for name in ['within_neonatal', 'within_senescent', 'within_adult']:
+        table = pandas.read_csv(os.path.join(statistics_path, '{}.csv'.format(name)), index_col=0)
+        table.columns = pandas.MultiIndex.from_product([[name], list(table.columns)])
+        tables.append(table)
+    for name in ['between_control', 'between_tgfb']:
+        table = pandas.read_csv(os.path.join(statistics_path, '{}_statistics.csv'.format(name)), index_col=0)
+        table = table[['sen_perc', 'ad_perc']]
+        table.columns = pandas.MultiIndex.from_product([[name], list(table.columns)])
+        tables.append(table)
+    ## stack dropped the missing cells itself before pandas 3
+    df = pandas.DataFrame(pandas.concat(tables, axis=1).stack().stack().dropna())
+    df.index.names = ['gene', 'group1', 'group2']
+    df.columns = ['percentage']
+    df = df.reset_index()
+
+    within = df[df['group2'].str.startswith('within_')]
+    within = within.assign(group=within['group2'] + '_' + within['group1'])
+    within = within.pivot(index='gene', columns='group', values='percentage')
+    within.columns = ['adult_control', 'adult_tgf', 'neonatal_control', 'neonatal_tgf',
+                      'senescent_control', 'senescent_tgf']
+    between = df[df['group2'].str.startswith('between_')]
+    between = between.assign(group=between['group1'] + '_' + between['group2'])
+    between = between.pivot_table(index='gene', columns='group', values='percentage')
+    between.columns = ['adult_control', 'adult_tgfb', 'senescent_control', 'senescent_tgfb']
+
+    for kind, table in [('within', within), ('between', between)]:
+        count = pandas.DataFrame(table[table > 60].count())
+        count.columns = ['Count']
+        cell, treat = zip(*[i.split('_') for i in list(count.index)])
+        count['comparison'] = cell
+        count['treatment'] = treat
+        count = count.set_index(['comparison', 'treatment']).unstack(level=1)
+        count.to_csv(os.path.join(pval_path, '{}_count_greater_than_60_percent.csv'.format(kind)))
+
+
+def _write_reference_thresholds(adj_pvals, thresholds, work_path):
+    """
+    One threshold at a time, the way the folders were produced before
+    pval_thresholds: indicators, write_statistics, then the original count tables
+    """
+    for threshold in thresholds:
+        pval_path = _out_dir(work_path, threshold)
+        limma_stats.write_statistics(limma_stats.indicators(adj_pvals, threshold), pval_path)
+        _write_baseline_counts(pval_path, pval_path)
+
+
+def _import_store(golden_path, work_path):
+    return results_store.ResultsStore(
+        results_store.import_saved_objects(golden_path, path=os.path.join(work_path, results_store.STORE_NAME)))
+
+
+def counts_reference(golden_path, work_path, workers=1):
+    for threshold, d in golden_dirs(golden_path).items():
+        _write_baseline_counts(d, _out_dir(work_path, threshold))
+
+
+def counts_candidate(golden_path, work_path, workers=1):
+    store = _import_store(golden_path, work_path)
+    counts = (numpy.asarray(store.array('percentages')) > 60).sum(axis=1)
+    keys = [tuple(g) for g in store.groups]
+    for t, threshold in enumerate(store.thresholds):
+        pval_path = _out_dir(work_path, threshold)
+        for kind in ['within', 'between']:
+            pval_thresholds.count_table(counts[t], keys, kind).to_csv(
+                os.path.join(pval_path, '{}_count_greater_than_60_percent.csv'.format(kind)))
+
+
+def tables_reference(golden_path, work_path, workers=1):
+    for threshold, d in golden_dirs(golden_path).items():
+        pval_path = _out_dir(work_path, threshold)
+        indicators = []
+        for treatment, name in [('Control', 'control'), ('TGFb', 'tgfb')]:
+            table = pandas.read_csv(os.path.join(d, 'between_{}_statistics.csv'.format(name)), index_col=0)
+            table = table[[c for c in table.columns if '.' in c]]
+            table.columns = pandas.MultiIndex.from_tuples(
+                [('between', treatment) + tuple(c.split('.', 1)) for c in table.columns],
+                names=pval_thresholds.LEVELS)
+            indicators.append(table)
+        hits = pandas.concat(indicators, axis=1)
+        for treatment, name in [('Control', 'control'), ('TGFb', 'tgfb')]:
+            limma_stats.write_r_csv(limma_stats.between_statistics(hits, treatment),
+                                    os.path.join(pval_path, 'between_{}_statistics.csv'.format(name)))
+
+
+def tables_candidate(golden_path, work_path, workers=1):
+    store = _import_store(golden_path, work_path)
+    for threshold in store.thresholds:
+        pval_path = _out_dir(work_path, threshold)
+        for treatment, name in [('Control', 'control'), ('TGFb', 'tgfb')]:
+            hits = store.hits(threshold, kind='between', treatment=treatment)
+            groups = hits.columns.get_level_values('group')
+            table = hits.copy()
+            table.columns = ['{}.{}'.format(c[2], c[3]) for c in hits.columns]
+            table['sen_perc'] = hits.values[:, groups == 'sen'].mean(axis=1) * 100
+            table['ad_perc'] = hits.values[:, groups == 'adult'].mean(axis=1) * 100
+            limma_stats.write_r_csv(table, os.path.join(pval_path, 'between_{}_statistics.csv'.format(name)))
+
+
+def thresholds_reference(golden_path, work_path, workers=1):
+    adj_pvals = pval_thresholds.load_adj_pvals(os.path.join(golden_path, pval_thresholds.ADJ_PVALS_FNAME))
+    _write_reference_thresholds(adj_pvals, sorted(golden_dirs(golden_path)), work_path)
+
+
+def thresholds_candidate(golden_path, work_path, workers=1):
+    adj_pvals = pval_thresholds.load_adj_pvals(os.path.join(golden_path, pval_thresholds.ADJ_PVALS_FNAME))
+    pval_thresholds.write_thresholds(adj_pvals, sorted(golden_dirs(golden_path)), work_path)
+
+
+def find_raw_data_file(golden_path):
+    found = sorted(glob.glob(os.path.join(golden_path, RAW_PATTERN)))
+    return found[0] if found else None
+
+
+def stats_reference(golden_path, work_path, workers=1, raw_data_file=None):
+    dct = limma_stats.calc_dct(limma_stats.read_raw_ct(raw_data_file or find_raw_data_file(golden_path)))
+    adj_pvals = limma_stats.fit_comparisons(dct, limma_stats.sample_factors(dct.index))
+    _write_reference_thresholds(adj_pvals, sorted(golden_dirs(golden_path)), work_path)
+
+
+def stats_candidate(golden_path, work_path, workers=1, raw_data_file=None):
+    ## consensus_intervals.csv has no golden counterpart, so it isn't worth timing
+    limma_stats.run(work_path, raw_data_file or find_raw_data_file(golden_path),
+                    sorted(golden_dirs(golden_path)), workers=workers, n_resamples=0)
+
+
+## name -> (reference, candidate, the input it needs beyond the CSVs)
+PATHS = {
+    'counts': (counts_reference, counts_candidate, None),
+    'tables': (tables_reference, tables_candidate, None),
+    'thresholds': (thresholds_reference, thresholds_candidate, 'adj_pvals'),
+    'stats': (stats_reference, stats_candidate, 'raw'),
+}
+
+
+def missing_input(golden_path, path, raw_data_file=None):
+    """
+    Why `path` can't run on golden_path, or None if it can
+    """
+    needs = PATHS[path][2]
+    if needs == 'adj_pvals' and not os.path.isfile(os.path.join(golden_path, pval_thresholds.ADJ_PVALS_FNAME)):
+        return 'no {}'.format(pval_thresholds.ADJ_PVALS_FNAME)
+    if needs == 'raw' and raw_data_file is None and find_raw_data_file(golden_path) is None:
+        return 'no {}'.format(RAW_PATTERN)
+    return None
+
+
+def check(golden_path, paths=None, rtol=RTOL, atol=ATOL, workers=1, raw_data_file=None, keep=None):
+    """
+    Run the reference and candidate implementation of every path against the golden
+    folders in golden_path. Returns (summary, mismatches): one summary row per path
+    with both timings and mismatch counts, and one mismatch row per differing cell.
+    Scratch output is deleted unless `keep` names a directory to write it under.
+    """
+    golden_path = os.path.abspath(golden_path)
+    published = golden_dirs(golden_path)
+    ## so the plotting imports aren't timed as part of whichever path runs first
+    import plot_stats_as_heatmap
+    rows, frames = [], []
+    for path in paths or list(PATHS):
+        row = {'path': path}
+        reason = missing_input(golden_path, path, raw_data_file)
+        if reason is not None:
+            row['skipped'] = reason
+            rows.append(row)
+            continue
+        for implementation, function in zip(IMPLEMENTATIONS, PATHS[path][:2]):
+            parent = keep if keep is not None else tempfile.gettempdir()
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            work_path = tempfile.mkdtemp(prefix='golden-{}-{}-'.format(path, implementation), dir=parent)
+            kwargs = {'workers': workers}
+            if PATHS[path][2] == 'raw':
+                kwargs['raw_data_file'] = raw_data_file
+            try:
+                start = time.perf_counter()
+                function(golden_path, work_path, **kwargs)
+                row['{}_s'.format(implementation)] = time.perf_counter() - start
+                mismatches, n_files, n_cells = compare_dirs(
+                    published, results_store.find_threshold_dirs(work_path), rtol, atol)
+            finally:
+                if keep is None:
+                    shutil.rmtree(work_path, ignore_errors=True)
+            mismatches.insert(0, 'implementation', implementation)
+            mismatches.insert(0, 'path', path)
+            frames.append(mismatches)
+            row.update({'files': n_files, 'cells': n_cells, '{}_mismatches'.format(implementation): len(mismatches)})
+        row['speedup'] = row['reference_s'] / row['candidate_s'] if row['candidate_s'] > 0 else numpy.nan
+        rows.append(row)
+
+    columns = ['path', 'reference_s', 'candidate_s', 'speedup', 'files', 'cells',
+               'reference_mismatches', 'candidate_mismatches', 'skipped']
+    summary = pandas.DataFrame(rows)
+    summary = summary.reindex(columns=[c for c in columns if c in summary.columns])
+    counts = ['files', 'cells', 'reference_mismatches', 'candidate_mismatches']
+    summary = summary.astype({c: 'Int64' for c in counts if c in summary.columns})
+    mismatches = pandas.concat(frames, ignore_index=True) if frames else pandas.DataFrame(columns=MISMATCH_COLUMNS)
+    return summary, mismatches.reindex(columns=MISMATCH_COLUMNS)
@@ -0,0 +1,143 @@
+import os, ast, json, hashlib, functools, importlib
+import render
+
+"""
+Content-hash incremental rebuild for the figure jobs in render.py.
+
+For every job the build manifest records a digest of its input files, its keyword
+arguments and the source of the plotting module (which holds the styling) and of
+every module of this directory it imports, directly or through another one, so an
+edit to results_cube.py or render.py redraws the figures too. A job is only rerun
+when that digest changes or one of its outputs is missing. The plotting modules
+declare what a job reads and writes through `job_files(function, kwargs)`.
+
+"""
+
+MANIFEST_NAME = '.build_manifest.json'
+
+
+def file_digest(fname, block_size=1 << 20):
+    sha = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_digest(fname, size, mtime_ns):
+    return file_digest(fname)
+
+
+@functools.lru_cache(maxsize=None)
+def _imported_names(fname, size, mtime_ns):
+    """
+    Top level names of every module a source file imports, including imports
+    inside functions
+    """
+    with open(fname) as f:
+        tree = ast.parse(f.read(), fname)
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            names.add(node.module.split('.')[0])
+    return frozenset(names)
+
+
+def local_sources(module):
+    """
+    {module: source file} of `module` and of every module of this directory it
+    imports, directly or through another local module
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    sources, todo = {}, [module]
+    while todo:
+        name = todo.pop()
+        fname = os.path.join(root, '{}.py'.format(name))
+        if name in sources or not os.path.isfile(fname):
+            continue
+        sources[name] = fname
+        stat = os.stat(fname)
+        todo.extend(_imported_names(fname, stat.st_size, stat.st_mtime_ns))
+    return sources
+
+
+def source_digest(module):
+    """
+    {module: sha1} over `local_sources`. Digests are cached by size and mtime.
+    """
+    digests = {}
+    for name, fname in local_sources(module).items():
+        stat = os.stat(fname)
+        digests[name] = _cached_digest(fname, stat.st_size, stat.st_mtime_ns)
+    return digests
+
+
+def job_files(job):
+    module, function, kwargs = job
+    return importlib.import_module(module).job_files(function, kwargs)
+
+
+def job_digest(job, inputs):
+    module, function, kwargs = job
+    state = {
+        'job': [module, function, sorted((k, str(v)) for k, v in kwargs.items())],
+        'source': source_digest(module),
+        'inputs': {f: file_digest(f) if os.path.isfile(f) else None for f in sorted(inputs)},
+    }
+    return hashlib.sha1(json.dumps(state, sort_keys=True).encode()).hexdigest()
+
+
+def load_manifest(fname):
+    if not os.path.isfile(fname):
+        return {}
+    with open(fname) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, fname):
+    tmp = '{}.{}.tmp'.format(fname, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, fname)
+
+
+def stale_jobs(jobs, manifest):
+    """
+    [(job, digest, outputs)] for the jobs that need to be rerun
+    """
+    stale = []
+    for job in jobs:
+        inputs, outputs = job_files(job)
+        digest = job_digest(job, inputs)
+        up_to_date = all(
+            manifest.get(out) == digest and os.path.isfile(out) for out in outputs
+        )
+        if not up_to_date:
+            stale.append((job, digest, outputs))
+    return stale
+
+
+def build(jobs, manifest_fname, workers=None, force=False):
+    """
+    Render only the stale jobs and record the new digests. Returns the
+    render reports of the jobs that ran and the number that were skipped.
+    """
+    manifest = load_manifest(manifest_fname)
+    if force:
+        stale = []
+        for job in jobs:
+            inputs, outputs = job_files(job)
+            stale.append((job, job_digest(job, inputs), outputs))
+    else:
+        stale = stale_jobs(jobs, manifest)
+
+    reports = render.render([job for job, digest, outputs in stale], workers=workers)
+    for (job, digest, outputs), report in zip(stale, reports):
+        if report['error'] is None:
+            for out in outputs:
+                manifest[out] = digest
+    save_manifest(manifest, manifest_fname)
+    return reports, len(jobs) - len(stale)
@@ -0,0 +1,127 @@
+import numpy, pandas
+import limma_stats
+
+"""
+Streaming ingestion of the long format Wafergen Ct exports.
+
+read_raw_ct + calc_dct read the whole FullDataFrameRawCT file into a frame of strings,
+pivot it to assay x sample and normalise a transposed copy. Here the file is read in
+chunks of CHUNK_SIZE rows and only (assay code, sample code, Ct) triples are kept,
+12 bytes per row. These are scattered into one preallocated float32 samples x genes
+matrix which is then normalised to the reference gene in place, a block of samples
+at a time:
+
+    dct, factors = ingest.ingest(raw_data_file)
+
+dct has the same rows, columns and order as calc_dct(read_raw_ct(raw_data_file)),
+in float32. The values agree to float32 precision, not exactly.
+
+The fitted p-values agree to about 7e-5 in log10 adj.P.Val on synthetic data, so an
+indicator can only flip for a p-value that close to a cut-off (see tests/test_ingest.py).
+
+Sample factors are parsed from the distinct sample names only, into categorical
+treatment/cell_line codes, float32 time and int16 replicate.
+
+"""
+
+CHUNK_SIZE = 500000
+BLOCK_SIZE = 4096
+
+
+def _encode(values, table):
+    """
+    Integer codes for `values`, adding unseen labels to the label -> code `table`
+    """
+    codes, uniques = pandas.factorize(values)
+    mapping = numpy.array([table.setdefault(u, len(table)) for u in uniques], dtype=numpy.int32)
+    return mapping[codes]
+
+
+def _sorted_codes(codes, table):
+    """
+    Recode so codes follow the sorted labels, like the pivot in read_raw_ct
+    """
+    labels = sorted(table)
+    recode = numpy.empty(len(table), dtype=numpy.int32)
+    recode[[table[label] for label in labels]] = numpy.arange(len(labels), dtype=numpy.int32)
+    return recode[codes], labels
+
+
+def read_ct_codes(raw_data_file, chunk_size=CHUNK_SIZE):
+    """
+    Stream the export into (assay codes, sample codes, Ct, assays, samples)
+    with codes indexing the sorted assay and sample names
+    """
+    assays, samples = {}, {}
+    assay_codes, sample_codes, cts = [], [], []
+    for chunk in pandas.read_csv(raw_data_file, usecols=['Assay', 'Sample', 'Ct'], chunksize=chunk_size):
+        assay_codes.append(_encode(chunk['Assay'].values, assays))
+        sample_codes.append(_encode(chunk['Sample'].values, samples))
+        cts.append(pandas.to_numeric(chunk['Ct'], errors='coerce').values.astype(numpy.float32))
+
+    assay_codes, assay_labels = _sorted_codes(numpy.concatenate(assay_codes), assays)
+    sample_codes, sample_labels = _sorted_codes(numpy.concatenate(sample_codes), samples)
+    return assay_codes, sample_codes, numpy.concatenate(cts), assay_labels, sample_labels
+
+
+def ct_matrix(assay_codes, sample_codes, ct, n_assays, n_samples):
+    """
+    Scatter the triples into a preallocated float32 samples x assays matrix.
+    Missing wells are NaN; repeated assay/sample rows are an error, as in the pivot.
+    """
+    flat = sample_codes.astype(numpy.int64) * n_assays + assay_codes
+    if numpy.bincount(flat, minlength=n_samples * n_assays).max(initial=0) > 1:
+        raise ValueError('the raw data contains repeated Assay/Sample rows')
+    matrix = numpy.full((n_samples, n_assays), numpy.nan, dtype=numpy.float32)
+    matrix.ravel()[flat] = ct
+    return matrix
+
+
+def normalise(matrix, reference_column, block_size=BLOCK_SIZE):
+    """
+    In place 2^-(Ct - Ct_ref) over blocks of `block_size` samples
+    """
+    for start in range(0, matrix.shape[0], block_size):
+        block = matrix[start:start + block_size]
+        reference = block[:, reference_column].copy()
+        numpy.subtract(block, reference[:, None], out=block)
+        numpy.negative(block, out=block)
+        numpy.exp2(block, out=block)
+    return matrix
+
+
+def parse_samples(samples):
+    """
+    Compact equivalent of limma_stats.sample_factors: categorical treatment and
+    cell_line, float32 time and int16 replicate
+    """
+    parts = pandas.Series(samples).str.split('_', expand=True)
+    parts.columns = limma_stats.FACTORS
+    factors = pandas.DataFrame({
+        'treatment': pandas.Categorical(parts['treatment']),
+        'time': parts['time'].astype(numpy.float32).values,
+        'cell_line': pandas.Categorical(parts['cell_line']),
+        'replicate': parts['replicate'].astype(numpy.int16).values,
+    }, index=pandas.Index(samples, name='Sample'))
+    return factors[limma_stats.FACTORS]
+
+
+def ingest(raw_data_file, reference='PPIA', chunk_size=CHUNK_SIZE, drop=None):
+    """
+    Streamed replacement for calc_dct(read_raw_ct(raw_data_file)) and sample_factors.
+    Returns the float32 samples x genes delta Ct frame and the sample factors.
+    Samples in `drop` (e.g. those flagged by raw_qc) are left out.
+    """
+    assay_codes, sample_codes, ct, assays, samples = read_ct_codes(raw_data_file, chunk_size)
+    if reference not in assays:
+        raise KeyError('reference gene {} is not in {}'.format(reference, raw_data_file))
+    matrix = ct_matrix(assay_codes, sample_codes, ct, len(assays), len(samples))
+    del assay_codes, sample_codes, ct
+    if drop:
+        keep = ~numpy.isin(samples, list(drop))
+        matrix = matrix[keep]
+        samples = [s for s, k in zip(samples, keep) if k]
+    normalise(matrix, assays.index(reference))
+    dct = pandas.DataFrame(matrix, index=pandas.Index(samples, name='Sample'),
+                           columns=pandas.Index(assays, name='Assay'), copy=False)
+    return dct, parse_samples(samples)
@@ -0,0 +1,196 @@
+import os, time, json, resource, tracemalloc, contextlib
+
+"""
+Opt-in stage timing and memory instrumentation.
+
+Code marks its stages with
+
+    with instrument.stage('savefig', fname=fname):
+        fig.savefig(fname)
+
+which is a no-op unless profiling has been enabled, either with instrument.enable()
+(pipeline.py --profile trace.json) or through the WAFERGEN_PROFILE environment
+variable that enable() sets so render and fit worker processes profile too.
+
+Each stage records wall time, CPU time and peak memory while it ran (the resident
+set high-water mark, or traced allocations with memory='tracemalloc'); nested
+stages are fine. Events are kept in Chrome trace format
+("ph": "X" complete events, times in microseconds) so a trace opens directly in
+chrome://tracing or Perfetto, and `summary` folds them into one screen of
+per-stage totals and the slowest output files.
+
+"""
+
+ENV_VAR = 'WAFERGEN_PROFILE'
+MEMORY_MODES = ['rss', 'tracemalloc']
+
+_STATE = {'enabled': False, 'memory': 'rss', 'events': [], 'stack': []}
+
+
+def enable(memory='rss'):
+    """
+    Start recording. memory='rss' measures the resident set high-water mark, which
+    costs nothing but is per process; 'tracemalloc' counts Python and numpy
+    allocations exactly but slows the run down several times.
+    """
+    if memory not in MEMORY_MODES:
+        raise ValueError('memory must be one of {}'.format(MEMORY_MODES))
+    os.environ[ENV_VAR] = memory
+    _STATE['enabled'] = True
+    _STATE['memory'] = memory
+    if memory == 'tracemalloc' and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    os.environ.pop(ENV_VAR, None)
+    _STATE['enabled'] = False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def enabled():
+    return _STATE['enabled']
+
+
+def _rss_peak():
+    """
+    VmHWM in bytes, falling back to ru_maxrss where /proc isn't available
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _reset_rss_peak():
+    ## Linux resets VmHWM to the current RSS on writing 5 to clear_refs. Elsewhere the
+    ## peak can't be reset and stages report the process high-water mark instead.
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _memory():
+    """
+    (current, peak since last reset) in bytes, for the active memory mode
+    """
+    if _STATE['memory'] == 'tracemalloc':
+        return tracemalloc.get_traced_memory()
+    return None, _rss_peak()
+
+
+def _reset_peak():
+    if _STATE['memory'] == 'tracemalloc':
+        tracemalloc.reset_peak()
+    else:
+        _reset_rss_peak()
+
+
+@contextlib.contextmanager
+def stage(name, **args):
+    if not _STATE['enabled']:
+        yield
+        return
+    stack = _STATE['stack']
+    ## fold the peak so far into the enclosing stage before resetting it for this one
+    if stack:
+        stack[-1]['peak'] = max(stack[-1]['peak'], _memory()[1])
+    _reset_peak()
+    frame = {'peak': 0, 'start': time.perf_counter(), 'cpu': time.process_time()}
+    stack.append(frame)
+    try:
+        yield
+    finally:
+        stack.pop()
+        peak = max(frame['peak'], _memory()[1])
+        if stack:
+            stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+        _STATE['events'].append({
+            'name': name,
+            'ph': 'X',
+            'ts': frame['start'] * 1e6,
+            'dur': (time.perf_counter() - frame['start']) * 1e6,
+            'pid': os.getpid(),
+            'tid': 0,
+            'args': dict({k: str(v) for k, v in args.items()},
+                         cpu_ms=(time.process_time() - frame['cpu']) * 1e3,
+                         peak_mb=peak / 1e6),
+        })
+
+
+def drain():
+    """
+    Events recorded in this process since the last drain, for shipping back from
+    workers. Forked workers inherit the parent's events, which are left out.
+    """
+    pid = os.getpid()
+    events = [e for e in _STATE['events'] if e['pid'] == pid]
+    _STATE['events'] = []
+    return events
+
+
+def add_events(events):
+    _STATE['events'].extend(events)
+
+
+def max_rss_mb():
+    """
+    Peak resident set size of this process and its finished children
+    """
+    usage = [resource.getrusage(who).ru_maxrss for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]]
+    return [u / 1e3 for u in usage]
+
+
+def write_trace(fname, events=None):
+    events = _STATE['events'] if events is None else events
+    self_mb, children_mb = max_rss_mb()
+    trace = {
+        'traceEvents': sorted(events, key=lambda e: e['ts']),
+        'displayTimeUnit': 'ms',
+        'otherData': {'max_rss_mb': self_mb, 'children_max_rss_mb': children_mb},
+    }
+    with open(fname, 'w') as f:
+        json.dump(trace, f)
+    return fname
+
+
+def summary(events=None, n_files=10):
+    """
+    Per-stage totals (calls, wall, cpu, max peak memory) and the slowest output files
+    """
+    events = _STATE['events'] if events is None else events
+    stages = {}
+    for e in events:
+        s = stages.setdefault(e['name'], [0, 0.0, 0.0, 0.0])
+        s[0] += 1
+        s[1] += e['dur'] / 1e6
+        s[2] += e['args']['cpu_ms'] / 1e3
+        s[3] = max(s[3], e['args']['peak_mb'])
+
+    width = max([len('stage')] + [len(name) for name in stages])
+    lines = ['{:<{}} {:>6} {:>10} {:>10} {:>10}'.format('stage', width, 'calls', 'wall s', 'cpu s', 'peak MB')]
+    for name, (calls, wall, cpu, peak) in sorted(stages.items(), key=lambda s: -s[1][1]):
+        lines.append('{:<{}} {:>6} {:>10.3f} {:>10.3f} {:>10.1f}'.format(name, width, calls, wall, cpu, peak))
+
+    files = sorted([e for e in events if 'fname' in e['args']], key=lambda e: -e['dur'])
+    if files:
+        lines.append('')
+        lines.append('slowest output files')
+        for e in files[:n_files]:
+            lines.append('{:>10.3f}s {:>8.1f} MB  {}  {}'.format(
+                e['dur'] / 1e6, e['args']['peak_mb'], e['name'], os.path.basename(e['args']['fname'])))
+    self_mb, children_mb = max_rss_mb()
+    lines.append('')
+    lines.append('max rss {:.0f} MB (workers {:.0f} MB)'.format(self_mb, children_mb))
+    return '\n'.join(lines)
+
+
+if os.environ.get(ENV_VAR) in MEMORY_MODES:
+    enable(os.environ[ENV_VAR])
@@ -0,0 +1,474 @@
+import os
+import numpy, pandas
+from scipy import special, stats
+
+"""
+Python implementation of the statistics in AnotherLimmaBootstrap04-09-2018.R.
+
+For every pair of cell lines, `do_limma` fits `~0 + cell_line * ns(time, df=4)` to
+the delta Ct data, moderates the residual variances with limma's empirical Bayes
+procedure and tests the four cell_line:spline interaction coefficients with a
+moderated F-test, followed by a Benjamini-Hochberg correction across genes.
+
+Here all genes and all pairwise comparisons are fitted at once. Comparisons that
+share a sample layout are stacked into a single batched least squares problem so
+the cost of a fit grows with the size of the data, not with the number of pairs.
+
+"""
+
+TREATMENTS = ['Control', 'TGFb']
+
+## cell line comparisons, in the order the R script builds them
+BETWEEN_GROUPS = {
+    'adult': [(i, j) for i in 'ABC' for j in 'GHI'],
+    'sen': [(i, j) for i in 'ABC' for j in 'DEF'],
+}
+
+WITHIN_GROUPS = {
+    'neonatal': [('A', 'B'), ('A', 'C'), ('B', 'C')],
+    'senescent': [('D', 'E'), ('D', 'F'), ('E', 'F')],
+    'adult': [('G', 'H'), ('G', 'I'), ('H', 'I')],
+}
+
+FACTORS = ['treatment', 'time', 'cell_line', 'replicate']
+
+
+def comparison_grid():
+    """
+    Every comparison the R script performs as a list of
+    (kind, treatment, group, (cell_line1, cell_line2)) tuples.
+    """
+    grid = []
+    for treatment in TREATMENTS:
+        for group, pairs in BETWEEN_GROUPS.items():
+            for pair in pairs:
+                grid.append(('between', treatment, group, pair))
+    for group, pairs in WITHIN_GROUPS.items():
+        for treatment in TREATMENTS:
+            for pair in pairs:
+                grid.append(('within', treatment, group, pair))
+    return grid
+
+
+def comparison_columns(grid=None):
+    grid = comparison_grid() if grid is None else grid
+    return pandas.MultiIndex.from_tuples(
+        [(kind, treatment, group, '_'.join(pair)) for kind, treatment, group, pair in grid],
+        names=['kind', 'treatment', 'group', 'pair']
+    )
+
+
+def read_raw_ct(raw_data_file):
+    """
+    Read the long format Wafergen export and reshape to assay x sample,
+    equivalent to `dcast(df, formula = Assay ~ Sample, value.var='Ct')`
+    """
+    df = pandas.read_csv(raw_data_file, usecols=['Assay', 'Sample', 'Ct'])
+    df['Ct'] = pandas.to_numeric(df['Ct'], errors='coerce')
+    return df.pivot(index='Assay', columns='Sample', values='Ct')
+
+
+def calc_dct(ct, reference='PPIA'):
+    """
+    Normalise to the reference gene. Returns samples x genes of 2^-(Ct - Ct_ref)
+    """
+    ct = ct.T
+    return 2 ** (-(ct.sub(ct[reference], axis=0)))
+
+
+def sample_factors(samples):
+    """
+    Split `treatment_time_cellline_replicate` sample names into a data frame
+    """
+    factors = pandas.DataFrame([s.split('_') for s in samples], index=samples, columns=FACTORS)
+    factors['time'] = factors['time'].astype(float)
+    factors['replicate'] = factors['replicate'].astype(int)
+    return factors
+
+
+def natural_spline_basis(x, df=4):
+    """
+    Natural cubic spline basis for x without intercept, spanning the same space as
+    R's `ns(x, df=df)`: interior knots at quantiles of x, boundary knots at its range.
+
+    Uses the truncated power form (Hastie et al. Elements of Statistical Learning 5.4).
+    The basis differs from R's B-spline parametrisation but has the same column space,
+    so tests on the interaction block of `~0 + cell_line * X` are identical.
+    """
+    x = numpy.asarray(x, dtype=float)
+    lo, hi = x.min(), x.max()
+    z = (x - lo) / (hi - lo)
+    interior = numpy.percentile(z, numpy.linspace(0, 100, df + 1)[1:-1])
+    knots = numpy.concatenate([[0.0], interior, [1.0]])
+
+    def d(k):
+        return (numpy.clip(z - knots[k], 0, None) ** 3
+                - numpy.clip(z - knots[-1], 0, None) ** 3) / (knots[-1] - knots[k])
+
+    columns = [z] + [d(k) - d(len(knots) - 2) for k in range(len(knots) - 2)]
+    return numpy.column_stack(columns)
+
+
+def design_matrix(cell_line, time, first):
+    """
+    Equivalent of `model.matrix(~0 + cell_line * X)` with X = ns(time, df=4).
+    Returns the design and the column indices of the interaction coefficients
+    (coef=7:10 in the R script).
+    """
+    spline = natural_spline_basis(time)
+    other = (numpy.asarray(cell_line) != first).astype(float)[:, None]
+    design = numpy.hstack([1 - other, other, spline, other * spline])
+    n_spline = spline.shape[1]
+    return design, numpy.arange(2 + n_spline, 2 + 2 * n_spline)
+
+
+def trigamma_inverse(x):
+    """
+    Vectorised port of limma's trigammaInverse (Newton iteration)
+    """
+    x = numpy.asarray(x, dtype=float)
+    y = 0.5 + 1.0 / x
+    big = x > 1e7
+    small = x < 1e-6
+    y = numpy.where(big, 1.0 / numpy.sqrt(numpy.where(big, x, 1.0)), y)
+    y = numpy.where(small, 1.0 / numpy.where(small, x, 1.0), y)
+    active = ~(big | small)
+    for _ in range(50):
+        if not active.any():
+            break
+        tri = special.polygamma(1, y)
+        dif = tri * (1 - tri / x) / special.polygamma(2, y)
+        y = numpy.where(active, y + dif, y)
+        active = active & (numpy.abs(-dif / y) > 1e-8)
+    return y
+
+
+def fit_f_dist(s2, df):
+    """
+    limma's fitFDist applied along the last axis of s2.
+    Returns (s0^2, d0) with one value per leading index.
+    """
+    s2 = numpy.array(s2, dtype=float)
+    df = numpy.broadcast_to(numpy.asarray(df, dtype=float), s2.shape)
+    ok = numpy.isfinite(s2) & (s2 > -1e-15) & (df > 1e-15)
+    s2 = numpy.where(ok, numpy.clip(s2, 0, None), numpy.nan)
+    m = numpy.nanmedian(s2, axis=-1, keepdims=True)
+    m = numpy.where(m == 0, 1.0, m)
+    s2 = numpy.maximum(s2, 1e-5 * m)
+    df = numpy.where(ok, df, numpy.nan)
+
+    e = numpy.log(s2) - special.digamma(df / 2) + numpy.log(df / 2)
+    n = ok.sum(axis=-1)
+    emean = numpy.nanmean(e, axis=-1)
+    evar = numpy.nansum((e - emean[..., None]) ** 2, axis=-1) / (n - 1)
+    evar = evar - numpy.nanmean(special.polygamma(1, df / 2), axis=-1)
+
+    positive = evar > 0
+    d0 = numpy.full(evar.shape, numpy.inf)
+    d0[positive] = 2 * trigamma_inverse(evar[positive])
+    ## with no excess variance limma (since 3.30) uses the pooled variance, not the
+    ## limit of the evar > 0 estimate
+    s20 = numpy.nanmean(s2, axis=-1)
+    s20[positive] = numpy.exp(emean[positive] + special.digamma(d0[positive] / 2)
+                              - numpy.log(d0[positive] / 2))
+    return s20, d0
+
+
+def p_adjust_bh(p):
+    """
+    Benjamini-Hochberg along the last axis, ignoring NaN like R's p.adjust
+    """
+    p = numpy.asarray(p, dtype=float)
+    flat = p.reshape(-1, p.shape[-1])
+    out = numpy.full(flat.shape, numpy.nan)
+    for row in range(flat.shape[0]):
+        ok = numpy.flatnonzero(numpy.isfinite(flat[row]))
+        n = ok.size
+        if n == 0:
+            continue
+        order = ok[numpy.argsort(flat[row, ok])[::-1]]
+        ranks = numpy.arange(n, 0, -1)
+        adjusted = numpy.minimum.accumulate(flat[row, order] * n / ranks)
+        out[row, order] = numpy.minimum(adjusted, 1)
+    return out.reshape(p.shape)
+
+
+def _lm_fit(designs, y):
+    """
+    Batched least squares. designs is (P, n, p), y is (P, n, G).
+    Genes with missing values are refitted individually on their observed samples,
+    as lmFit does.
+    """
+    n_tasks, n, p = designs.shape
+    n_genes = y.shape[2]
+    pinv = numpy.linalg.pinv(designs)
+    cov = pinv @ pinv.transpose(0, 2, 1)
+
+    complete = numpy.isfinite(y).all(axis=1)
+    y0 = numpy.where(numpy.isfinite(y), y, 0.0)
+    coef = pinv @ y0
+    resid = y0 - designs @ coef
+    df = numpy.full((n_tasks, n_genes), float(n - p))
+    s2 = (resid ** 2).sum(axis=1) / df
+    stdev = numpy.broadcast_to(
+        numpy.sqrt(numpy.diagonal(cov, axis1=1, axis2=2))[:, :, None], coef.shape
+    ).copy()
+
+    for task, gene in zip(*numpy.nonzero(~complete)):
+        observed = numpy.isfinite(y[task, :, gene])
+        x = designs[task][observed]
+        rank = numpy.linalg.matrix_rank(x) if x.size else 0
+        if observed.sum() <= rank or rank < p:
+            coef[task, :, gene] = numpy.nan
+            s2[task, gene] = numpy.nan
+            df[task, gene] = 0
+            continue
+        gene_pinv = numpy.linalg.pinv(x)
+        coef[task, :, gene] = gene_pinv @ y[task, observed, gene]
+        r = y[task, observed, gene] - x @ coef[task, :, gene]
+        df[task, gene] = observed.sum() - p
+        s2[task, gene] = (r ** 2).sum() / df[task, gene]
+        stdev[task, :, gene] = numpy.sqrt(numpy.diag(gene_pinv @ gene_pinv.T))
+    return coef, stdev, s2, df, cov
+
+
+def moderated_f(designs, y, coefs):
+    """
+    lmFit + eBayes + topTable(coef=coefs) for a stack of comparisons.
+
+    designs: (P, n, p) design matrices
+    y: (P, n, G) expression for each comparison
+    coefs: indices of the coefficients to test jointly
+
+    Returns (F, P.Value, adj.P.Val), each of shape (P, G)
+    """
+    coef, stdev, s2, df, cov = _lm_fit(designs, y)
+    s20, d0 = fit_f_dist(s2, df)
+    d0 = d0[:, None]
+    s20 = s20[:, None]
+    with numpy.errstate(invalid='ignore'):
+        s2_post = numpy.where(numpy.isinf(d0), s20, (df * s2 + d0 * s20) / (df + d0))
+    df_total = numpy.minimum(df + d0, numpy.nansum(df, axis=1, keepdims=True))
+
+    t = coef[:, coefs, :] / stdev[:, coefs, :] / numpy.sqrt(s2_post)[:, None, :]
+    sub = cov[:, coefs][:, :, coefs]
+    sd = numpy.sqrt(numpy.diagonal(sub, axis1=1, axis2=2))
+    cor = sub / sd[:, :, None] / sd[:, None, :]
+    r = len(coefs)
+    f = numpy.einsum('pig,pij,pjg->pg', t, numpy.linalg.inv(cor), t) / r
+    pvalue = stats.f.sf(f, r, df_total)
+    pvalue[~numpy.isfinite(f)] = numpy.nan
+    return f, pvalue, p_adjust_bh(pvalue)
+
+
+def comparison_samples(factors, treatment, pair):
+    """
+    Rows of `dct` used by do_limma for one comparison
+    """
+    mask = ((factors['treatment'] == treatment) & factors['cell_line'].isin(pair)).values
+    return numpy.flatnonzero(mask)
+
+
+def fit_comparisons(dct, factors, grid=None):
+    """
+    Run every comparison in `grid` and return the adj.P.Val matrix as a
+    gene x comparison data frame (columns from `comparison_columns`).
+    """
+    grid = comparison_grid() if grid is None else grid
+    genes = sorted(dct.columns)
+    ## avoid a copy of the whole matrix when it is already in gene order (shared_dct)
+    values = dct.values if list(dct.columns) == genes else dct[genes].values
+    adj = numpy.full((len(genes), len(grid)), numpy.nan)
+
+    ## group comparisons with the same number of samples so they can be stacked
+    batches = {}
+    for task, (kind, treatment, group, pair) in enumerate(grid):
+        rows = comparison_samples(factors, treatment, pair)
+        batches.setdefault(rows.size, []).append((task, rows, pair))
+
+    for n, tasks in batches.items():
+        designs = []
+        for task, rows, pair in tasks:
+            design, coefs = design_matrix(factors['cell_line'].values[rows],
+                                          factors['time'].values[rows], pair[0])
+            designs.append(design)
+        y = numpy.stack([values[rows] for task, rows, pair in tasks])
+        f, pvalue, adj_pvalue = moderated_f(numpy.stack(designs), y, coefs)
+        adj[:, [task for task, rows, pair in tasks]] = adj_pvalue.T
+
+    return pandas.DataFrame(adj, index=pandas.Index(genes, name='gene'),
+                            columns=comparison_columns(grid))
+
+
+def select(adj_pvals, kind, treatment, group=None):
+    """
+    Columns of the adj.P.Val matrix for one kind/treatment (and optionally group),
+    in grid order
+    """
+    columns = adj_pvals.columns
+    mask = ((columns.get_level_values('kind') == kind)
+            & (columns.get_level_values('treatment') == treatment))
+    if group is not None:
+        mask &= columns.get_level_values('group') == group
+    return adj_pvals.loc[:, mask]
+
+
+def indicators(adj_pvals, pval):
+    """
+    Vectorised check_pval: 1 where adj.P.Val < pval, 0 otherwise (including NA)
+    """
+    return (adj_pvals < pval).astype(int)
+
+
+def between_statistics(hits, treatment):
+    """
+    The table written to between_{control,tgfb}_statistics.csv, from a
+    gene x comparison indicator frame (see `indicators`)
+    """
+    hits = select(hits, 'between', treatment)
+    hits.columns = ['{}.{}'.format(c[2], c[3]) for c in hits.columns]
+    adult = [c for c in hits.columns if c.startswith('adult.')]
+    sen = [c for c in hits.columns if c.startswith('sen.')]
+    df = hits[adult + sen].copy()
+    df['sen_perc'] = df[sen].sum(axis=1) / len(sen) * 100
+    df['ad_perc'] = df[adult].sum(axis=1) / len(adult) * 100
+    return df
+
+
+def within_statistics(hits, group):
+    """
+    The table written to within_{neonatal,adult,senescent}.csv
+    """
+    df = pandas.DataFrame(index=hits.index)
+    for column, treatment in [('tgfb_perc', 'TGFb'), ('ctrl_perc', 'Control')]:
+        group_hits = select(hits, 'within', treatment, group)
+        df[column] = group_hits.sum(axis=1) / group_hits.shape[1] * 100
+    return df
+
+
+def write_r_csv(df, fname):
+    """
+    Write a frame the way R's write.csv does, so outputs diff cleanly against
+    the files the R pipeline produced.
+    """
+    df = df.copy()
+    df.index.name = None
+    lines = [','.join(['""'] + ['"{}"'.format(c) for c in df.columns])]
+    for gene, row in zip(df.index, df.values):
+        lines.append(','.join(['"{}"'.format(gene)] + ['{:.15g}'.format(v) for v in row]))
+    with open(fname, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def write_statistics(hits, pval_dir):
+    """
+    Write the between/within statistics for one threshold. `hits` is the
+    indicator frame, i.e. `indicators(adj_pvals, pval)`
+    """
+    if not os.path.isdir(pval_dir):
+        os.makedirs(pval_dir)
+    for treatment, name in [('Control', 'control'), ('TGFb', 'tgfb')]:
+        write_r_csv(between_statistics(hits, treatment),
+                    os.path.join(pval_dir, 'between_{}_statistics.csv'.format(name)))
+    for group in WITHIN_GROUPS:
+        write_r_csv(within_statistics(hits, group),
+                    os.path.join(pval_dir, 'within_{}.csv'.format(group)))
+
+
+def pval_suffix(pval):
+    """
+    A threshold as it appears in file and folder names: 1e-5, '1e-5' and '0.00001'
+    all give 0_00001
+    """
+    return numpy.format_float_positional(float(pval), trim='-').replace('.', '_')
+
+
+def pval_dir_name(pval):
+    """
+    The pval_less_than_* folder of a threshold; every reader and writer of the
+    folders goes through here
+    """
+    return 'pval_less_than_{}'.format(pval_suffix(pval))
+
+
+def quality_checks(saved_objects_path, raw_data_file, figures=False, drop_flagged=False):
+    """
+    Run raw_qc on the raw file. Returns the samples to leave out of the fits (the
+    flagged ones with `drop_flagged`, otherwise none) and the sample, flagged and
+    dropped counts for the caller to report.
+    """
+    import raw_qc, instrument
+    with instrument.stage('qc', fname=raw_data_file):
+        report = raw_qc.run(saved_objects_path, raw_data_file, figures=figures)
+    flagged = report.flagged_samples()
+    drop = flagged if drop_flagged else []
+    return drop, {'samples': len(report.samples), 'flagged': len(flagged), 'dropped': len(drop)}
+
+
+def ingest_shared(saved_objects_path, raw_data_file, drop=()):
+    """
+    Ingest the raw file into a shared_dct run directory keyed on the file and the
+    dropped samples, reusing a finished one. Returns its path.
+    """
+    import ingest, instrument, run_dirs, shared_dct
+    params = dict(run_dirs.file_params(raw_data_file), drop=sorted(drop))
+    path = run_dirs.completed(saved_objects_path, shared_dct.DCT_NAME, params)
+    if path is None:
+        with instrument.stage('ingest', fname=raw_data_file):
+            dct, factors = ingest.ingest(raw_data_file, drop=drop)
+        with instrument.stage('write_dct'):
+            with run_dirs.atomic_run(saved_objects_path, shared_dct.DCT_NAME, params) as tmp:
+                shared_dct.write_dct(dct, factors, tmp)
+        del dct, factors
+        path = run_dirs.completed(saved_objects_path, shared_dct.DCT_NAME, params)
+    return path
+
+
+def store_thresholds(pvals):
+    """
+    Thresholds kept in the results store: the standard ones plus any requested
+    """
+    import pval_thresholds
+    return sorted(set(pval_thresholds.THRESHOLDS + [float(p) for p in pvals]), reverse=True)
+
+
+def run(saved_objects_path, raw_data_file, pvals, workers=1, n_resamples=10000, qc=False, qc_figures=False,
+        drop_flagged=False):
+    """
+    The full statistics stage: fit every comparison, save the adj.P.Val matrix
+    and results store and write the pval_less_than_* folder for each threshold,
+    with n_resamples bootstrap/permutation resamples in consensus_intervals.csv.
+    With `qc` (implied by `drop_flagged`) the raw data is checked by raw_qc first
+    and, with `drop_flagged`, flagged samples are left out of every fit.
+
+    Returns the adj.P.Val frame and a report of the QC counts (None without `qc`)
+    and the comparison chunks the scheduler had to retry.
+    """
+    import pval_thresholds, results_store, ingest, instrument, run_dirs
+    pvals = [float(p) for p in pvals]
+    ## fail before the fit rather than after it if a published folder is in the way
+    run_dirs.check_links(saved_objects_path, [pval_dir_name(p) for p in pvals] + [results_store.STORE_NAME])
+    drop, report = [], {'qc': None, 'retried': []}
+    if qc or drop_flagged:
+        drop, report['qc'] = quality_checks(saved_objects_path, raw_data_file, figures=qc_figures,
+                                            drop_flagged=drop_flagged)
+    ## comparisons only select Control/TGFb rows, so Baseline samples need not be dropped first
+    if workers > 1:
+        import scheduler
+        ## the memory-mapped matrix is a run keyed on the raw file, reused by later runs
+        path = ingest_shared(saved_objects_path, raw_data_file, drop)
+        with instrument.stage('fit', workers=workers):
+            adj_pvals, report['retried'] = scheduler.run_shared_grid(path, workers=workers)
+    else:
+        with instrument.stage('ingest', fname=raw_data_file):
+            dct, factors = ingest.ingest(raw_data_file, drop=drop)
+        with instrument.stage('fit', workers=1):
+            adj_pvals = fit_comparisons(dct, factors)
+
+    with instrument.stage('write_thresholds'):
+        pval_thresholds.save_adj_pvals(adj_pvals, os.path.join(saved_objects_path, pval_thresholds.ADJ_PVALS_FNAME))
+        pval_thresholds.write_thresholds(adj_pvals, pvals, saved_objects_path, n_resamples=n_resamples)
+    with instrument.stage('build_store'):
+        results_store.build_store(adj_pvals, os.path.join(saved_objects_path, results_store.STORE_NAME),
+                                  thresholds=store_thresholds(pvals))
+    return adj_pvals, report
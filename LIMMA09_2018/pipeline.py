@@ -0,0 +1,358 @@
+import os, sys, argparse
+
+"""
+Command line entry point for the statistics and plotting steps.
+
+    python pipeline.py stats   --directory DIR [--pval 0.001 ...] [--workers N] [--qc --drop-flagged]
+    python pipeline.py qc      --directory DIR [--figures]
+    python pipeline.py within  --input-dir DIR/SavedObjects --pval 0.001 [--output-dir OUT] [--row-order cluster]
+    python pipeline.py between --input-dir DIR/SavedObjects --pval 0.001 0.0001
+    python pipeline.py sweep   --input-dir DIR/SavedObjects
+    python pipeline.py bars    --input-dir DIR/SavedObjects [--pval ...] [--dpi 72] [--format pdf] [--top-level]
+    python pipeline.py all     --input-dir DIR/SavedObjects --pval ...
+    python pipeline.py surface --input-dir DIR/SavedObjects [--fdr 1e-10 0.05] [--points 50]
+    python pipeline.py serve   --input-dir DIR/SavedObjects [--port 8050]
+    python pipeline.py batch   '/data/plates/*' [--list experiments.txt] [--workers 4] [--restart]
+    python pipeline.py golden  --input-dir DIR/SavedObjects [--paths counts tables] [--report mismatches.csv]
+    python pipeline.py bench   --genes 68 500 5000 [--render]
+
+Any subcommand can be profiled with `python pipeline.py --profile trace.json <command> ...`,
+which prints a per-stage summary and writes a Chrome trace (see instrument.py).
+
+Heavy modules (pandas, seaborn, matplotlib) are only imported inside the
+subcommand that needs them, so starting the CLI is cheap.
+
+"""
+
+DEFAULT_DIRECTORY = r'/home/b3053674/Documents/LargeStudy/LIMMA09-2018'
+
+
+def read_pval_file(directory):
+    """
+    Threshold from the `pval` settings file in `directory`, or None
+    """
+    fname = os.path.join(directory, 'pval')
+    if not os.path.isfile(fname):
+        return None
+    with open(fname) as f:
+        return f.read().strip()
+
+
+def thresholds(args, directories=None):
+    """
+    --pval, or the `pval` settings file in the first of `directories` that has one
+    (by default the study directory above --input-dir, then --input-dir itself)
+    """
+    if args.pval:
+        return args.pval
+    if directories is None:
+        directories = [os.path.dirname(os.path.abspath(args.input_dir)), args.input_dir]
+    for directory in directories:
+        pval = read_pval_file(directory)
+        if pval is not None:
+            return [pval]
+    raise SystemExit('no --pval given and no `pval` settings file in {}'.format(' or '.join(directories)))
+
+
+def run_stats(args):
+    import limma_stats
+    saved_objects_path = os.path.join(args.directory, 'SavedObjects')
+    raw_data_file = args.raw_data_file or os.path.join(saved_objects_path, 'FullDataFrameRawCT_16_003_2018.csv')
+    pvals = thresholds(args, [args.directory])
+    print('pval is "{}"'.format(', '.join(pvals)))
+    try:
+        adj_pvals, report = limma_stats.run(saved_objects_path, raw_data_file, pvals,
+                                            workers=args.workers, n_resamples=args.resamples,
+                                            qc=args.qc, qc_figures=args.qc_figures, drop_flagged=args.drop_flagged)
+    except FileExistsError as e:
+        raise SystemExit(str(e))
+    for retry in report['retried']:
+        print('retried comparisons {} ({})'.format(retry['comparisons'], retry['error']))
+    if report['qc'] is not None:
+        qc = report['qc']
+        print('qc: {} of {} samples flagged{}'.format(qc['flagged'], qc['samples'],
+                                                      ', dropped them' if qc['dropped'] else ''))
+
+
+def run_qc(args):
+    import raw_qc
+    saved_objects_path = os.path.join(args.directory, 'SavedObjects')
+    raw_data_file = args.raw_data_file or os.path.join(saved_objects_path, 'FullDataFrameRawCT_16_003_2018.csv')
+    report = raw_qc.run(saved_objects_path, raw_data_file, reference=args.reference, figures=args.figures,
+                        max_ct=args.max_ct, outlier_ct=args.outlier_ct)
+    print(report.chips.to_string())
+    flagged = report.samples[report.samples['flagged']]
+    print('{} of {} samples flagged'.format(len(flagged), len(report.samples)))
+    if len(flagged):
+        print(flagged[['chip', 'reference_ct', 'reference_z', 'failed_fraction', 'outlier_fraction',
+                       'reasons']].to_string())
+
+
+def gene_order_path(args):
+    """
+    Cached cluster ordering of the genes for --row-order cluster, else None
+    """
+    if getattr(args, 'row_order', 'alphabetical') != 'cluster':
+        return None
+    import gene_order
+    return gene_order.build_order(args.input_dir)
+
+
+def figure_jobs(args):
+    jobs = []
+    order_path = gene_order_path(args)
+    if args.command in ['within', 'between', 'sweep', 'all']:
+        import plot_stats_as_heatmap
+        pvals = thresholds(args) if args.command != 'sweep' else []
+        jobs += plot_stats_as_heatmap.figure_jobs(
+            args.input_dir, pvals,
+            within=args.command in ['within', 'all'],
+            between=args.command in ['between', 'all'],
+            pval_graph=args.command in ['sweep', 'all'],
+            output_path=args.output_dir,
+            mode=args.heatmap_mode,
+            rows_per_page=args.rows_per_page,
+            order_path=order_path,
+        )
+    if args.command == 'surface':
+        import threshold_sweep
+        jobs += threshold_sweep.figure_jobs(
+            args.input_dir, output_path=args.output_dir,
+            fdrs=threshold_sweep.fdr_grid(args.fdr[0], args.fdr[1], args.points),
+            consensus=threshold_sweep.numpy.arange(0, 100, args.consensus_step),
+        )
+    if args.command in ['bars', 'all']:
+        import plot_statistics_as_bar_charts
+        if getattr(args, 'top_level', False):
+            jobs += plot_statistics_as_bar_charts.figure_jobs(
+                args.input_dir, thresholds(args)[0], output_path=args.output_dir,
+                dpi=args.dpi, fmt=args.format, order_path=order_path
+            )
+        else:
+            jobs += plot_statistics_as_bar_charts.sweep_jobs(
+                args.input_dir, thresholds(args), output_path=args.output_dir,
+                dpi=args.dpi, fmt=args.format, order_path=order_path
+            )
+    return jobs
+
+
+def run_render(args):
+    import render, incremental
+    render.use_headless_backend()
+    if args.output_dir is not None and not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    manifest_dir = args.input_dir if args.output_dir is None else args.output_dir
+    reports, skipped = incremental.build(
+        figure_jobs(args), os.path.join(manifest_dir, incremental.MANIFEST_NAME),
+        workers=args.workers, force=args.force
+    )
+    print(render.timing_report(reports))
+    print('{} jobs up to date'.format(skipped))
+    if any(r['error'] for r in reports):
+        return 1
+    return 0
+
+
+def run_batch(args):
+    import batch
+    patterns = list(args.experiments)
+    if args.list:
+        patterns += batch.read_experiment_list(args.list)
+    experiments, missing = batch.find_experiments(patterns, raw_pattern=args.raw_pattern)
+    for pattern in missing:
+        print('no experiment with SavedObjects/{} matches {}'.format(args.raw_pattern, pattern))
+    if not experiments:
+        raise SystemExit('no experiments to run')
+    results = batch.run_batch(experiments, workers=args.workers, pvals=args.pval, restart=args.restart,
+                              qc=args.qc, drop_flagged=args.drop_flagged, resamples=args.resamples, dpi=args.dpi)
+    table = batch.throughput(results)
+    table.to_csv(args.report, index=False)
+    print(table.to_string(index=False, float_format='{:.2f}'.format))
+    print('report written to {}'.format(args.report))
+    return 1 if any(r['error'] for r in results) else 0
+
+
+def run_golden(args):
+    import golden
+    try:
+        summary, mismatches = golden.check(args.input_dir, paths=args.paths, rtol=args.rtol, atol=args.atol,
+                                           workers=args.workers, raw_data_file=args.raw_data_file, keep=args.keep)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    print(summary.to_string(index=False, float_format='{:.3f}'.format, na_rep=''))
+    if len(mismatches):
+        print(mismatches.head(args.show).to_string(index=False))
+        if args.report:
+            mismatches.to_csv(args.report, index=False)
+            print('{} mismatches written to {}'.format(len(mismatches), args.report))
+        return 1
+    print('every compared CSV matches the golden outputs')
+    return 0
+
+
+def run_bench(args):
+    import benchmark
+    benchmark.run_suite(args.genes, n_cell_lines=args.cell_lines, n_time_points=args.time_points,
+                        n_replicates=args.replicates, render=args.render, history_fname=args.history)
+
+
+def run_serve(args):
+    import results_server
+    results_server.serve(args.input_dir, host=args.host, port=args.port, cache_size=args.cache_size)
+
+
+def parser():
+    parser = argparse.ArgumentParser(description='LIMMA09_2018 statistics and figures')
+    parser.add_argument('--profile', metavar='TRACE_JSON', default=None,
+                        help='record wall/cpu time and peak memory per stage and output file, '
+                             'write them as a Chrome trace and print a summary')
+    parser.add_argument('--profile-memory', choices=['rss', 'tracemalloc'], default='rss',
+                        help='rss: resident set high-water mark (cheap). tracemalloc: exact '
+                             'allocations, several times slower')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    stats = subparsers.add_parser('stats', help='fit every comparison and write the pval_less_than_* folders')
+    stats.add_argument('--directory', default=DEFAULT_DIRECTORY,
+                       help='study directory containing SavedObjects and the `pval` settings file')
+    stats.add_argument('--raw-data-file', default=None)
+    stats.add_argument('--pval', nargs='*', default=None,
+                       help='thresholds to write. Defaults to the contents of the `pval` settings file')
+    stats.add_argument('--resamples', type=int, default=10000,
+                       help='bootstrap/permutation resamples for the consensus percentage intervals '
+                            'drawn on the bar charts. 0 turns them off')
+    stats.add_argument('--workers', type=int, default=1, help='fit the comparison grid on this many processes')
+    stats.add_argument('--qc', action='store_true', help='check the raw Ct data first (see `qc`)')
+    stats.add_argument('--qc-figures', action='store_true', help='also draw the QC figures')
+    stats.add_argument('--drop-flagged', action='store_true',
+                       help='leave samples flagged by the QC checks out of every fit. Implies --qc')
+    stats.set_defaults(func=run_stats)
+
+    qc = subparsers.add_parser('qc', help='well flags, replicate CVs, reference stability and chip summaries '
+                                          'of the raw Ct data, written to SavedObjects/qc')
+    qc.add_argument('--directory', default=DEFAULT_DIRECTORY, help='study directory containing SavedObjects')
+    qc.add_argument('--raw-data-file', default=None)
+    qc.add_argument('--reference', default='PPIA')
+    qc.add_argument('--max-ct', type=float, default=35.0, help='Ct values above this are flagged as late')
+    qc.add_argument('--outlier-ct', type=float, default=1.0,
+                    help='flag wells this many cycles from the mean of their other replicates')
+    qc.add_argument('--figures', action='store_true', help='reference, replicate CV and well flag figures')
+    qc.set_defaults(func=run_qc)
+
+    for name, help in [('within', 'within group heatmaps'),
+                       ('between', 'between group heatmaps'),
+                       ('sweep', 'gene counts across p-value thresholds'),
+                       ('bars', 'per gene bar charts'),
+                       ('all', 'every figure')]:
+        sub = subparsers.add_parser(name, help=help)
+        sub.add_argument('--input-dir', default=os.path.join(DEFAULT_DIRECTORY, 'SavedObjects'),
+                         help='SavedObjects directory holding the statistics')
+        sub.add_argument('--output-dir', default=None,
+                         help='defaults to SavedObjects/figures/<pval folder> for per-threshold figures, '
+                              'alongside the inputs otherwise')
+        sub.add_argument('--pval', nargs='*', default=None,
+                         help='thresholds to plot. Defaults to the `pval` settings file')
+        sub.add_argument('--workers', type=int, default=None, help='render on this many processes')
+        sub.add_argument('--force', action='store_true', help='rerender figures even if they are up to date')
+        sub.add_argument('--heatmap-mode', choices=['auto', 'raster', 'patches'], default='auto',
+                         help='draw heatmaps as one image (raster) or one patch per cell. '
+                              'auto rasterises large tables')
+        sub.add_argument('--rows-per-page', type=int, default=None,
+                         help='split heatmaps with more genes than this across several files')
+        sub.add_argument('--row-order', choices=['alphabetical', 'cluster'], default='alphabetical',
+                         help='order heatmap rows and bar chart genes alphabetically or by a cached '
+                              'clustering of their percentage profiles (see gene_order.py)')
+        if name in ['bars', 'all']:
+            sub.add_argument('--dpi', type=int, default=350, help='bar chart resolution, e.g. 72 for previews')
+            sub.add_argument('--format', choices=['png', 'pdf', 'svg'], default='png',
+                             help='bar chart file format. pdf/svg are vector output for the paper')
+        if name == 'bars':
+            sub.add_argument('--top-level', action='store_true',
+                             help='bar charts of the statistics CSVs directly in --input-dir, labelled with the '
+                                  'first --pval, instead of those in each pval_less_than_* folder')
+        sub.set_defaults(func=run_render)
+
+    surface = subparsers.add_parser('surface', help='gene counts over a grid of FDR cut-offs x consensus percentages')
+    surface.add_argument('--input-dir', default=os.path.join(DEFAULT_DIRECTORY, 'SavedObjects'),
+                         help='SavedObjects directory holding adj_pvals.npz or the results store')
+    surface.add_argument('--output-dir', default=None, help='defaults to the input directory')
+    surface.add_argument('--fdr', type=float, nargs=2, default=[1e-10, 0.05], metavar=('LOW', 'HIGH'),
+                         help='FDR range, log spaced. Ignored for stores without adj.P.Val values')
+    surface.add_argument('--points', type=int, default=50, help='number of FDR cut-offs')
+    surface.add_argument('--consensus-step', type=float, default=5, help='consensus grid step in percent')
+    surface.add_argument('--workers', type=int, default=1)
+    surface.add_argument('--force', action='store_true')
+    surface.set_defaults(func=run_render)
+
+    serve = subparsers.add_parser('serve', help='answer threshold/consensus queries and render figures over HTTP')
+    serve.add_argument('--input-dir', default=os.path.join(DEFAULT_DIRECTORY, 'SavedObjects'),
+                       help='SavedObjects directory holding the results store')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8050)
+    serve.add_argument('--cache-size', type=int, default=256,
+                       help='entries kept in each LRU cache (slices, tables, heatmaps, bar charts)')
+    serve.set_defaults(func=run_serve)
+
+    batch = subparsers.add_parser('batch', help='ingest, stats, summary and render many experiment directories '
+                                                '(resumable)')
+    batch.add_argument('experiments', nargs='*', help='experiment directories or globs')
+    batch.add_argument('--list', default=None, help='file of experiment directories or globs, one per line')
+    batch.add_argument('--raw-pattern', default='FullDataFrameRawCT*.csv',
+                       help='raw Ct export to look for in each SavedObjects directory')
+    batch.add_argument('--pval', nargs='*', default=None,
+                       help='thresholds for every experiment. Defaults to each one\'s `pval` settings file')
+    batch.add_argument('--workers', type=int, default=None, help='stages run at once. Defaults to the cpu count')
+    batch.add_argument('--restart', action='store_true', help='ignore recorded progress and rerun every stage')
+    batch.add_argument('--qc', action='store_true')
+    batch.add_argument('--drop-flagged', action='store_true')
+    batch.add_argument('--resamples', type=int, default=10000)
+    batch.add_argument('--dpi', type=int, default=350, help='bar chart resolution')
+    batch.add_argument('--report', default='batch_report.csv', help='per-experiment throughput CSV')
+    batch.set_defaults(func=run_batch)
+
+    golden = subparsers.add_parser('golden', help='rerun reference and candidate code paths and compare their '
+                                                  'CSVs with the published pval_less_than_* folders')
+    golden.add_argument('--input-dir', default=os.path.join(DEFAULT_DIRECTORY, 'SavedObjects'),
+                        help='SavedObjects directory holding the golden pval_less_than_* folders')
+    golden.add_argument('--paths', nargs='*', default=None, choices=['counts', 'tables', 'thresholds', 'stats'],
+                        help='paths to check. Defaults to every path whose inputs exist (see golden.py)')
+    golden.add_argument('--raw-data-file', default=None,
+                        help='raw Ct export for the stats path. Defaults to SavedObjects/FullDataFrameRawCT*.csv')
+    golden.add_argument('--rtol', type=float, default=1e-9)
+    golden.add_argument('--atol', type=float, default=1e-9)
+    golden.add_argument('--workers', type=int, default=1, help='workers for the candidate stats path')
+    golden.add_argument('--report', default=None, help='write every mismatching cell to this CSV')
+    golden.add_argument('--show', type=int, default=20, help='mismatches to print')
+    golden.add_argument('--keep', default=None, help='keep the scratch outputs under this directory')
+    golden.set_defaults(func=run_golden)
+
+    bench = subparsers.add_parser('bench', help='time each stage on synthetic data')
+    bench.add_argument('--genes', type=int, nargs='*', default=[68, 500, 5000])
+    bench.add_argument('--cell-lines', type=int, default=9)
+    bench.add_argument('--time-points', type=int, default=11)
+    bench.add_argument('--replicates', type=int, default=2)
+    bench.add_argument('--render', action='store_true', help='include figure rendering')
+    bench.add_argument('--history', default='benchmark_history.jsonl',
+                       help='JSON lines file the results are appended to')
+    bench.set_defaults(func=run_bench)
+    return parser
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    if args.profile is None:
+        return args.func(args) or 0
+
+    import instrument
+    instrument.enable(memory=args.profile_memory)
+    try:
+        with instrument.stage(args.command):
+            return args.func(args) or 0
+    finally:
+        instrument.write_trace(args.profile)
+        print(instrument.summary())
+        print('trace written to {}'.format(args.profile))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
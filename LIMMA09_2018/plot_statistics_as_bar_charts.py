@@ -1,157 +1,249 @@
-import pandas, os, glob, seaborn
+import pandas, numpy, os, functools, seaborn
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+import instrument, limma_stats, run_dirs
 
 """
 We are primarily interest in three questions:
    1) Does gene g respond to TGFb? - Compare TGFb vs Control groups
-   2) Is the gene g response different in adult/senescent compared to neonatal cell lines? - Compare Control groups for cell lines 
+   2) Is the gene g response different in adult/senescent compared to neonatal cell lines? - Compare Control groups for cell lines
    3) Is the gene g response to TGFb different in adult/senescent compared to neonatal cell lines? - Compare treated groups for cell lines
 
-Analysis has been conducted in R, with LIMMA. This script is only for plotting. 
+Analysis has been conducted in R, with LIMMA. This script is only for plotting.
+Run it with `python pipeline.py bars`.
 
 """
-PVAL = 0.001
-
+FIGSIZE = (30, 10)
+DPI = 350
+## gene sets whose laid out figure is kept per process
+TEMPLATE_CACHE = 4
+## bootstrap intervals written next to the statistics by `stats --resamples`
+INTERVALS_FNAME = 'consensus_intervals.csv'
+## parsed consensus_intervals.csv files kept per process; each is shared by ten charts
+INTERVALS_CACHE = 4
 
 seaborn.set_context('talk', font_scale=2)
 seaborn.set_style('white')
 
-directory = r'/home/b3053674/Documents/LargeStudy/LIMMA09-2018'
-saved_objects_path = os.path.join(directory, 'SavedObjects')
-
-## first do the 'between' data plots
-
-between_control_path = os.path.join(saved_objects_path, 'between_control_statistics.csv')
-between_tgfb_path = os.path.join(saved_objects_path, 'between_tgfb_statistics.csv')
-
-between_control_data = pandas.read_csv(between_control_path, index_col=0)
-between_tgfb_data = pandas.read_csv(between_tgfb_path, index_col=0)
-
-between_control_data.index.name = 'Gene'
-between_tgfb_data.index.name = 'Gene'
-
-between_control_data.reset_index(inplace=True)
-between_tgfb_data.reset_index(inplace=True)
-
-
-def plot(data, y=None, fname=None):
-    if y is None:
-        print(data.head())
-        raise ValueError('y cannot be None')
-
-    import matplotlib
-    cmap = matplotlib.cm.get_cmap('gist_rainbow')
-    colours = []
-    count = 0
-    num_colours_needed = data.shape[0]
-    for i in range(num_colours_needed):
-        colours.append(cmap(count))
-        count += 1.0 / num_colours_needed
-
-    fig, ax = plt.subplots(figsize=(30, 10))
-    seaborn.barplot(x='Gene',
-                    y=y,
-                    data=data,
-                    linewidth=2,
-                    edgecolor='black',
-                    palette=reversed(colours)
-                    )
-
-    plt.xticks(rotation=90)
-    plt.xlabel('')
-    plt.ylabel('% < {}'.format(PVAL))
-
-    seaborn.despine(fig=fig, top=True, right=True)
-    if fname is not None:
-        fig.savefig(fname, dpi=350, bbox_inches='tight')
-    plt.show()
-    # print(q2_data)
-
-
-between_control_adult_fname = os.path.join(saved_objects_path, 'between_control_adult.png')
-between_control_senescent_fname = os.path.join(saved_objects_path, 'between_control_sen.png')
-between_tgfb_adult_fname = os.path.join(saved_objects_path, 'between_tgf_adult.png')
-between_tgfb_senescent_fname = os.path.join(saved_objects_path, 'between_tgf_sen.png')
-
-plot(between_control_data, 'ad_perc', fname=between_control_adult_fname)
-plot(between_control_data, 'sen_perc', fname=between_control_senescent_fname)
-plot(between_tgfb_data, 'ad_perc', fname=between_tgfb_adult_fname)
-plot(between_tgfb_data, 'sen_perc', fname=between_tgfb_senescent_fname)
-
 
-
-## Similarly, do the 'within' data plots
-
-within_neonatal_path = os.path.join(saved_objects_path, 'within_neonatal.csv')
-within_adult_path = os.path.join(saved_objects_path, 'within_adult.csv')
-within_senescent_path = os.path.join(saved_objects_path, 'within_senescent.csv')
-
-within_neonatal_data = pandas.read_csv(within_neonatal_path, index_col=0)
-within_adult_data = pandas.read_csv(within_adult_path, index_col=0)
-within_senescent_data = pandas.read_csv(within_senescent_path, index_col=0)
-
-within_neonatal_data.index.name = 'Gene'
-within_adult_data.index.name = 'Gene'
-within_senescent_data.index.name = 'Gene'
-
-within_neonatal_data.reset_index(inplace=True)
-within_adult_data.reset_index(inplace=True)
-within_senescent_data.reset_index(inplace=True)
-
-# print(within_adult_data)
-def plot(data, y=None, fname=None):
+def read_statistics(fname):
+    with instrument.stage('load_statistics', fname=fname):
+        data = pandas.read_csv(fname, index_col=0)
+    data.index.name = 'Gene'
+    data.reset_index(inplace=True)
+    return data
+
+
+def interval_key(csv_fname, y):
+    """
+    The (kind, treatment, group) of consensus_intervals.csv behind column `y` of a
+    statistics file, or None for files the intervals don't cover
+    """
+    name = os.path.basename(csv_fname)
+    if name.startswith('between_') and y in ('ad_perc', 'sen_perc'):
+        treatment = 'TGFb' if name.startswith('between_tgfb') else 'Control'
+        return ('between', treatment, 'adult' if y == 'ad_perc' else 'sen')
+    if name.startswith('within_') and y in ('tgfb_perc', 'ctrl_perc'):
+        return ('within', 'TGFb' if y == 'tgfb_perc' else 'Control', name[len('within_'):-len('.csv')])
+    return None
+
+
+@functools.lru_cache(maxsize=INTERVALS_CACHE)
+def _read_intervals(fname, mtime_ns):
+    with instrument.stage('load_intervals', fname=fname):
+        return pandas.read_csv(fname, index_col=[0, 1, 2, 3]).sort_index()
+
+
+def read_intervals(csv_fname, y):
+    """
+    gene x (ci_low, ci_high) frame for column `y` of a statistics file, or None
+    when there is no consensus_intervals.csv next to it. The file is parsed once
+    per process and modification time.
+    """
+    fname = os.path.join(os.path.dirname(csv_fname), INTERVALS_FNAME)
+    key = interval_key(csv_fname, y)
+    if key is None or not os.path.isfile(fname):
+        return None
+    return _read_intervals(os.path.realpath(fname), os.stat(fname).st_mtime_ns).loc[key, ['ci_low', 'ci_high']]
+
+
+class BarChartTemplate(object):
+    """
+    One gene x percentage bar chart whose figure, bars, palette and tick labels are
+    built once per gene set. `draw` only updates bar heights and the y label, so
+    every further series costs little more than saving the file.
+    """
+
+    def __init__(self, genes, figsize=FIGSIZE):
+        self.genes = list(genes)
+        n = len(self.genes)
+        cmap = plt.get_cmap('gist_rainbow')
+        ## same colours as stepping 1/n through gist_rainbow, reversed, with
+        ## seaborn.barplot's default 0.75 saturation
+        colours = seaborn.color_palette(cmap(numpy.arange(n) / float(max(n, 1)))[::-1, :3], desat=0.75)
+
+        self.fig, self.ax = plt.subplots(figsize=figsize)
+        x = numpy.arange(n)
+        self.bars = self.ax.bar(x, numpy.zeros(n), width=0.8, color=colours,
+                                edgecolor='black', linewidth=2)
+        self.errors = self.ax.add_collection(LineCollection([], colors='black', linewidths=2))
+        self.ax.set_xticks(x)
+        self.ax.set_xticklabels(self.genes, rotation=90)
+        self.ax.set_xlim(-0.5, n - 0.5)
+        self.ax.set_xlabel('')
+        seaborn.despine(fig=self.fig, top=True, right=True)
+
+    def draw(self, values, ylabel='Percentage', intervals=None):
+        """
+        `intervals` is an optional (gene, 2) array of low/high error bar ends
+        """
+        values = numpy.nan_to_num(numpy.asarray(values, dtype=float))
+        for bar, value in zip(self.bars, values):
+            bar.set_height(value)
+        segments = []
+        if intervals is not None:
+            x = numpy.arange(len(values))
+            segments = [[(i, low), (i, high)] for i, (low, high) in zip(x, intervals)
+                        if numpy.isfinite(low) and numpy.isfinite(high)]
+        self.errors.set_segments(segments)
+        self.ax.relim()
+        self.ax.autoscale_view(scalex=False)
+        if segments:
+            top = max(high for (_, low), (_, high) in segments)
+            if top > self.ax.get_ylim()[1]:
+                self.ax.set_ylim(top=top * 1.05, auto=None)
+        self.ax.set_ylabel(ylabel)
+        return self.fig
+
+    def save(self, fname, dpi=DPI, format=None):
+        """
+        The format follows the extension (or `format` for file objects): .pdf/.svg
+        for vector output, .png at `dpi` (e.g. 72 for previews)
+        """
+        with instrument.stage('savefig', fname=fname):
+            if isinstance(fname, str):
+                with run_dirs.atomic_file(fname) as tmp:
+                    self.fig.savefig(tmp, dpi=dpi, bbox_inches='tight', format=format)
+            else:
+                self.fig.savefig(fname, dpi=dpi, bbox_inches='tight', format=format)
+        return fname
+
+    def close(self):
+        plt.close(self.fig)
+
+
+_TEMPLATES = {}
+
+
+def template(genes):
+    """
+    Cached BarChartTemplate for a gene set. Render workers keep theirs between
+    jobs, so a sweep only lays out each gene set once per process.
+    """
+    key = tuple(genes)
+    if key not in _TEMPLATES:
+        if len(_TEMPLATES) >= TEMPLATE_CACHE:
+            _TEMPLATES.pop(next(iter(_TEMPLATES))).close()
+        with instrument.stage('build_template', genes=len(key)):
+            _TEMPLATES[key] = BarChartTemplate(key)
+    return _TEMPLATES[key]
+
+
+def plot(data, y=None, fname=None, ylabel='Percentage', show=True, dpi=DPI, intervals=None):
     if y is None:
         print(data.head())
         raise ValueError('y cannot be None')
 
-    import matplotlib
-    cmap = matplotlib.cm.get_cmap('gist_rainbow')
-    colours = []
-    count = 0
-    num_colours_needed = data.shape[0]
-    for i in range(num_colours_needed):
-        colours.append(cmap(count))
-        count += 1.0 / num_colours_needed
-
-    fig, ax = plt.subplots(figsize=(30, 10))
-
-    seaborn.barplot(x='Gene',
-                    y=y,
-                    data=data,
-                    linewidth=2,
-                    edgecolor='black',
-                    palette=reversed(colours)
-                    )
-
-    plt.xticks(rotation=90)
-    plt.xlabel('')
-    plt.ylabel('Percentage')
-
-    seaborn.despine(fig=fig, top=True, right=True)
+    if show:
+        chart = BarChartTemplate(data['Gene'])
+    else:
+        chart = template(data['Gene'])
+    with instrument.stage('barplot', rows=data.shape[0]):
+        chart.draw(data[y].values, ylabel, intervals=intervals)
     if fname is not None:
-        fig.savefig(fname, dpi=350, bbox_inches='tight')
-    plt.show()
-    # print(q2_data)
-
-
-within_neonatal_control_fname = os.path.join(saved_objects_path, 'within_neonatal_control.png')
-within_neonatal_tgfb_fname = os.path.join(saved_objects_path, 'within_neonatal_tgfb.png')
-
-
-within_adult_control_fname = os.path.join(saved_objects_path, 'within_adult_control.png')
-within_adult_tgfb_fname = os.path.join(saved_objects_path, 'within_adult_tgfb.png')
-
-
-within_senescent_control_fname = os.path.join(saved_objects_path, 'within_senescent_control.png')
-within_senescent_tgfb_fname = os.path.join(saved_objects_path, 'within_senescent_tgfb.png')
-
-
-
-plot(within_neonatal_data, 'tgfb_perc', fname=within_neonatal_control_fname)
-plot(within_neonatal_data, 'ctrl_perc', fname=within_neonatal_tgfb_fname)
-
-plot(within_adult_data, 'tgfb_perc', fname=within_adult_control_fname)
-plot(within_adult_data, 'ctrl_perc', fname=within_adult_tgfb_fname)
-
-plot(within_senescent_data, 'tgfb_perc', fname=within_senescent_control_fname)
-plot(within_senescent_data, 'ctrl_perc', fname=within_senescent_tgfb_fname)
+        chart.save(fname, dpi=dpi)
+    if show:
+        plt.show()
+        chart.close()
+
+
+def plot_from_csv(csv_fname, y, fname, ylabel='Percentage', dpi=DPI, order_path=None):
+    data = read_statistics(csv_fname)
+    if not os.path.isdir(os.path.dirname(fname)):
+        os.makedirs(os.path.dirname(fname))
+    if order_path is not None:
+        import gene_order
+        data = data.set_index('Gene').loc[gene_order.apply_order(data['Gene'], order_path)].reset_index()
+    intervals = read_intervals(csv_fname, y)
+    if intervals is not None:
+        intervals = intervals.reindex(data['Gene']).values
+    plot(data, y, fname=fname, ylabel=ylabel, show=False, dpi=dpi, intervals=intervals)
+    return [fname]
+
+
+def chart_specs(saved_objects_path, pval, output_path=None, fmt='png'):
+    """
+    (statistics csv, column, output file, y label) for each of the ten bar charts.
+    `pval` is the threshold the statistics were computed at, for the y labels.
+    """
+    output_path = saved_objects_path if output_path is None else output_path
+    between_control_path = os.path.join(saved_objects_path, 'between_control_statistics.csv')
+    between_tgfb_path = os.path.join(saved_objects_path, 'between_tgfb_statistics.csv')
+    between_label = '% < {}'.format(pval)
+
+    within_neonatal_path = os.path.join(saved_objects_path, 'within_neonatal.csv')
+    within_adult_path = os.path.join(saved_objects_path, 'within_adult.csv')
+    within_senescent_path = os.path.join(saved_objects_path, 'within_senescent.csv')
+
+    def out(name):
+        return os.path.join(output_path, '{}.{}'.format(name, fmt))
+
+    return [
+        (between_control_path, 'ad_perc', out('between_control_adult'), between_label),
+        (between_control_path, 'sen_perc', out('between_control_sen'), between_label),
+        (between_tgfb_path, 'ad_perc', out('between_tgf_adult'), between_label),
+        (between_tgfb_path, 'sen_perc', out('between_tgf_sen'), between_label),
+
+        (within_neonatal_path, 'tgfb_perc', out('within_neonatal_control'), 'Percentage'),
+        (within_neonatal_path, 'ctrl_perc', out('within_neonatal_tgfb'), 'Percentage'),
+        (within_adult_path, 'tgfb_perc', out('within_adult_control'), 'Percentage'),
+        (within_adult_path, 'ctrl_perc', out('within_adult_tgfb'), 'Percentage'),
+        (within_senescent_path, 'tgfb_perc', out('within_senescent_control'), 'Percentage'),
+        (within_senescent_path, 'ctrl_perc', out('within_senescent_tgfb'), 'Percentage'),
+    ]
+
+
+def figure_jobs(saved_objects_path, pval, output_path=None, dpi=DPI, fmt='png', order_path=None):
+    """
+    Figure jobs (see render.py), one per bar chart. With `order_path`
+    (gene_order.build_order) genes follow the cached cluster order.
+    """
+    return [('plot_statistics_as_bar_charts', 'plot_from_csv',
+             dict(csv_fname=csv_fname, y=y, fname=fname, ylabel=ylabel, dpi=dpi, order_path=order_path))
+            for csv_fname, y, fname, ylabel in chart_specs(saved_objects_path, pval, output_path, fmt)]
+
+
+def sweep_jobs(saved_objects_path, pvals, output_path=None, dpi=DPI, fmt='png', order_path=None):
+    """
+    Figure jobs for the ten bar charts of every pval_less_than_* folder in `pvals`,
+    drawn into SavedObjects/figures/<folder> unless an output directory is given.
+    All thresholds share a gene set, so each worker lays the chart out once.
+    """
+    output_path = os.path.join(saved_objects_path, run_dirs.FIGURES_DIR) if output_path is None else output_path
+    jobs = []
+    for pval in pvals:
+        name = limma_stats.pval_dir_name(pval)
+        jobs += figure_jobs(os.path.join(saved_objects_path, name), pval, os.path.join(output_path, name),
+                            dpi=dpi, fmt=fmt, order_path=order_path)
+    return jobs
+
+
+def job_files(function, kwargs):
+    """
+    (input files, output files) of a figure job, for incremental.py
+    """
+    inputs = [kwargs['csv_fname']]
+    intervals = os.path.join(os.path.dirname(kwargs['csv_fname']), INTERVALS_FNAME)
+    if os.path.isfile(intervals):
+        inputs.append(intervals)
+    return inputs, [kwargs['fname']]
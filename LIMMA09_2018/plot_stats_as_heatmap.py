@@ -1,233 +1,233 @@
-import pandas, os, glob, seaborn
+import pandas, numpy, os, glob, seaborn
 import matplotlib.pyplot as plt
+from matplotlib import transforms
+from matplotlib.lines import Line2D
+import instrument, limma_stats, run_dirs
 
 """
 We are primarily interest in three questions:
    1) Does gene g respond to TGFb? - Compare TGFb vs Control groups
-   2) Is the gene g response different in adult/senescent compared to neonatal cell lines? - Compare Control groups for cell lines 
+   2) Is the gene g response different in adult/senescent compared to neonatal cell lines? - Compare Control groups for cell lines
    3) Is the gene g response to TGFb different in adult/senescent compared to neonatal cell lines? - Compare treated groups for cell lines
 
-Analysis has been conducted in R, with LIMMA. This script is only for plotting. 
+Analysis has been conducted in R, with LIMMA. This script is only for plotting.
+Run it with `python pipeline.py within|between|sweep`.
 
 """
-PLOT_WITHIN = False
-PLOT_BETWEEN = False
-PLOT_PVAL_GRAPH = True
-
 seaborn.set_context('talk', font_scale=2)
 seaborn.set_style('white')
 
-directory = r'/home/b3053674/Documents/LargeStudy/LIMMA09-2018'
-saved_objects_path = os.path.join(directory, 'SavedObjects')
-
-pval_settings_file = os.path.join(directory, 'pval')
-with open(pval_settings_file) as f:
-    PVAL = f.read().strip()
-
-print('pval is "{}"'.format(PVAL))
-pval_path = os.path.join(saved_objects_path, 'pval_less_than_{}'.format(str(PVAL).replace('.', '_')))
-if not os.path.isdir(pval_path):
-    print('makeing file', pval_path)
-    os.mkdir(pval_path)  # if os.path.isdir(pval_path) is False else None
-
-between_control_path = os.path.join(pval_path, 'between_control_statistics.csv')
-between_tgfb_path = os.path.join(pval_path, 'between_tgfb_statistics.csv')
-within_neonatal_path = os.path.join(pval_path, 'within_neonatal.csv')
-within_adult_path = os.path.join(pval_path, 'within_adult.csv')
-within_senescent_path = os.path.join(pval_path, 'within_senescent.csv')
-
-between_control_data = pandas.read_csv(between_control_path, index_col=0)
-between_tgfb_data = pandas.read_csv(between_tgfb_path, index_col=0)
-within_neonatal_data = pandas.read_csv(within_neonatal_path, index_col=0)
-within_adult_data = pandas.read_csv(within_adult_path, index_col=0)
-within_senescent_data = pandas.read_csv(within_senescent_path, index_col=0)
-
-between_control_data.index.name = 'Gene'
-between_tgfb_data.index.name = 'Gene'
-within_neonatal_data.index.name = 'Gene'
-within_adult_data.index.name = 'Gene'
-within_senescent_data.index.name = 'Gene'
-
-# print(between_tgfb_data)
-between_control_data = between_control_data[['sen_perc', 'ad_perc']]
-between_tgfb_data = between_tgfb_data[['sen_perc', 'ad_perc']]
-
-within_neonatal_data.columns = pandas.MultiIndex.from_product([['within_neonatal'], list(within_neonatal_data.columns)])
-within_adult_data.columns = pandas.MultiIndex.from_product([['within_adult'], list(within_adult_data.columns)])
-within_senescent_data.columns = pandas.MultiIndex.from_product(
-    [['within_senescent'], list(within_senescent_data.columns)])
-between_control_data.columns = pandas.MultiIndex.from_product([['between_control'], list(between_control_data.columns)])
-between_tgfb_data.columns = pandas.MultiIndex.from_product([['between_tgfb'], list(between_tgfb_data.columns)])
-
-df = pandas.concat(
-    [within_neonatal_data, within_senescent_data, within_adult_data, between_control_data, between_tgfb_data], axis=1
-)
-df = df.stack().stack()
-df = pandas.DataFrame(df)
-df.index.names = ['gene', 'group1', 'group2']
-
-df.columns = ['percentage']
-
-df = df.reset_index()
 tgf = r'TGF$\beta$'
 
 label_down = -0.095
 
-if PLOT_WITHIN:
-    within = df.query("group2 in ['within_adult', 'within_senescent', 'within_neonatal']")
-    # within = df[df['group2'].any() in ]
-
-    new_col = ["{}_{}".format(
-        within['group2'].iloc[i], within['group1'].iloc[i]) for i in range(within.shape[0])
-    ]
-    within['group'] = new_col
-    within = within.pivot(index='gene', columns='group', values='percentage')
-    group_labels = ['adult_control', 'adult_tgf',
-                    'neonatal_control', 'neonatal_tgf',
-                    'senescent_control', 'senescent_tgf']
-    within.columns = group_labels
-    new_order = [group_labels[2], group_labels[0], group_labels[4],
-                 group_labels[3], group_labels[1], group_labels[5]]
-    within = within[new_order]
-    fig, ax = plt.subplots(figsize=(10, 20), dpi=350)
-
-    # print(within['neonatal_tgf'])
-    print('within, pval ({}) count below 60%'.format(PVAL))
-    count = pandas.DataFrame(within[within > 60].count())
+## heatmap layout. Height follows the number of genes between MIN_HEIGHT and MAX_HEIGHT inches
+CMAP = 'YlGnBu'
+DPI = 350
+WIDTH = 10
+ROW_INCHES = 0.3
+MIN_HEIGHT = 6
+MAX_HEIGHT = 30
+TICK_FONTSIZE = 16
+GROUP_PAD = 10
+## above this many cells 'auto' draws one image instead of a patch per cell
+RASTER_CELLS = 2000
+## gridlines between cells are only drawn up to this many cells
+GRID_CELLS = 2000
+
+## x tick labels and (caption, first column, last column) groups of each heatmap
+HEATMAP_LABELS = {
+    'within': (['Neo', 'Adult', 'Sen'] * 2, [('Control', 0, 2), (tgf, 3, 5)]),
+    'between': (['Adult', 'Sen'] * 2, [('Control', 0, 1), (tgf, 2, 3)]),
+}
+
+
+def read_statistics(pval_path, PVAL=None):
+    """
+    Read the between/within tables for one threshold into a ResultsCube
+    (gene x group x treatment x threshold). The threshold is taken from the
+    folder name unless given.
+    """
+    import results_store
+    from results_cube import ResultsCube
+    threshold = results_store.parse_threshold(pval_path) if PVAL is None else float(PVAL)
+    with instrument.stage('load_statistics', fname=pval_path):
+        return ResultsCube.from_statistics(run_dirs.resolve(pval_path), threshold)
+
+
+def count_greater_than(data, consensus=60):
+    """
+    Number of genes above `consensus` percent in each `<comparison>_<treatment>` column
+    """
+    count = pandas.DataFrame(data[data > consensus].count())
     count.columns = ['Count']
     cell, treat = zip(*[i.split('_') for i in list(count.index)])
     count['comparison'] = cell
     count['treatment'] = treat
     count = count.set_index(['comparison', 'treatment'])
-    count = count.unstack(level=1)
+    return count.unstack(level=1)
+
+
+def within_table(cube):
+    """
+    gene x neonatal/adult/senescent_control, neonatal/adult/senescent_tgf percentages
+    """
+    return cube.table('within').dropna(how='all')
+
+
+def between_table(cube):
+    """
+    gene x adult/senescent_control, adult/senescent_tgfb percentages
+    """
+    return cube.table('between').dropna(how='all')
+
+
+def order_rows(table, order_path=None):
+    """
+    Rows in the cached cluster order of gene_order.build_order, or left alphabetical
+    """
+    if order_path is None:
+        return table
+    import gene_order
+    return table.loc[gene_order.apply_order(table.index, order_path)]
+
+
+def heatmap_pages(table, rows_per_page=None):
+    """
+    Split a tall table into pages of at most `rows_per_page` genes
+    """
+    if not rows_per_page or table.shape[0] <= rows_per_page:
+        return [table]
+    return [table.iloc[i:i + rows_per_page] for i in range(0, table.shape[0], rows_per_page)]
+
+
+def heatmap_fnames(fname, n_pages):
+    if n_pages == 1:
+        return [fname + '.png']
+    return ['{}_page{}.png'.format(fname, page + 1) for page in range(n_pages)]
+
+
+def annotate_groups(ax, groups, xticklabels):
+    """
+    Bar and caption under each run of columns, e.g. [('Control', 0, 2), (tgf, 3, 5)].
+    The offset below the axis comes from the length of the rotated tick labels.
+    """
+    fontsize = ax.xaxis.get_ticklabels()[0].get_fontsize()
+    offset = GROUP_PAD + max(len(label) for label in xticklabels) * fontsize * 0.7
+    trans = transforms.blended_transform_factory(ax.transData, ax.transAxes)
+    shift = transforms.ScaledTranslation(0, -offset / 72.0, ax.figure.dpi_scale_trans)
+    for label, first, last in groups:
+        ax.add_line(Line2D([first + 0.1, last + 0.9], [0, 0], transform=trans + shift,
+                           color='black', linewidth=5, clip_on=False))
+        ax.annotate(label, xy=((first + last + 1) / 2.0, 0), xycoords=trans,
+                    xytext=(0, -offset - GROUP_PAD), textcoords='offset points',
+                    ha='center', va='top', annotation_clip=False)
+
+
+def draw_heatmap(table, PVAL, xticklabels, groups, mode='auto'):
+    """
+    Heatmap of a gene x comparison table with the figure height taken from the
+    number of genes. mode='patches' is the seaborn heatmap with one bordered patch
+    per cell; mode='raster' draws a single image, with gridlines only while the
+    table is small. 'auto' switches to raster above RASTER_CELLS cells.
+    """
+    n_rows, n_cols = table.shape
+    height = min(MAX_HEIGHT, max(MIN_HEIGHT, n_rows * ROW_INCHES))
+    fig, ax = plt.subplots(figsize=(WIDTH, height), dpi=DPI)
+    cbar_kws = {'label': '% p-value < {}'.format(PVAL)}
+
+    if mode == 'patches' or (mode == 'auto' and n_rows * n_cols <= RASTER_CELLS):
+        seaborn.heatmap(table, linewidths=1, cmap=CMAP, ax=ax, linecolor='black', cbar_kws=cbar_kws)
+    else:
+        image = ax.imshow(numpy.ma.masked_invalid(table.values), cmap=CMAP, aspect='auto',
+                          interpolation='nearest', extent=(0, n_cols, n_rows, 0))
+        fig.colorbar(image, ax=ax, **cbar_kws)
+        if n_rows * n_cols <= GRID_CELLS:
+            ax.hlines(numpy.arange(n_rows + 1), 0, n_cols, colors='black', linewidth=1)
+            ax.vlines(numpy.arange(n_cols + 1), 0, n_rows, colors='black', linewidth=1)
+        for spine in ax.spines.values():
+            spine.set_visible(False)
+
+    ## label every gene while they fit in the axes (~3/4 of the figure height), otherwise every step'th gene
+    step = max(1, int(numpy.ceil(n_rows * TICK_FONTSIZE / 72.0 / (0.75 * height))))
+    ax.set_yticks(numpy.arange(0, n_rows, step) + 0.5)
+    ax.set_yticklabels(table.index[::step], rotation=0, fontsize=TICK_FONTSIZE)
+    ax.set_xticks(numpy.arange(n_cols) + 0.5)
+    ax.set_xticklabels(xticklabels, rotation=90)
+    ax.set_ylabel('')
+    ax.set_xlabel('')
+    annotate_groups(ax, groups, xticklabels)
+    return fig, ax
+
+
+def save_heatmaps(table, fname, PVAL, xticklabels, groups, mode='auto', rows_per_page=None):
+    pages = heatmap_pages(table, rows_per_page)
+    fnames = heatmap_fnames(fname, len(pages))
+    for page, page_fname in zip(pages, fnames):
+        with instrument.stage('draw_heatmap', rows=page.shape[0]):
+            fig, ax = draw_heatmap(page, PVAL, xticklabels, groups, mode=mode)
+        with instrument.stage('savefig', fname=page_fname), run_dirs.atomic_file(page_fname) as tmp:
+            fig.savefig(tmp, dpi=DPI, bbox_inches='tight')
+        plt.close(fig)
+    return fnames
+
+
+def heatmap_fname(pval_path, kind, PVAL):
+    """
+    Heatmap file name (without extension) for one kind and threshold, as published:
+    within_heatmap_0_001 and between_heatmap0_001
+    """
+    separator = '_' if kind == 'within' else ''
+    return os.path.join(pval_path, '{}_heatmap{}{}'.format(kind, separator, limma_stats.pval_suffix(PVAL)))
+
+
+def plot_within(cube, PVAL, pval_path, mode='auto', rows_per_page=None, order_path=None):
+    with instrument.stage('reshape'):
+        within = order_rows(within_table(cube), order_path)
+
+    # print(within['neonatal_tgf'])
+    print('within, pval ({}) count below 60%'.format(PVAL))
     count_fname = os.path.join(pval_path, 'within_count_greater_than_60_percent.csv')
-    count.to_csv(count_fname)
+    with instrument.stage('count_table', fname=count_fname), run_dirs.atomic_file(count_fname) as tmp:
+        count = count_greater_than(within)
+        count.to_csv(tmp)
     print(count)
 
-    ax = seaborn.heatmap(within, linewidths=1, cmap='YlGnBu',
-                         ax=ax, linecolor='black',
-                         cbar_kws={'label': '% p-value < {}'.format(PVAL)})
-
-    ax.set_xticklabels(['Neo', 'Adult', 'Sen'] * 2, rotation=90)
-    plt.yticks(rotation=0, fontsize=16)
-    plt.ylabel('')
-    plt.xlabel('')
-
-    trans = ax.get_xaxis_transform()
-    down_loc = -380
+    fname = heatmap_fname(pval_path, 'within', PVAL)
+    xticklabels, groups = HEATMAP_LABELS['within']
+    return [count_fname] + save_heatmaps(within, fname, PVAL, xticklabels, groups,
+                                         mode=mode, rows_per_page=rows_per_page)
 
-    ax.annotate('Control', xy=(1.0, label_down), xycoords=trans)
-    ax.annotate('', xycoords='axes pixels', xytext=(100, down_loc), xy=(1000, down_loc),
-                arrowprops=dict(arrowstyle='-',
-                                color='black',
-                                linewidth=5)
-                )
 
-    ax.annotate(tgf, xy=(4.0, label_down), xycoords=trans)
-    ax.annotate('', xycoords='axes pixels', xytext=(1200, down_loc), xy=(2100, down_loc),
-                arrowprops=dict(arrowstyle='-',
-                                color='black',
-                                linewidth=5)
-                )
+def plot_between(cube, PVAL, pval_path, mode='auto', rows_per_page=None, order_path=None):
+    with instrument.stage('reshape'):
+        between = order_rows(between_table(cube), order_path)
 
-    fname = os.path.join(pval_path, 'within_heatmap_{}'.format(str(PVAL).replace('.', '_')))
-    fig.savefig(fname, dpi=350, bbox_inches='tight')
+    print('between, pval ({}) count below 60%'.format(PVAL))
+    count_fname = os.path.join(pval_path, 'between_count_greater_than_60_percent.csv')
+    with instrument.stage('count_table', fname=count_fname), run_dirs.atomic_file(count_fname) as tmp:
+        count = count_greater_than(between)
+        count.to_csv(tmp)
+    print(count)
 
-if PLOT_BETWEEN:
-    between = df.query("group2 in ['between_control', 'between_tgfb']")
+    fname = heatmap_fname(pval_path, 'between', PVAL)
+    xticklabels, groups = HEATMAP_LABELS['between']
+    return [count_fname] + save_heatmaps(between, fname, PVAL, xticklabels, groups,
+                                         mode=mode, rows_per_page=rows_per_page)
 
-    new_col = [
-        "{}_{}".format(
-            between['group1'].iloc[i], between['group2'].iloc[i]
-        ) for i in range(between.shape[0])
-    ]
 
-    between['group'] = new_col
+def plot_pval_graph(saved_objects_path, output_path=None):
+    import results_store
+    from results_cube import ResultsCube
+    output_path = saved_objects_path if output_path is None else output_path
 
-    between = between.pivot_table(index='gene', columns='group', values='percentage')
-    new_labels = ['adult_control', 'adult_tgfb', 'senescent_control', 'senescent_tgfb']
-    between.columns = new_labels
-    new_order = [new_labels[0], new_labels[2], new_labels[1], new_labels[3]]
-    between = between[new_order]
+    ## one read of the results store (imported from the pval_less_than_* folders on first use)
+    with instrument.stage('open_store', fname=saved_objects_path):
+        cube = ResultsCube.from_store(results_store.open_store(saved_objects_path))
+    with instrument.stage('reshape'):
+        between = cube.count_frame('between')
+        within = cube.count_frame('within')
 
-    print('between, pval ({}) count below 60%'.format(PVAL))
-    count = pandas.DataFrame(between[between > 60].count())
-    count.columns = ['Count']
-    cell, treat = zip(*[i.split('_') for i in list(count.index)])
-    count['comparison'] = cell
-    count['treatment'] = treat
-    count = count.set_index(['comparison', 'treatment'])
-    count = count.unstack(level=1)
-    print(count)
-    count_fname = os.path.join(pval_path, 'between_count_greater_than_60_percent.csv')
-    count.to_csv(count_fname)
-
-    fig, ax = plt.subplots(figsize=(10, 20), dpi=350)
-    # [YlOrRd,YlOrBr, YlGnBu]
-    ax = seaborn.heatmap(between, linewidths=1, cmap='YlGnBu',
-                         ax=ax, linecolor='black',
-                         cbar_kws={'label': '% p-value < {}'.format(PVAL)})
-
-    ax.set_xticklabels(['Adult', 'Sen'] * 2, rotation=90)
-    plt.yticks(rotation=0, fontsize=16)
-    plt.ylabel('')
-    plt.xlabel('')
-    trans = ax.get_xaxis_transform()
-
-    down_loc = -370
-    ax.annotate('Control', xy=(0.5, label_down), xycoords=trans)
-    ax.annotate('', xycoords='axes pixels', xytext=(100, down_loc), xy=(1000, down_loc),
-                arrowprops=dict(arrowstyle='-',
-                                color='black',
-                                linewidth=5)
-                )
-
-    ax.annotate(tgf, xy=(2.75, label_down), xycoords=trans)
-    ax.annotate('', xycoords='axes pixels', xytext=(1200, down_loc), xy=(2100, down_loc),
-                arrowprops=dict(arrowstyle='-',
-                                color='black',
-                                linewidth=5)
-                )
-
-    fname = os.path.join(pval_path, 'between_heatmap{}'.format(str(PVAL).replace('.', '_')))
-    fig.savefig(fname, dpi=350, bbox_inches='tight')
-
-if PLOT_PVAL_GRAPH:
-    import glob
-
-    dirs = glob.glob(os.path.join(saved_objects_path, 'pval_less_than_*'))
-    all_pvals = ['{}.{}'.format(i.split('_')[-2:][0], i.split('_')[-2:][1]) for i in dirs]
-    all_pvals = [float(i) for i in all_pvals]
-    dirs = zip(dirs, all_pvals)
-    between_df_dct = {}
-    within_df_dct = {}
-    for (d, p) in dirs:
-        assert os.path.isdir(d)
-        print(d)
-        between_file = glob.glob(os.path.join(d, 'between_count*'))
-        within_file = glob.glob(os.path.join(d, 'within_count*'))
-        assert len(between_file) == 1, between_file
-        assert len(within_file) == 1
-        between_count = pandas.read_csv(between_file[0], index_col=[0], skiprows=[0]).dropna()
-        within_count = pandas.read_csv(within_file[0], index_col=[0], skiprows=[0]).dropna()
-        between_df_dct[p] = between_count
-        within_df_dct[p] = within_count
-        # print(within_count)
-    between = pandas.concat(between_df_dct)
-    within = pandas.concat(within_df_dct)
-    within.index.names = ['p_val', 'comparison']
-    between.index.names = ['p_val', 'comparison']
-    between = between.unstack(level=1).sort_index(ascending=False)
-    within = within.unstack(level=1).sort_index(ascending=False)
-
-    within = within.stack().stack().reset_index()
-    new_col = []
-    for i in range(within.shape[0]):
-        new_col.append("{}_{}".format(
-            within['comparison'].iloc[i],
-            within['level_2'].iloc[i])
-        )
-    within['label'] = new_col
     # print(within)
     fig, ax = plt.subplots()
     seaborn.barplot(data=within, x='p_val', y=0, hue='label', ax=ax,
@@ -249,17 +249,11 @@ if PLOT_PVAL_GRAPH:
     plt.xticks(rotation=90)
     plt.ylabel('Count >60%')
     plt.xlabel('FDR corrected p-value cut-off')
-    fname = os.path.join(saved_objects_path, 'within_pvalue_counts.png')
-    fig.savefig(fname, bbox_inches='tight', dpi=100)
-
-    between = between.stack().stack().reset_index()
-    new_col = []
-    for i in range(between.shape[0]):
-        new_col.append("{}_{}".format(
-            between['comparison'].iloc[i],
-            between['level_2'].iloc[i])
-        )
-    between['label'] = new_col
+    within_fname = os.path.join(output_path, 'within_pvalue_counts.png')
+    with instrument.stage('savefig', fname=within_fname), run_dirs.atomic_file(within_fname) as tmp:
+        fig.savefig(tmp, bbox_inches='tight', dpi=100)
+    plt.close(fig)
+
     print('between')
     print(between)
     fig, ax = plt.subplots()
@@ -282,113 +276,100 @@ if PLOT_PVAL_GRAPH:
     plt.xticks(rotation=90)
     plt.ylabel('Count >60%')
     plt.xlabel('FDR corrected p-value cut-off')
-    fname = os.path.join(saved_objects_path, 'between_pvalue_counts.png')
-    fig.savefig(fname, bbox_inches='tight', dpi=100)
+    fname = os.path.join(output_path, 'between_pvalue_counts.png')
+    with instrument.stage('savefig', fname=fname), run_dirs.atomic_file(fname) as tmp:
+        fig.savefig(tmp, bbox_inches='tight', dpi=100)
+    plt.close(fig)
     # print(between)
-
-# if MODE == 1:
-#
-#     if PLOT_WITHIN:
-#         within = df.query("group2 in ['within_adult', 'within_senescent', 'within_neonatal']")
-#         # within = df[df['group2'].any() in ]
-#
-#         new_col = ["{}_{}".format(
-#             within['group2'].iloc[i], within['group1'].iloc[i]) for i in range(within.shape[0])
-#         ]
-#         within['group'] = new_col
-#         within = within.pivot(index='gene', columns='group', values='percentage')
-#         group_labels = ['adult, control', 'adult, {}'.format(tgf),
-#                         'neonatal, control', 'neonatal, {}'.format(tgf),
-#                         'senescent, control', 'senescent, {}'.format(tgf)
-#                         ]
-#         within.columns = group_labels
-#         new_order = [group_labels[2], group_labels[3],
-#                      group_labels[0], group_labels[1],
-#                      group_labels[4], group_labels[5]]
-#         within = within[new_order]
-#
-#         fig, ax = plt.subplots(figsize=(10, 20), dpi=350)
-#         ax = seaborn.heatmap(within, linewidths=1, cmap='YlGnBu',
-#                              ax=ax, linecolor='black',
-#                              cbar_kws={'label': '% p-value < 0.001'})
-#
-#         ax.set_xticklabels(['Control', tgf] * 3, rotation=90)
-#         plt.yticks(rotation=0, fontsize=16)
-#         plt.ylabel('')
-#         plt.xlabel('')
-#
-#         trans = ax.get_xaxis_transform()
-#         ax.annotate('Neonatal', xy=(0.25, label_down), xycoords=trans)
-#         down_loc = -480
-#         gap = 40
-#         length = 160
-#         start_loc = 20
-#         ax.annotate('', xycoords='axes pixels', xytext=(50, down_loc), xy=(700, down_loc),
-#                     arrowprops=dict(arrowstyle='-',
-#                                     color='black',
-#                                     linewidth=5)
-#                     )
-#
-#         ax.annotate('Adult', xy=(2.5, label_down), xycoords=trans)
-#         ax.annotate('', xycoords='axes pixels', xytext=(800, down_loc), xy=(1400, down_loc),
-#                     arrowprops=dict(arrowstyle='-',
-#                                     color='black',
-#                                     linewidth=5)
-#                     )
-#
-#         ax.annotate('Senescent', xy=(4.1, label_down), xycoords=trans)
-#         ax.annotate('', xycoords='axes pixels', xytext=(1500, down_loc), xy=(2100, down_loc),
-#                     arrowprops=dict(arrowstyle='-',
-#                                     color='black',
-#                                     linewidth=5)
-#                     )
-#         fname = os.path.join(saved_objects_path, 'within_heatmap0_001')
-#         fig.savefig(fname, dpi=350, bbox_inches='tight')
-#
-#     if PLOT_BETWEEN:
-#         between = df.query("group2 in ['between_control', 'between_tgfb']")
-#
-#         new_col = [
-#             "{}_{}".format(
-#                 between['group1'].iloc[i], between['group2'].iloc[i]
-#             ) for i in range(between.shape[0])
-#         ]
-#
-#         between['group'] = new_col
-#
-#         between = between.pivot_table(index='gene', columns='group', values='percentage')
-#         between.columns = ['adult_control', 'adult_tgfb', 'senescent_control', 'senescent_tgfb']
-#
-#         fig, ax = plt.subplots(figsize=(10, 20), dpi=350)
-#         # [YlOrRd,YlOrBr, YlGnBu]
-#         ax = seaborn.heatmap(between, linewidths=1, cmap='YlGnBu',
-#                              ax=ax, linecolor='black',
-#                              cbar_kws={'label': '% p-value < 0.001'})
-#
-#         ax.set_xticklabels(['Control', tgf] * 3, rotation=90)
-#         plt.yticks(rotation=0, fontsize=16)
-#         plt.ylabel('')
-#         plt.xlabel('')
-#         trans = ax.get_xaxis_transform()
-#
-#         down_loc = -480
-#         gap = 40
-#         length = 160
-#         start_loc = 20
-#
-#         ax.annotate('Adult', xy=(0.5, label_down), xycoords=trans)
-#         ax.annotate('', xycoords='axes pixels', xytext=(100, down_loc), xy=(1000, down_loc),
-#                     arrowprops=dict(arrowstyle='-',
-#                                     color='black',
-#                                     linewidth=5)
-#                     )
-#
-#         ax.annotate('Senescent', xy=(2.3, label_down), xycoords=trans)
-#         ax.annotate('', xycoords='axes pixels', xytext=(1200, down_loc), xy=(2100, down_loc),
-#                     arrowprops=dict(arrowstyle='-',
-#                                     color='black',
-#                                     linewidth=5)
-#                     )
-#
-#         fname = os.path.join(saved_objects_path, 'between_heatmap')
-#         fig.savefig(fname, dpi=350, bbox_inches='tight')
+    return [within_fname, fname]
+
+
+def output_dir(saved_objects_path, PVAL, output_path=None):
+    """
+    Where the figures and count tables for one threshold go: SavedObjects/figures/
+    <pval folder> unless an output directory is given. Never the pval folder itself,
+    which is an immutable run or the published results.
+    """
+    name = limma_stats.pval_dir_name(PVAL)
+    if output_path is None:
+        return os.path.join(saved_objects_path, run_dirs.FIGURES_DIR, name)
+    return os.path.join(output_path, name)
+
+
+def plot_within_for_threshold(saved_objects_path, PVAL, output_path=None, mode='auto', rows_per_page=None,
+                              order_path=None):
+    cube = read_statistics(os.path.join(saved_objects_path, limma_stats.pval_dir_name(PVAL)), PVAL)
+    out = output_dir(saved_objects_path, PVAL, output_path)
+    if not os.path.isdir(out):
+        os.makedirs(out)
+    return plot_within(cube, PVAL, out,
+                       mode=mode, rows_per_page=rows_per_page, order_path=order_path)
+
+
+def plot_between_for_threshold(saved_objects_path, PVAL, output_path=None, mode='auto', rows_per_page=None,
+                               order_path=None):
+    cube = read_statistics(os.path.join(saved_objects_path, limma_stats.pval_dir_name(PVAL)), PVAL)
+    out = output_dir(saved_objects_path, PVAL, output_path)
+    if not os.path.isdir(out):
+        os.makedirs(out)
+    return plot_between(cube, PVAL, out,
+                        mode=mode, rows_per_page=rows_per_page, order_path=order_path)
+
+
+def figure_jobs(saved_objects_path, pvals, within=True, between=True, pval_graph=False, output_path=None,
+                mode='auto', rows_per_page=None, order_path=None):
+    """
+    Figure jobs (see render.py) for the heatmaps at each threshold and,
+    optionally, the p-value sweep plots. With `order_path` (gene_order.build_order)
+    heatmap rows follow the cached cluster order.
+    """
+    jobs = []
+    kwargs = dict(saved_objects_path=saved_objects_path, output_path=output_path)
+    heatmap_kwargs = dict(kwargs, mode=mode, rows_per_page=rows_per_page, order_path=order_path)
+    for PVAL in pvals:
+        if within:
+            jobs.append(('plot_stats_as_heatmap', 'plot_within_for_threshold', dict(heatmap_kwargs, PVAL=PVAL)))
+        if between:
+            jobs.append(('plot_stats_as_heatmap', 'plot_between_for_threshold', dict(heatmap_kwargs, PVAL=PVAL)))
+    if pval_graph:
+        jobs.append(('plot_stats_as_heatmap', 'plot_pval_graph', kwargs))
+    return jobs
+
+
+def job_files(function, kwargs):
+    """
+    (input files, output files) of a figure job, for incremental.py
+    """
+    saved_objects_path = kwargs['saved_objects_path']
+    output_path = kwargs.get('output_path')
+    if function == 'plot_pval_graph':
+        output_path = saved_objects_path if output_path is None else output_path
+        inputs = [f for f in glob.glob(os.path.join(saved_objects_path, '*pval_less_than_*', '*.csv'))
+                  if '_count_greater_than_' not in f]
+        inputs += glob.glob(os.path.join(saved_objects_path, 'results_store', '*'))
+        outputs = [os.path.join(output_path, 'within_pvalue_counts.png'),
+                   os.path.join(output_path, 'between_pvalue_counts.png')]
+        return inputs, outputs
+
+    PVAL = kwargs['PVAL']
+    pval_path = os.path.join(saved_objects_path, limma_stats.pval_dir_name(PVAL))
+    out = output_dir(saved_objects_path, PVAL, output_path)
+    inputs = [os.path.join(pval_path, f) for f in [
+        'between_control_statistics.csv', 'between_tgfb_statistics.csv',
+        'within_neonatal.csv', 'within_adult.csv', 'within_senescent.csv'
+    ]]
+    if function == 'plot_within_for_threshold':
+        table = within_table
+        outputs = [os.path.join(out, 'within_count_greater_than_60_percent.csv')]
+        fname = heatmap_fname(out, 'within', PVAL)
+    else:
+        table = between_table
+        outputs = [os.path.join(out, 'between_count_greater_than_60_percent.csv')]
+        fname = heatmap_fname(out, 'between', PVAL)
+
+    ## paged heatmaps write one file per page, so the page count needs the gene count
+    n_pages = 1
+    rows_per_page = kwargs.get('rows_per_page')
+    if rows_per_page and all(os.path.isfile(f) for f in inputs):
+        n_pages = len(heatmap_pages(table(read_statistics(pval_path, PVAL)), rows_per_page))
+    return inputs, outputs + heatmap_fnames(fname, n_pages)
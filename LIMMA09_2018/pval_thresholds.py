@@ -0,0 +1,127 @@
+import os
+import numpy, pandas
+import limma_stats, run_dirs
+
+"""
+The limma fit only needs to be done once. The gene x comparison matrix of
+adjusted p-values is saved to `adj_pvals.npz` and every significance threshold
+(the pval_less_than_* folders) is derived from it in one vectorised pass:
+the indicator matrices, the between/within percentages and the
+*_count_greater_than_60_percent.csv tables.
+
+Each folder is an immutable run directory keyed by the threshold, consensus,
+resamples and a digest of the adj.P.Val matrix (see run_dirs.py), so jobs for
+different thresholds can write into the same SavedObjects at once.
+
+"""
+
+ADJ_PVALS_FNAME = 'adj_pvals.npz'
+
+THRESHOLDS = [0.01, 0.001, 0.0001, 1e-5, 1e-6, 1e-7, 1e-8, 1e-9, 1e-10]
+
+LEVELS = ['kind', 'treatment', 'group', 'pair']
+
+## labels used in the count tables written by plot_stats_as_heatmap.py
+COUNT_LABELS = {
+    'between': {'treatment': {'Control': 'control', 'TGFb': 'tgfb'},
+                'group': {'adult': 'adult', 'sen': 'senescent'}},
+    'within': {'treatment': {'Control': 'control', 'TGFb': 'tgf'},
+               'group': {'adult': 'adult', 'neonatal': 'neonatal', 'senescent': 'senescent'}},
+}
+
+
+def save_adj_pvals(adj_pvals, fname):
+    columns = adj_pvals.columns
+    with run_dirs.atomic_file(fname) as tmp:
+        numpy.savez_compressed(
+            tmp,
+            adj_pvals=adj_pvals.values,
+            genes=numpy.asarray(adj_pvals.index, dtype=str),
+            **{level: numpy.asarray(columns.get_level_values(level), dtype=str) for level in LEVELS}
+        )
+
+
+def load_adj_pvals(fname):
+    with numpy.load(fname) as data:
+        columns = pandas.MultiIndex.from_arrays([data[level] for level in LEVELS], names=LEVELS)
+        return pandas.DataFrame(data['adj_pvals'], index=pandas.Index(data['genes'], name='gene'),
+                                columns=columns)
+
+
+def threshold_hits(adj_pvals, thresholds):
+    """
+    Indicator array of shape (threshold, gene, comparison). NaN p-values are
+    never significant, as in check_pval.
+    """
+    thresholds = numpy.asarray(thresholds, dtype=float)
+    with numpy.errstate(invalid='ignore'):
+        return adj_pvals.values[None, :, :] < thresholds[:, None, None]
+
+
+def consensus_percentages(adj_pvals, thresholds, hits=None):
+    """
+    Percentage of comparisons in each (kind, treatment, group) that are
+    significant, for every gene and threshold.
+
+    Returns an array of shape (threshold, gene, group) and the list of
+    (kind, treatment, group) keys for the last axis.
+    """
+    if hits is None:
+        hits = threshold_hits(adj_pvals, thresholds)
+    groups = adj_pvals.columns.droplevel('pair')
+    keys = list(dict.fromkeys(groups))
+    codes = numpy.array([keys.index(g) for g in groups])
+    membership = numpy.zeros((len(groups), len(keys)))
+    membership[numpy.arange(len(groups)), codes] = 1
+    percentages = hits.astype(float) @ membership / membership.sum(axis=0) * 100
+    return percentages, keys
+
+
+def count_table(counts, keys, kind):
+    """
+    Lay a {key: count} mapping out like the tables written by
+    plot_stats_as_heatmap.py (comparison x treatment)
+    """
+    labels = COUNT_LABELS[kind]
+    records = [(labels['group'][group], labels['treatment'][treatment], count)
+               for (k, treatment, group), count in zip(keys, counts) if k == kind]
+    count = pandas.DataFrame(records, columns=['comparison', 'treatment', 'Count'])
+    count = count.set_index(['comparison', 'treatment']).sort_index()
+    return count.unstack(level=1)
+
+
+def write_thresholds(adj_pvals, thresholds, saved_objects_path, consensus=60, n_resamples=0):
+    """
+    Write the pval_less_than_* folder for every threshold in `thresholds`. With
+    n_resamples > 0 bootstrap intervals and permutation p-values for the
+    percentages are written to consensus_intervals.csv as well.
+    """
+    run_dirs.check_links(saved_objects_path, [limma_stats.pval_dir_name(p) for p in thresholds])
+    hits = threshold_hits(adj_pvals, thresholds)
+    percentages, keys = consensus_percentages(adj_pvals, thresholds, hits=hits)
+    counts = (percentages > consensus).sum(axis=1)
+    digest = run_dirs.frame_digest(adj_pvals)
+
+    dirs = []
+    for i, pval in enumerate(thresholds):
+        name = limma_stats.pval_dir_name(pval)
+        params = {'threshold': float(pval), 'consensus': consensus, 'n_resamples': n_resamples,
+                  'adj_pvals': digest}
+        done = run_dirs.completed(saved_objects_path, name, params)
+        if done is not None:
+            run_dirs.point_link(os.path.join(saved_objects_path, name), done)
+        else:
+            with run_dirs.atomic_run(saved_objects_path, name, params) as pval_dir:
+                limma_stats.write_statistics(
+                    pandas.DataFrame(hits[i].astype(int), index=adj_pvals.index, columns=adj_pvals.columns),
+                    pval_dir
+                )
+                for kind in ['between', 'within']:
+                    fname = os.path.join(pval_dir, '{}_count_greater_than_{}_percent.csv'.format(kind, consensus))
+                    count_table(counts[i], keys, kind).to_csv(fname)
+                if n_resamples:
+                    import resampling
+                    intervals = resampling.consensus_intervals(adj_pvals, pval, n_resamples=n_resamples, seed=0)
+                    intervals.to_csv(os.path.join(pval_dir, 'consensus_intervals.csv'))
+        dirs.append(os.path.join(saved_objects_path, name))
+    return dirs
@@ -0,0 +1,291 @@
+import os
+import numpy, pandas
+import ingest, instrument, run_dirs
+
+"""
+Quality control of the raw Ct export, ahead of the delta Ct normalisation and fits.
+
+The export is read into the samples x assays Ct matrix (see ingest.py) and every
+check is a whole-matrix operation:
+
+  * well flags, as bits of an int8 matrix: MISSING (no row in the export),
+    UNDETERMINED (non-numeric Ct), LATE (Ct > MAX_CT), OUTLIER (delta Ct more than
+    OUTLIER_CT cycles from the mean of its other replicates; with two replicates
+    both wells of a disagreeing pair are flagged) and REFERENCE (the sample's
+    reference well is unusable);
+  * replicate coefficients of variation of 2^-delta Ct for every gene in every
+    treatment/time/cell line group, from sparse group sums;
+  * reference gene stability: a robust z score of each sample's PPIA Ct against
+    its chip's median and MAD;
+  * per-sample and per-chip summaries. Chips come from a `Chip` column when the
+    export has one; otherwise all samples count as a single chip.
+
+A sample is flagged when its reference is unstable or more than MAX_FAILED_FRACTION
+of its wells failed or MAX_OUTLIER_FRACTION are replicate outliers.
+
+    python pipeline.py qc --directory DIR [--figures]
+    python pipeline.py stats --directory DIR --qc --drop-flagged
+
+The tables (and optional figures) are written to SavedObjects/qc, a run directory
+keyed on the raw file and the QC limits (see run_dirs.py).
+
+"""
+
+QC_NAME = 'qc'
+CHIP_COLUMN = 'Chip'
+REFERENCE = 'PPIA'
+
+MAX_CT = 35.0
+OUTLIER_CT = 1.0
+REFERENCE_Z = 3.5
+MAX_FAILED_FRACTION = 0.2
+MAX_OUTLIER_FRACTION = 0.2
+
+MISSING, UNDETERMINED, LATE, OUTLIER, REFERENCE_FAILED = 1, 2, 4, 8, 16
+FLAGS = {'missing': MISSING, 'undetermined': UNDETERMINED, 'late': LATE,
+         'outlier': OUTLIER, 'reference': REFERENCE_FAILED}
+
+
+def read_raw(raw_data_file, chunk_size=ingest.CHUNK_SIZE):
+    """
+    (Ct matrix, present mask, assays, samples, chip per sample). Ct is NaN where
+    the well is missing or undetermined; `present` tells the two apart.
+    """
+    assay_codes, sample_codes, ct, assays, samples = ingest.read_ct_codes(raw_data_file, chunk_size)
+    matrix = ingest.ct_matrix(assay_codes, sample_codes, ct, len(assays), len(samples))
+    present = numpy.zeros(matrix.shape, dtype=bool)
+    present.ravel()[sample_codes.astype(numpy.int64) * len(assays) + assay_codes] = True
+    return matrix, present, assays, samples, read_chips(raw_data_file, samples, chunk_size)
+
+
+def read_chips(raw_data_file, samples, chunk_size=ingest.CHUNK_SIZE):
+    header = pandas.read_csv(raw_data_file, nrows=0).columns
+    if CHIP_COLUMN not in header:
+        return numpy.array(['all'] * len(samples), dtype=object)
+    chips = {}
+    for chunk in pandas.read_csv(raw_data_file, usecols=['Sample', CHIP_COLUMN], chunksize=chunk_size):
+        chips.update(chunk.drop_duplicates('Sample').set_index('Sample')[CHIP_COLUMN].astype(str).to_dict())
+    return numpy.array([chips[s] for s in samples], dtype=object)
+
+
+def _group_membership(codes, n_groups):
+    from scipy import sparse
+    return sparse.csr_matrix((numpy.ones(len(codes)), (codes, numpy.arange(len(codes)))),
+                             shape=(n_groups, len(codes)))
+
+
+def robust_z(values, groups):
+    """
+    (x - median) / (1.4826 MAD) within each group, NaN ignored
+    """
+    z = numpy.full(len(values), numpy.nan)
+    for g in numpy.unique(groups):
+        mask = groups == g
+        median = numpy.nanmedian(values[mask])
+        mad = 1.4826 * numpy.nanmedian(numpy.abs(values[mask] - median))
+        z[mask] = (values[mask] - median) / mad if mad > 0 else 0.0
+    return z
+
+
+class QCReport(object):
+    """
+    Results of `quality_control`: `flags` (samples x assays int8 bit flags),
+    `cv` (replicate group x gene CVs) and the `samples`, `chips` and `genes` tables
+    """
+
+    def __init__(self, flags, cv, samples, chips, genes, assays, limits):
+        self.flags = flags
+        self.cv = cv
+        self.samples = samples
+        self.chips = chips
+        self.genes = genes
+        self.assays = assays
+        self.limits = limits
+
+    def flagged_samples(self):
+        return list(self.samples.index[self.samples['flagged']])
+
+    def well_table(self):
+        """
+        Long (sample, assay, flags) table of every flagged well
+        """
+        rows, cols = numpy.nonzero(self.flags)
+        values = self.flags[rows, cols]
+        table = pandas.DataFrame({'sample': self.samples.index[rows],
+                                  'assay': numpy.asarray(self.assays)[cols]})
+        for name, bit in FLAGS.items():
+            table[name] = (values & bit) != 0
+        return table
+
+
+def quality_control(matrix, present, assays, samples, chips, reference=REFERENCE, max_ct=MAX_CT,
+                    outlier_ct=OUTLIER_CT, reference_z=REFERENCE_Z,
+                    max_failed_fraction=MAX_FAILED_FRACTION, max_outlier_fraction=MAX_OUTLIER_FRACTION):
+    """
+    Run every check on the Ct matrix from `read_raw`. Returns a QCReport.
+    """
+    if reference not in assays:
+        raise KeyError('reference gene {} is not in the raw data'.format(reference))
+    limits = dict(max_ct=max_ct, outlier_ct=outlier_ct, reference_z=reference_z,
+                  max_failed_fraction=max_failed_fraction, max_outlier_fraction=max_outlier_fraction)
+    n_samples, n_assays = matrix.shape
+    ref_column = assays.index(reference)
+
+    undetermined = present & numpy.isnan(matrix)
+    with numpy.errstate(invalid='ignore'):
+        late = matrix > max_ct
+    usable = present & ~undetermined & ~late
+    flags = numpy.zeros(matrix.shape, dtype=numpy.int8)
+    flags[~present] |= MISSING
+    flags[undetermined] |= UNDETERMINED
+    flags[late] |= LATE
+
+    ## reference stability against the chip's median
+    ref_ct = numpy.where(usable[:, ref_column], matrix[:, ref_column], numpy.nan).astype(float)
+    ref_z = robust_z(ref_ct, chips)
+    ref_failed = numpy.isnan(ref_ct) | (numpy.abs(ref_z) > reference_z)
+    flags[ref_failed] |= REFERENCE_FAILED
+
+    ## replicate groups: samples that differ only by replicate number
+    keys = pandas.Series(samples).str.rsplit('_', n=1).str[0].values
+    group_codes, group_names = pandas.factorize(keys)
+    membership = _group_membership(group_codes, len(group_names))
+    valid = usable & ~ref_failed[:, None]
+    dct = numpy.where(valid, matrix - ref_ct[:, None], 0.0)
+    n = membership @ valid.astype(float)
+    sum_dct = membership @ dct
+
+    ## delta Ct against the mean of the sample's other replicates
+    others = n[group_codes] - valid
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        loo_mean = (sum_dct[group_codes] - dct) / others
+        outlier = valid & (others > 0) & (numpy.abs(dct - loo_mean) > outlier_ct)
+    flags[outlier] |= OUTLIER
+
+    ## replicate CV on the linear scale the statistics use
+    quantity = numpy.where(valid, numpy.exp2(-dct), 0.0)
+    s1 = membership @ quantity
+    s2 = membership @ quantity ** 2
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean = s1 / n
+        sd = numpy.sqrt(numpy.maximum(s2 - n * mean ** 2, 0) / (n - 1))
+        cv = numpy.where(n >= 2, sd / mean, numpy.nan)
+    cv = pandas.DataFrame(cv, index=pandas.Index(group_names, name='group'),
+                          columns=pandas.Index(assays, name='Assay'))
+
+    failed_fraction = (~usable).mean(axis=1)
+    outlier_fraction = outlier.sum(axis=1) / numpy.maximum(valid.sum(axis=1), 1)
+    sample_table = pandas.DataFrame({
+        'chip': chips,
+        'group': keys,
+        'reference_ct': ref_ct,
+        'reference_z': ref_z,
+        'missing': (~present).sum(axis=1),
+        'undetermined': undetermined.sum(axis=1),
+        'late': late.sum(axis=1),
+        'outliers': outlier.sum(axis=1),
+        'failed_fraction': failed_fraction,
+        'outlier_fraction': outlier_fraction,
+        'median_ct': numpy.nanmedian(numpy.where(usable, matrix, numpy.nan), axis=1),
+    }, index=pandas.Index(samples, name='Sample'))
+    reasons = numpy.array([ref_failed, failed_fraction > max_failed_fraction,
+                           outlier_fraction > max_outlier_fraction])
+    sample_table['flagged'] = reasons.any(axis=0)
+    sample_table['reasons'] = [';'.join(r for r, hit in zip(['reference', 'failed_wells', 'outliers'], row) if hit)
+                               for row in reasons.T]
+
+    chip_table = sample_table.groupby('chip').agg(
+        samples=('group', 'size'),
+        flagged=('flagged', 'sum'),
+        missing=('missing', 'sum'),
+        undetermined=('undetermined', 'sum'),
+        late=('late', 'sum'),
+        outliers=('outliers', 'sum'),
+        median_ct=('median_ct', 'median'),
+        reference_mean=('reference_ct', 'mean'),
+        reference_sd=('reference_ct', 'std'),
+    )
+    chip_table['reference_cv'] = chip_table['reference_sd'] / chip_table['reference_mean']
+    chip_table['failed_fraction'] = (chip_table[['missing', 'undetermined', 'late']].sum(axis=1)
+                                     / (chip_table['samples'] * n_assays))
+
+    gene_table = pandas.DataFrame({
+        'missing': (~present).sum(axis=0),
+        'undetermined': undetermined.sum(axis=0),
+        'late': late.sum(axis=0),
+        'outliers': outlier.sum(axis=0),
+        'median_cv': numpy.nanmedian(cv.values, axis=0) if len(cv) else numpy.nan,
+    }, index=pandas.Index(assays, name='Assay'))
+    return QCReport(flags, cv, sample_table, chip_table, gene_table, assays, limits)
+
+
+def plot_report(report, path):
+    """
+    Reference Ct per sample, replicate CVs per gene and a map of the well flags
+    """
+    import render
+    render.use_headless_backend()
+    import matplotlib.pyplot as plt
+    fnames = []
+
+    samples = report.samples
+    fig, ax = plt.subplots(figsize=(12, 5))
+    x = numpy.arange(len(samples))
+    for chip, rows in samples.groupby('chip', sort=False):
+        ax.scatter(x[samples.index.get_indexer(rows.index)], rows['reference_ct'], s=8, label=chip)
+    bad = samples['flagged'].values
+    ax.scatter(x[bad], samples['reference_ct'].values[bad], s=40, facecolors='none', edgecolors='red',
+               label='flagged')
+    ax.set_xlabel('sample')
+    ax.set_ylabel('reference Ct')
+    ax.legend(fontsize=8, ncol=4)
+    fnames.append(os.path.join(path, 'qc_reference.png'))
+    fig.savefig(fnames[-1], dpi=150, bbox_inches='tight')
+    plt.close(fig)
+
+    fig, ax = plt.subplots(figsize=(max(6, 0.15 * report.cv.shape[1]), 5))
+    cv = report.cv.values
+    ax.boxplot([c[~numpy.isnan(c)] for c in cv.T], showfliers=False)
+    ax.set_xticks(numpy.arange(1, cv.shape[1] + 1))
+    ax.set_xticklabels(report.cv.columns, rotation=90, fontsize=6)
+    ax.set_ylabel('replicate CV')
+    fnames.append(os.path.join(path, 'qc_replicate_cv.png'))
+    fig.savefig(fnames[-1], dpi=150, bbox_inches='tight')
+    plt.close(fig)
+
+    fig, ax = plt.subplots(figsize=(10, 8))
+    image = ax.imshow(report.flags, aspect='auto', interpolation='nearest', cmap='magma_r',
+                      vmin=0, vmax=sum(FLAGS.values()))
+    fig.colorbar(image, ax=ax, label='flag bits ({})'.format(
+        ', '.join('{}={}'.format(k, v) for k, v in FLAGS.items())))
+    ax.set_xlabel('assay')
+    ax.set_ylabel('sample')
+    fnames.append(os.path.join(path, 'qc_well_flags.png'))
+    fig.savefig(fnames[-1], dpi=150, bbox_inches='tight')
+    plt.close(fig)
+    return fnames
+
+
+def write_report(report, path, figures=False):
+    report.samples.to_csv(os.path.join(path, 'qc_samples.csv'))
+    report.chips.to_csv(os.path.join(path, 'qc_chips.csv'))
+    report.genes.to_csv(os.path.join(path, 'qc_genes.csv'))
+    report.well_table().to_csv(os.path.join(path, 'qc_wells.csv'), index=False)
+    if figures:
+        plot_report(report, path)
+
+
+def run(saved_objects_path, raw_data_file, reference=REFERENCE, figures=False, **limits):
+    """
+    QC the raw export and publish the tables to saved_objects_path/qc.
+    Returns the QCReport.
+    """
+    with instrument.stage('read_raw', fname=raw_data_file):
+        matrix, present, assays, samples, chips = read_raw(raw_data_file)
+    with instrument.stage('quality_control'):
+        report = quality_control(matrix, present, assays, samples, chips, reference=reference, **limits)
+    params = dict(run_dirs.file_params(raw_data_file), reference=reference, figures=figures, **report.limits)
+    with instrument.stage('write_qc'):
+        with run_dirs.atomic_run(saved_objects_path, QC_NAME, params) as tmp:
+            write_report(report, tmp, figures=figures)
+    return report
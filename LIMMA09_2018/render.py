@@ -0,0 +1,85 @@
+import os, time, importlib
+from concurrent.futures import ProcessPoolExecutor
+import instrument
+
+"""
+Headless, parallel figure rendering.
+
+A figure job is a (module, function, kwargs) tuple naming a plotting function that
+draws, saves and closes its figure(s) and returns the files it wrote, for example
+plot_stats_as_heatmap.figure_jobs or plot_statistics_as_bar_charts.figure_jobs.
+Jobs are plain data so they pickle cheaply; every worker imports the plotting module
+itself after selecting the non-interactive Agg backend.
+
+"""
+
+BACKEND = 'Agg'
+
+
+def use_headless_backend():
+    os.environ['MPLBACKEND'] = BACKEND
+    import matplotlib
+    matplotlib.use(BACKEND)
+
+
+def run_job(job):
+    """
+    Run one figure job and time it. Errors are reported rather than raised so one
+    bad figure doesn't take down the rest of the batch.
+    """
+    module, function, kwargs = job
+    use_headless_backend()
+    start, cpu_start = time.time(), time.process_time()
+    outputs, error = [], None
+    try:
+        with instrument.stage(function, module=module):
+            outputs = getattr(importlib.import_module(module), function)(**kwargs) or []
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+    return {
+        'job': '{}.{}'.format(module, function),
+        'kwargs': kwargs,
+        'outputs': list(outputs),
+        'seconds': time.time() - start,
+        'cpu_seconds': time.process_time() - cpu_start,
+        'pid': os.getpid(),
+        'error': error,
+    }
+
+
+def _run_pooled_job(job):
+    report = run_job(job)
+    report['trace'] = instrument.drain()
+    return report
+
+
+def render(jobs, workers=None):
+    """
+    Render `jobs` on a process pool (workers=1 renders in this process).
+    Returns one report dict per job, in job order.
+    """
+    use_headless_backend()
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(jobs) <= 1:
+        return [run_job(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), initializer=use_headless_backend) as pool:
+        reports = list(pool.map(_run_pooled_job, jobs))
+    for report in reports:
+        instrument.add_events(report.pop('trace'))
+    return reports
+
+
+def timing_report(reports):
+    """
+    One line per output file with its render time, plus a total
+    """
+    lines = []
+    for report in reports:
+        names = [os.path.basename(f) for f in report['outputs']] or [report['job']]
+        status = 'FAILED {}'.format(report['error']) if report['error'] else ''
+        lines.append('{:>8.2f}s  {:>8.2f}s cpu  {}  {}'.format(
+            report['seconds'], report['cpu_seconds'], ', '.join(names), status))
+    lines.append('{:>8.2f}s  total render time over {} jobs'.format(
+        sum(r['seconds'] for r in reports), len(reports)))
+    return '\n'.join(lines)
+
@@ -0,0 +1,136 @@
+import numpy, pandas
+import limma_stats
+
+"""
+Uncertainty for the consensus percentages (sen_perc, ad_perc, tgfb_perc, ctrl_perc).
+
+A percentage is the fraction of comparisons in a group (e.g. the nine neonatal x adult
+pairs) in which a gene is significant. Both resampling schemes here work directly on
+the gene x comparison indicator matrix, so each resample is a weighted row sum and all
+resamples are one matrix product rather than a refit:
+
+    bootstrap   - resample cell lines (or whole comparisons) with replacement. A
+                  resampled cell line carries every comparison it takes part in, so
+                  the weight of pair (i, j) is count_i * count_j.
+    permutation - shuffle genes independently within each comparison. This keeps the
+                  hit rate of every comparison but breaks any gene-level consensus, and
+                  because genes are exchangeable under this null one null distribution
+                  serves the whole panel.
+
+Genes with the same hit pattern share their interval, so only the distinct
+patterns (at most 2^n for a group of n comparisons) are resampled, BLOCK_SIZE at a
+time, and cost and memory barely grow with the panel size. `stats` and `batch` write
+DEFAULT_RESAMPLES resamples to consensus_intervals.csv in every pval_less_than_*
+folder (--resamples 0 turns this off), and the bar charts draw the intervals as
+error bars.
+
+"""
+
+DEFAULT_RESAMPLES = 10000
+BLOCK_SIZE = 512
+
+
+def cell_line_weights(pairs, n_resamples, rng):
+    """
+    Bootstrap weights of shape (n_resamples, n_pairs) from resampling cell lines.
+    Between groups (every pair is first-set x second-set) resample each set
+    separately, within groups resample the one set of cell lines.
+    """
+    firsts = sorted(set(p[0] for p in pairs))
+    seconds = sorted(set(p[1] for p in pairs))
+    if set(firsts) & set(seconds):
+        sides = [sorted(set(firsts) | set(seconds))]
+    else:
+        sides = [firsts, seconds]
+
+    counts = {}
+    for side in sides:
+        draws = rng.multinomial(len(side), [1.0 / len(side)] * len(side), size=n_resamples)
+        for k, line in enumerate(side):
+            counts[line] = draws[:, k]
+    return numpy.column_stack([counts[i] * counts[j] for i, j in pairs]).astype(float)
+
+
+def comparison_weights(n_comparisons, n_resamples, rng):
+    return rng.multinomial(n_comparisons, [1.0 / n_comparisons] * n_comparisons,
+                           size=n_resamples).astype(float)
+
+
+def bootstrap_percentages(hits, pairs, n_resamples=10000, unit='cell_line', rng=None):
+    """
+    hits: gene x comparison 0/1 array for one group.
+    Returns an array (gene, n_resamples) of resampled percentages; resamples
+    with no usable comparisons are NaN.
+    """
+    rng = numpy.random.default_rng(rng)
+    return weighted_percentages(hits, resample_weights(pairs, n_resamples, unit, rng))
+
+
+def resample_weights(pairs, n_resamples, unit, rng):
+    if unit == 'cell_line':
+        return cell_line_weights(pairs, n_resamples, rng)
+    if unit == 'comparison':
+        return comparison_weights(len(pairs), n_resamples, rng)
+    raise ValueError('unit must be "cell_line" or "comparison", not "{}"'.format(unit))
+
+
+def weighted_percentages(hits, weights):
+    """
+    (gene, resample) percentages of a gene x comparison 0/1 array under
+    (resample, comparison) weights; NaN where a resample has no weight
+    """
+    total = weights.sum(axis=1)
+    total[total == 0] = numpy.nan
+    return numpy.asarray(hits, dtype=numpy.float32) @ weights.T.astype(numpy.float32) / total * 100
+
+
+def permutation_null(hits, n_resamples=10000, rng=None):
+    """
+    Null distribution (n_resamples,) of a gene's percentage when genes are
+    shuffled independently within each comparison.
+    """
+    rng = numpy.random.default_rng(rng)
+    hits = numpy.asarray(hits)
+    n_genes, n_comparisons = hits.shape
+    rows = rng.integers(0, n_genes, size=(n_resamples, n_comparisons))
+    return hits[rows, numpy.arange(n_comparisons)].mean(axis=1) * 100
+
+
+def consensus_intervals(adj_pvals, pval, n_resamples=DEFAULT_RESAMPLES, unit='cell_line', alpha=0.05, seed=None):
+    """
+    For every (kind, treatment, group): each gene's percentage, its bootstrap
+    (1 - alpha) percentile interval and a one sided permutation p-value.
+    Returns a long data frame indexed by (kind, treatment, group, gene).
+    """
+    rng = numpy.random.default_rng(seed)
+    hits = limma_stats.indicators(adj_pvals, pval)
+    groups = list(dict.fromkeys(adj_pvals.columns.droplevel('pair')))
+    frames = {}
+    for kind, treatment, group in groups:
+        group_hits = limma_stats.select(hits, kind, treatment, group)
+        pairs = [tuple(p.split('_')) for p in group_hits.columns.get_level_values('pair')]
+        values = group_hits.values
+        observed = values.mean(axis=1) * 100
+
+        ## genes with the same hit pattern (at most 2^n for n comparisons) share an
+        ## interval, so only distinct patterns are resampled, a block at a time
+        weights = resample_weights(pairs, n_resamples, unit, rng)
+        patterns, inverse = numpy.unique(values, axis=0, return_inverse=True)
+        low, high = numpy.empty(len(patterns)), numpy.empty(len(patterns))
+        for start in range(0, len(patterns), BLOCK_SIZE):
+            boot = weighted_percentages(patterns[start:start + BLOCK_SIZE], weights)
+            percentile = numpy.percentile if numpy.isfinite(boot).all() else numpy.nanpercentile
+            low[start:start + BLOCK_SIZE], high[start:start + BLOCK_SIZE] = percentile(
+                boot, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=1)
+        low, high = low[inverse.ravel()], high[inverse.ravel()]
+
+        null = numpy.sort(permutation_null(values, n_resamples, rng=rng))
+        exceed = n_resamples - numpy.searchsorted(null, observed - 1e-9, side='left')
+        frames[(kind, treatment, group)] = pandas.DataFrame({
+            'percentage': observed,
+            'ci_low': low,
+            'ci_high': high,
+            'perm_pvalue': (exceed + 1.0) / (n_resamples + 1),
+        }, index=adj_pvals.index)
+    df = pandas.concat(frames, names=['kind', 'treatment', 'group'])
+    return df
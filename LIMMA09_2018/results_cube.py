@@ -0,0 +1,177 @@
+import os
+import numpy, pandas
+
+"""
+Dense results cube for the consensus percentages.
+
+Percentages are held in one float array of shape (gene, group, treatment, threshold)
+with categorical axis labels, so the tables the heatmaps and sweep plots need are
+array indexing rather than per row string formatting followed by stack/pivot.
+
+    groups      within_neonatal, within_adult, within_senescent,
+                between_adult, between_senescent
+    treatments  control, tgfb
+
+"""
+
+GROUPS = ['within_neonatal', 'within_adult', 'within_senescent', 'between_adult', 'between_senescent']
+TREATMENTS = ['control', 'tgfb']
+
+## how (kind, treatment, group) keys from limma_stats/pval_thresholds map onto the cube
+KEY_GROUPS = {
+    ('within', 'neonatal'): 'within_neonatal',
+    ('within', 'adult'): 'within_adult',
+    ('within', 'senescent'): 'within_senescent',
+    ('between', 'adult'): 'between_adult',
+    ('between', 'sen'): 'between_senescent',
+}
+KEY_TREATMENTS = {'Control': 'control', 'TGFb': 'tgfb'}
+
+## column labels used by the figures and count tables
+TREATMENT_LABELS = {
+    'within': {'control': 'control', 'tgfb': 'tgf'},
+    'between': {'control': 'control', 'tgfb': 'tgfb'},
+}
+
+## (kind, csv, column) -> (group, treatment) for the per-threshold statistics files
+CSV_COLUMNS = [
+    ('within_neonatal.csv', 'ctrl_perc', 'within_neonatal', 'control'),
+    ('within_neonatal.csv', 'tgfb_perc', 'within_neonatal', 'tgfb'),
+    ('within_adult.csv', 'ctrl_perc', 'within_adult', 'control'),
+    ('within_adult.csv', 'tgfb_perc', 'within_adult', 'tgfb'),
+    ('within_senescent.csv', 'ctrl_perc', 'within_senescent', 'control'),
+    ('within_senescent.csv', 'tgfb_perc', 'within_senescent', 'tgfb'),
+    ('between_control_statistics.csv', 'ad_perc', 'between_adult', 'control'),
+    ('between_control_statistics.csv', 'sen_perc', 'between_senescent', 'control'),
+    ('between_tgfb_statistics.csv', 'ad_perc', 'between_adult', 'tgfb'),
+    ('between_tgfb_statistics.csv', 'sen_perc', 'between_senescent', 'tgfb'),
+]
+
+
+class ResultsCube(object):
+
+    def __init__(self, values, genes, thresholds, groups=GROUPS, treatments=TREATMENTS):
+        self.values = numpy.asarray(values, dtype=float)
+        self.genes = pandas.Index(genes, name='gene')
+        self.groups = pandas.Index(groups, name='group')
+        self.treatments = pandas.Index(treatments, name='treatment')
+        self.thresholds = numpy.asarray(thresholds, dtype=float)
+        expected = (len(self.genes), len(self.groups), len(self.treatments), len(self.thresholds))
+        if self.values.shape != expected:
+            raise ValueError('values have shape {}, axes need {}'.format(self.values.shape, expected))
+
+    @classmethod
+    def from_percentages(cls, percentages, genes, keys, thresholds):
+        """
+        From a (threshold, gene, key) array with (kind, treatment, group) keys, as
+        returned by pval_thresholds.consensus_percentages or stored in results_store
+        """
+        percentages = numpy.asarray(percentages)
+        values = numpy.full((len(genes), len(GROUPS), len(TREATMENTS), len(thresholds)), numpy.nan)
+        for k, (kind, treatment, group) in enumerate(keys):
+            g = GROUPS.index(KEY_GROUPS[(kind, group)])
+            t = TREATMENTS.index(KEY_TREATMENTS[treatment])
+            values[:, g, t, :] = percentages[:, :, k].T
+        return cls(values, genes, thresholds)
+
+    @classmethod
+    def from_store(cls, store):
+        return cls.from_percentages(store.array('percentages'), store.genes,
+                                    list(store.groups), store.thresholds)
+
+    @classmethod
+    def from_statistics(cls, pval_path, threshold):
+        """
+        From the five statistics CSVs of one pval_less_than_* folder
+        """
+        tables = {}
+        for fname, column, group, treatment in CSV_COLUMNS:
+            if fname not in tables:
+                tables[fname] = pandas.read_csv(os.path.join(pval_path, fname), index_col=0)
+        genes = sorted(set().union(*[t.index for t in tables.values()]))
+        values = numpy.full((len(genes), len(GROUPS), len(TREATMENTS), 1), numpy.nan)
+        for fname, column, group, treatment in CSV_COLUMNS:
+            column_values = tables[fname][column].reindex(genes).values
+            values[:, GROUPS.index(group), TREATMENTS.index(treatment), 0] = column_values
+        return cls(values, genes, [float(threshold)])
+
+    def _codes(self, axis, labels):
+        index = {'group': self.groups, 'treatment': self.treatments}[axis]
+        if labels is None:
+            return numpy.arange(len(index))
+        codes = index.get_indexer(numpy.atleast_1d(labels))
+        if (codes < 0).any():
+            raise KeyError('{} not in {} axis {}'.format(labels, axis, list(index)))
+        return codes
+
+    def _threshold_codes(self, thresholds):
+        if thresholds is None:
+            return numpy.arange(len(self.thresholds))
+        codes = []
+        for threshold in numpy.atleast_1d(thresholds):
+            match = numpy.flatnonzero(numpy.isclose(self.thresholds, float(threshold), rtol=1e-9, atol=0))
+            if not match.size:
+                raise KeyError('threshold {} not in {}'.format(threshold, list(self.thresholds)))
+            codes.append(match[0])
+        return numpy.array(codes)
+
+    def select(self, groups=None, treatments=None, thresholds=None, genes=None):
+        """
+        Sub-cube along any axes, in the order requested
+        """
+        g = self._codes('group', groups)
+        t = self._codes('treatment', treatments)
+        p = self._threshold_codes(thresholds)
+        rows = numpy.arange(len(self.genes)) if genes is None else self.genes.get_indexer(genes)
+        values = self.values[numpy.ix_(rows, g, t, p)]
+        return ResultsCube(values, self.genes[rows], self.thresholds[p],
+                           groups=self.groups[g], treatments=self.treatments[t])
+
+    def labels(self, kind, groups, treatments):
+        """
+        `<group>_<treatment>` labels (e.g. neonatal_tgf) for treatment-major columns
+        """
+        names = TREATMENT_LABELS[kind]
+        return ['{}_{}'.format(group.split('_', 1)[1], names[treatment])
+                for treatment in treatments for group in groups]
+
+    def table(self, kind, threshold=None, groups=None):
+        """
+        gene x `<group>_<treatment>` frame at one threshold, control columns first.
+        This is the table behind the within/between heatmaps.
+        """
+        groups = [g for g in self.groups if g.startswith(kind + '_')] if groups is None else groups
+        threshold = self.thresholds[0] if threshold is None else threshold
+        cube = self.select(groups=groups, thresholds=threshold)
+        ## (gene, group, treatment) -> (gene, treatment, group) so columns are treatment-major
+        values = cube.values[:, :, :, 0].transpose(0, 2, 1).reshape(len(cube.genes), -1)
+        return pandas.DataFrame(values, index=cube.genes,
+                                columns=self.labels(kind, list(cube.groups), list(cube.treatments)))
+
+    def counts(self, consensus=60):
+        """
+        (group, treatment, threshold) array of genes with a percentage above `consensus`
+        """
+        return (self.values > consensus).sum(axis=0)
+
+    def count_frame(self, kind, consensus=60):
+        """
+        Long frame of counts with p_val, comparison, level_2, count (column 0)
+        and label columns, the layout of the p-value sweep plots
+        """
+        g = numpy.array([i for i, group in enumerate(self.groups) if group.startswith(kind + '_')])
+        counts = self.counts(consensus)[g]
+        order = numpy.argsort(-self.thresholds, kind='stable')
+        n_groups, n_treatments, n_thresholds = counts.shape
+        p, grp, trt = numpy.meshgrid(order, numpy.arange(n_groups), numpy.arange(n_treatments), indexing='ij')
+        comparison = numpy.array([group.split('_', 1)[1] for group in self.groups[g]])[grp.ravel()]
+        names = TREATMENT_LABELS[kind]
+        treatment = numpy.array([names[t] for t in self.treatments])[trt.ravel()]
+        frame = pandas.DataFrame({
+            'p_val': self.thresholds[p.ravel()],
+            'comparison': comparison,
+            'level_2': treatment,
+            0: counts[grp.ravel(), trt.ravel(), p.ravel()].astype(float),
+        })
+        frame['label'] = frame['comparison'] + '_' + frame['level_2']
+        return frame
@@ -0,0 +1,208 @@
+import io, json, functools, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy, pandas
+import results_store, pval_thresholds
+from results_cube import ResultsCube, GROUPS, TREATMENTS
+
+"""
+Local HTTP service over the results store, so a different FDR cut-off or consensus
+level is a URL rather than an edit of the `pval` file and a rerun.
+
+    python pipeline.py serve --input-dir DIR/SavedObjects [--port 8050]
+
+    /thresholds                                             stored thresholds
+    /genes?threshold=1e-5&group=within_adult&treatment=tgfb&consensus=60
+                                                            genes with >= consensus % hits
+    /table?kind=within&threshold=0.001                      heatmap table as CSV
+    /counts?consensus=60                                    gene counts per threshold, JSON
+    /heatmap?kind=between&threshold=0.001[&mode=raster&dpi=100]
+    /bars?group=within_adult&treatment=tgfb&threshold=0.001[&dpi=100&format=svg]
+    /cache                                                  cache statistics
+
+Thresholds that are not in the store are computed on demand from the stored
+adj.P.Val matrix when the store has one (i.e. it was built by the stats step).
+Percentage slices and rendered figures are kept in LRU caches shared by all
+request threads, so repeated queries never reach pandas or matplotlib again.
+Rendering itself is serialised because pyplot is not thread safe.
+
+"""
+
+HOST = '127.0.0.1'
+PORT = 8050
+CACHE_SIZE = 256
+
+CONTENT_TYPES = {'png': 'image/png', 'svg': 'image/svg+xml', 'pdf': 'application/pdf'}
+
+
+class ResultsService(object):
+
+    def __init__(self, saved_objects_path, cache_size=CACHE_SIZE):
+        self.store = results_store.open_store(saved_objects_path)
+        self.cube = ResultsCube.from_store(self.store)
+        self._render_lock = threading.Lock()
+        ## per-instance caches, so a service's cache goes with it
+        self.slice = functools.lru_cache(maxsize=cache_size)(self._slice)
+        self.table_csv = functools.lru_cache(maxsize=cache_size)(self._table_csv)
+        self.heatmap = functools.lru_cache(maxsize=cache_size)(self._heatmap)
+        self.bars = functools.lru_cache(maxsize=cache_size)(self._bars)
+
+    def thresholds(self):
+        return {
+            'thresholds': [float(t) for t in self.cube.thresholds],
+            'on_demand': bool(self.store.manifest['arrays'].get('adj_pvals')),
+        }
+
+    def _slice(self, threshold):
+        """
+        ResultsCube at a single threshold, from the store or computed from adj.P.Val
+        """
+        try:
+            return self.cube.select(thresholds=threshold)
+        except KeyError:
+            if not self.store.manifest['arrays'].get('adj_pvals'):
+                raise KeyError('threshold {} is not stored and the store has no adj.P.Val matrix '
+                               'to compute it from. Stored: {}'.format(threshold, [float(t) for t in self.cube.thresholds]))
+        adj_pvals = pandas.DataFrame(numpy.asarray(self.store.array('adj_pvals')),
+                                     index=self.store.genes, columns=self.store.comparisons)
+        percentages, keys = pval_thresholds.consensus_percentages(adj_pvals, [threshold])
+        return ResultsCube.from_percentages(percentages, self.store.genes, keys, [threshold])
+
+    def genes(self, threshold, group, treatment, consensus=60):
+        cube = self.slice(threshold).select(groups=group, treatments=treatment)
+        values = cube.values[:, 0, 0, 0]
+        keep = values >= consensus
+        order = numpy.argsort(-values[keep], kind='stable')
+        return [{'gene': gene, 'percentage': float(p)}
+                for gene, p in zip(cube.genes[keep][order], values[keep][order])]
+
+    def _table_csv(self, kind, threshold):
+        return self.slice(threshold).table(kind).dropna(how='all').to_csv()
+
+    def counts(self, consensus=60):
+        counts = self.cube.counts(consensus)
+        return [{'threshold': float(t), 'group': g, 'treatment': tr, 'count': int(counts[i, j, k])}
+                for k, t in enumerate(self.cube.thresholds)
+                for i, g in enumerate(self.cube.groups)
+                for j, tr in enumerate(self.cube.treatments)]
+
+    def _heatmap(self, kind, threshold, mode='auto', dpi=100):
+        import render
+        render.use_headless_backend()
+        import plot_stats_as_heatmap
+        import matplotlib.pyplot as plt
+        table = self.slice(threshold).table(kind).dropna(how='all')
+        xticklabels, groups = plot_stats_as_heatmap.HEATMAP_LABELS[kind]
+        buffer = io.BytesIO()
+        with self._render_lock:
+            fig, ax = plot_stats_as_heatmap.draw_heatmap(table, threshold, xticklabels, groups, mode=mode)
+            fig.savefig(buffer, format='png', dpi=dpi, bbox_inches='tight')
+            plt.close(fig)
+        return buffer.getvalue()
+
+    def _bars(self, group, treatment, threshold, dpi=100, format='png'):
+        import render
+        render.use_headless_backend()
+        import plot_statistics_as_bar_charts
+        cube = self.slice(threshold).select(groups=group, treatments=treatment)
+        ylabel = '% < {}'.format(threshold) if group.startswith('between') else 'Percentage'
+        buffer = io.BytesIO()
+        with self._render_lock:
+            chart = plot_statistics_as_bar_charts.template(cube.genes)
+            chart.draw(cube.values[:, 0, 0, 0], ylabel)
+            chart.save(buffer, dpi=dpi, format=format)
+        return buffer.getvalue()
+
+    def cache_info(self):
+        return {name: getattr(self, name).cache_info()._asdict()
+                for name in ['slice', 'table_csv', 'heatmap', 'bars']}
+
+
+def _one(query, name, default=None, type=str, choices=None):
+    if name not in query:
+        if default is None:
+            raise ValueError('missing query parameter {}'.format(name))
+        return default
+    value = type(query[name][0])
+    if choices is not None and value not in choices:
+        raise ValueError('{} must be one of {}'.format(name, choices))
+    return value
+
+
+def make_handler(service):
+
+    def thresholds(query):
+        return 'json', service.thresholds()
+
+    def genes(query):
+        return 'json', service.genes(_one(query, 'threshold', type=float),
+                                     _one(query, 'group', choices=GROUPS),
+                                     _one(query, 'treatment', choices=TREATMENTS),
+                                     _one(query, 'consensus', 60, float))
+
+    def table(query):
+        return 'csv', service.table_csv(_one(query, 'kind', choices=['within', 'between']),
+                                        _one(query, 'threshold', type=float))
+
+    def counts(query):
+        return 'json', service.counts(_one(query, 'consensus', 60, float))
+
+    def heatmap(query):
+        return 'png', service.heatmap(_one(query, 'kind', choices=['within', 'between']),
+                                      _one(query, 'threshold', type=float),
+                                      _one(query, 'mode', 'auto', choices=['auto', 'raster', 'patches']),
+                                      _one(query, 'dpi', 100, int))
+
+    def bars(query):
+        format = _one(query, 'format', 'png', choices=list(CONTENT_TYPES))
+        return format, service.bars(_one(query, 'group', choices=GROUPS),
+                                    _one(query, 'treatment', choices=TREATMENTS),
+                                    _one(query, 'threshold', type=float),
+                                    _one(query, 'dpi', 100, int), format)
+
+    def cache(query):
+        return 'json', service.cache_info()
+
+    routes = {
+        '/thresholds': thresholds, '/genes': genes, '/table': table, '/counts': counts,
+        '/heatmap': heatmap, '/bars': bars, '/cache': cache,
+    }
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path not in routes:
+                return self._send(404, 'json', {'error': 'unknown path', 'paths': sorted(routes)})
+            try:
+                kind, body = routes[url.path](parse_qs(url.query))
+            except (KeyError, ValueError) as e:
+                return self._send(400, 'json', {'error': str(e.args[0]) if e.args else repr(e)})
+            self._send(200, kind, body)
+
+        def _send(self, status, kind, body):
+            if kind == 'json':
+                body, content_type = json.dumps(body).encode(), 'application/json'
+            elif kind == 'csv':
+                body, content_type = body.encode(), 'text/csv'
+            else:
+                content_type = CONTENT_TYPES[kind]
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+
+def serve(saved_objects_path, host=HOST, port=PORT, cache_size=CACHE_SIZE):
+    service = ResultsService(saved_objects_path, cache_size=cache_size)
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    print('serving {} on http://{}:{}/'.format(saved_objects_path, host, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
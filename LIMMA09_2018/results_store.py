@@ -0,0 +1,282 @@
+import os, re, glob, json
+import numpy, pandas
+import limma_stats, pval_thresholds, run_dirs
+
+"""
+One indexed results store for every gene x comparison x treatment x threshold result,
+replacing the per-threshold folders of small CSVs.
+
+A store is a directory of uncompressed .npy arrays plus a manifest.json describing
+their axes:
+
+    hits.npy         int8   (threshold, gene, comparison)  1/0, -1 where unknown
+    percentages.npy  float  (threshold, gene, group)       consensus percentages
+    adj_pvals.npy    float  (gene, comparison)             only when built from a fit
+
+Arrays are opened with mmap_mode='r', so selecting a slice for a figure only reads
+that slice from disk.
+
+results_store is a run directory (see run_dirs.py): a rebuild is published by
+swapping the symlink, and an open ResultsStore keeps reading the run it resolved,
+so the sweep plots never see a half written store.
+
+A store imported from the CSV tree records the size and mtime of every table it
+read (`import_inputs`), and `open_store` imports again when a pval_less_than_*
+folder is added, removed or rewritten. The older analysis_at_pval_less_than_*
+folders are only read when asked for with `legacy`.
+
+"""
+
+MANIFEST = 'manifest.json'
+STORE_NAME = 'results_store'
+VERSION = 1
+
+
+def write_store(path, thresholds, genes, comparisons, groups, hits, percentages,
+                adj_pvals=None, source=None, inputs=None):
+    """
+    Publish a store as the run directory `path` points to. `inputs` identifies the
+    files it was imported from, see `import_inputs`.
+    """
+    hits = numpy.asarray(hits, dtype=numpy.int8)
+    percentages = numpy.asarray(percentages, dtype=float)
+    adj_pvals = None if adj_pvals is None else numpy.asarray(adj_pvals, dtype=float)
+    saved_objects_path, name = os.path.split(os.path.normpath(path))
+    params = {'source': source, 'thresholds': [float(t) for t in thresholds],
+              'arrays': run_dirs.array_digest(hits, percentages, adj_pvals), 'inputs': inputs}
+    with run_dirs.atomic_run(saved_objects_path, name, params) as tmp:
+        _write_arrays(tmp, thresholds, genes, comparisons, groups, hits, percentages, adj_pvals, source, inputs)
+    return path
+
+
+def _write_arrays(path, thresholds, genes, comparisons, groups, hits, percentages, adj_pvals, source, inputs):
+    numpy.save(os.path.join(path, 'hits.npy'), hits)
+    numpy.save(os.path.join(path, 'percentages.npy'), percentages)
+    if adj_pvals is not None:
+        numpy.save(os.path.join(path, 'adj_pvals.npy'), adj_pvals)
+    manifest = {
+        'version': VERSION,
+        'source': source,
+        'inputs': inputs,
+        'thresholds': [float(t) for t in thresholds],
+        'genes': list(genes),
+        'comparisons': [list(c) for c in comparisons],
+        'groups': [list(g) for g in groups],
+        'arrays': {
+            'hits': ['threshold', 'gene', 'comparison'],
+            'percentages': ['threshold', 'gene', 'group'],
+            'adj_pvals': ['gene', 'comparison'] if adj_pvals is not None else None,
+        },
+    }
+    with open(os.path.join(path, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+
+def build_store(adj_pvals, path, thresholds=pval_thresholds.THRESHOLDS):
+    """
+    Build a store from an adj.P.Val matrix (see limma_stats.fit_comparisons)
+    """
+    hits = pval_thresholds.threshold_hits(adj_pvals, thresholds)
+    percentages, groups = pval_thresholds.consensus_percentages(adj_pvals, thresholds, hits=hits)
+    return write_store(path, thresholds, adj_pvals.index, list(adj_pvals.columns), groups,
+                       hits, percentages, adj_pvals=adj_pvals.values, source='adj_pvals')
+
+
+def parse_threshold(dirname):
+    """
+    Threshold from a folder name such as pval_less_than_0_0001 or the
+    misnamed analysis_at_pval_less_than_0 _001. Returns None if it doesn't match.
+    """
+    match = re.search(r'pval_less_than_(.+)$', os.path.basename(os.path.normpath(dirname)))
+    if match is None:
+        return None
+    value = match.group(1).replace(' ', '')
+    integer, _, fraction = value.partition('_')
+    try:
+        return float('{}.{}'.format(integer, fraction.replace('_', '')))
+    except ValueError:
+        return None
+
+
+def find_threshold_dirs(saved_objects_path, legacy=False):
+    """
+    {threshold: folder} of the pval_less_than_* folders. With `legacy` the older
+    analysis_at_pval_less_than_* folders are included too; where both exist for a
+    threshold the pval_less_than_* folder wins.
+    """
+    found = {}
+    pattern = '*pval_less_than_*' if legacy else 'pval_less_than_*'
+    candidates = sorted(glob.glob(os.path.join(saved_objects_path, pattern)),
+                        key=lambda d: os.path.basename(d).startswith('pval_less_than_'))
+    for d in candidates:
+        threshold = parse_threshold(d)
+        if threshold is not None and os.path.isdir(d):
+            found[threshold] = d
+    return found
+
+
+def _table_fnames(d):
+    """
+    {(kind, treatment or group): file} of the tables an import reads from one folder
+    """
+    fnames = {('between', treatment): os.path.join(d, 'between_{}_statistics.csv'.format(name))
+              for treatment, name in [('Control', 'control'), ('TGFb', 'tgfb')]}
+    fnames.update({('within', group): os.path.join(d, 'within_{}.csv'.format(group))
+                   for group in limma_stats.WITHIN_GROUPS})
+    return fnames
+
+
+def import_inputs(dirs):
+    """
+    run_dirs.file_params of every table an import of `dirs` ({threshold: folder})
+    reads, by folder name
+    """
+    return {os.path.basename(os.path.normpath(d)): [run_dirs.file_params(f) for _, f in
+                                                    sorted(_table_fnames(run_dirs.resolve(d)).items())]
+            for d in dirs.values()}
+
+
+def import_saved_objects(saved_objects_path, path=None, legacy=False):
+    """
+    Convert an existing SavedObjects tree of pval_less_than_* folders (and with
+    `legacy` the analysis_at_pval_less_than_* ones) into a store.
+
+    The between tables carry the per-comparison indicators; the within tables only
+    carry percentages, so their per-comparison hits are stored as unknown (-1).
+    """
+    path = os.path.join(saved_objects_path, STORE_NAME) if path is None else path
+    dirs = find_threshold_dirs(saved_objects_path, legacy)
+    if not dirs:
+        raise ValueError('no pval_less_than_* folders in {}'.format(saved_objects_path))
+    inputs = import_inputs(dirs)
+    thresholds = sorted(dirs, reverse=True)
+    grid = limma_stats.comparison_grid()
+    comparisons = list(limma_stats.comparison_columns(grid))
+    groups = list(dict.fromkeys(c[:3] for c in comparisons))
+
+    genes = None
+    hits = percentages = None
+    for t, threshold in enumerate(thresholds):
+        tables = {key: pandas.read_csv(fname, index_col=0)
+                  for key, fname in _table_fnames(run_dirs.resolve(dirs[threshold])).items()}
+
+        if genes is None:
+            genes = sorted(tables[('between', 'Control')].index)
+            hits = numpy.full((len(thresholds), len(genes), len(comparisons)), -1, dtype=numpy.int8)
+            percentages = numpy.full((len(thresholds), len(genes), len(groups)), numpy.nan)
+
+        for c, (kind, treatment, group, pair) in enumerate(comparisons):
+            if kind == 'between':
+                column = '{}.{}'.format(group, pair)
+                hits[t, :, c] = tables[(kind, treatment)].loc[genes, column].values
+        for g, (kind, treatment, group) in enumerate(groups):
+            if kind == 'between':
+                column = 'ad_perc' if group == 'adult' else 'sen_perc'
+                values = tables[(kind, treatment)].loc[genes, column]
+            else:
+                column = 'tgfb_perc' if treatment == 'TGFb' else 'ctrl_perc'
+                values = tables[(kind, group)].loc[genes, column]
+            percentages[t, :, g] = values.values
+
+    return write_store(path, thresholds, genes, comparisons, groups, hits, percentages,
+                       source=os.path.abspath(saved_objects_path), inputs=inputs)
+
+
+class ResultsStore(object):
+    """
+    Read access to a store written by `write_store`
+    """
+
+    def __init__(self, path):
+        ## pin the run the store currently points to; a concurrent rebuild publishes a new one
+        self.path = run_dirs.resolve(path)
+        with open(os.path.join(self.path, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        self.thresholds = numpy.array(self.manifest['thresholds'])
+        self.genes = pandas.Index(self.manifest['genes'], name='gene')
+        self.comparisons = pandas.MultiIndex.from_tuples(
+            [tuple(c) for c in self.manifest['comparisons']], names=pval_thresholds.LEVELS)
+        self.groups = pandas.MultiIndex.from_tuples(
+            [tuple(g) for g in self.manifest['groups']], names=['kind', 'treatment', 'group'])
+        self._arrays = {}
+
+    def array(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = numpy.load(os.path.join(self.path, '{}.npy'.format(name)), mmap_mode='r')
+        return self._arrays[name]
+
+    def _threshold_index(self, thresholds):
+        if thresholds is None:
+            return numpy.arange(len(self.thresholds))
+        index = []
+        for threshold in numpy.atleast_1d(thresholds):
+            match = numpy.flatnonzero(numpy.isclose(self.thresholds, float(threshold), rtol=1e-9, atol=0))
+            if not match.size:
+                raise KeyError('threshold {} is not in the store ({})'.format(threshold, list(self.thresholds)))
+            index.append(match[0])
+        return numpy.array(index)
+
+    @staticmethod
+    def _mask(index, **levels):
+        mask = numpy.ones(len(index), dtype=bool)
+        for level, value in levels.items():
+            if value is not None:
+                mask &= numpy.isin(index.get_level_values(level), numpy.atleast_1d(value))
+        return mask
+
+    def percentages(self, threshold, kind=None, treatment=None, group=None):
+        """
+        gene x group frame of consensus percentages at one threshold
+        """
+        t = self._threshold_index(threshold)[0]
+        mask = self._mask(self.groups, kind=kind, treatment=treatment, group=group)
+        values = self.array('percentages')[t][:, mask]
+        return pandas.DataFrame(numpy.array(values), index=self.genes, columns=self.groups[mask])
+
+    def hits(self, threshold, kind=None, treatment=None, group=None):
+        """
+        gene x comparison indicator frame at one threshold (-1 where unknown)
+        """
+        t = self._threshold_index(threshold)[0]
+        mask = self._mask(self.comparisons, kind=kind, treatment=treatment, group=group)
+        values = self.array('hits')[t][:, mask]
+        return pandas.DataFrame(numpy.array(values), index=self.genes, columns=self.comparisons[mask])
+
+    def counts(self, consensus=60, thresholds=None):
+        """
+        threshold x group frame of the number of genes with a percentage above `consensus`
+        """
+        index = self._threshold_index(thresholds)
+        counts = (numpy.asarray(self.array('percentages')[index]) > consensus).sum(axis=1)
+        return pandas.DataFrame(counts, index=pandas.Index(self.thresholds[index], name='p_val'),
+                                columns=self.groups)
+
+    def count_frame(self, kind, consensus=60):
+        """
+        Long (p_val, comparison, level_2, 0) frame of counts, the layout the
+        p-value sweep plots in plot_stats_as_heatmap.py are drawn from
+        """
+        counts = self.counts(consensus).sort_index(ascending=False)
+        labels = pval_thresholds.COUNT_LABELS[kind]
+        records = []
+        for p_val, row in counts.iterrows():
+            for (k, treatment, group), count in row.items():
+                if k == kind:
+                    records.append((p_val, labels['group'][group], labels['treatment'][treatment], float(count)))
+        return pandas.DataFrame(records, columns=['p_val', 'comparison', 'level_2', 0])
+
+
+def open_store(saved_objects_path):
+    """
+    The store in saved_objects_path. A store built from a fit is used as it is; one
+    imported from the CSV tree is imported again when the pval_less_than_* folders
+    or their tables no longer match the ones it was imported from.
+    """
+    path = os.path.join(saved_objects_path, STORE_NAME)
+    if os.path.isfile(os.path.join(path, MANIFEST)):
+        store = ResultsStore(path)
+        if store.manifest['source'] == 'adj_pvals' or \
+                store.manifest.get('inputs') == import_inputs(find_threshold_dirs(saved_objects_path)):
+            return store
+    import_saved_objects(saved_objects_path, path)
+    return ResultsStore(path)
@@ -0,0 +1,198 @@
+import os, json, time, uuid, errno, shutil, socket, hashlib, tempfile, contextlib
+import numpy
+import incremental
+
+"""
+Immutable, parameter-keyed run directories, so stats jobs for different thresholds
+or datasets can run at the same time without clobbering each other's files.
+
+A run writes into a private temporary directory and is published with a single
+os.rename once every file in it is complete:
+
+    with run_dirs.atomic_run(saved_objects_path, 'pval_less_than_0_001', params) as tmp:
+        ... write files into tmp ...
+
+    SavedObjects/runs/pval_less_than_0_001-<key>/     the files plus run.json
+    SavedObjects/pval_less_than_0_001 -> runs/pval_less_than_0_001-<key>
+
+<key> is a digest of `params`, so the same run started twice lands in the same
+directory (the later copy is dropped) and different parameters never share one.
+The familiar pval_less_than_* and results_store names become symlinks that are
+swapped atomically to the newest run. Readers `resolve` a name once and then only
+see that one complete run, even while another job publishes a new one; nothing
+takes a lock.
+
+A real directory already at one of these names, such as the published
+pval_less_than_* folders, is never moved or replaced: writing a run under its name
+fails with FileExistsError until the folder has been moved aside by hand.
+
+Published runs are never written to again. The heatmaps, bar charts and count
+tables drawn from them go to SavedObjects/figures/<name>, one `atomic_file` at a time.
+
+"""
+
+RUNS_DIR = 'runs'
+RUN_MANIFEST = 'run.json'
+## figures and count tables drawn from runs live here, never inside a run
+FIGURES_DIR = 'figures'
+
+
+def run_key(params):
+    blob = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(blob.encode()).hexdigest()[:12]
+
+
+def array_digest(*arrays):
+    """
+    Digest of array contents, for keying runs on the data they were derived from
+    """
+    sha = hashlib.sha1()
+    for a in arrays:
+        if a is not None:
+            a = numpy.ascontiguousarray(a)
+            sha.update('{}{}'.format(a.dtype, a.shape).encode())
+            sha.update(a.tobytes())
+    return sha.hexdigest()
+
+
+def frame_digest(df):
+    return array_digest(df.values, numpy.asarray(df.index, dtype=str),
+                        numpy.asarray([str(c) for c in df.columns]))
+
+
+def file_params(fname):
+    """
+    Cheap identity of an input file: path, size and modification time
+    """
+    stat = os.stat(fname)
+    return {'file': os.path.abspath(fname), 'bytes': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def run_path(saved_objects_path, name, params):
+    return os.path.join(saved_objects_path, RUNS_DIR, '{}-{}'.format(name, run_key(params)))
+
+
+def completed(saved_objects_path, name, params):
+    """
+    The published run directory for these parameters, or None
+    """
+    path = run_path(saved_objects_path, name, params)
+    return path if os.path.isfile(os.path.join(path, RUN_MANIFEST)) else None
+
+
+def write_manifest(path, name, params):
+    files = {}
+    for f in sorted(os.listdir(path)):
+        fname = os.path.join(path, f)
+        if f != RUN_MANIFEST and os.path.isfile(fname):
+            files[f] = {'bytes': os.path.getsize(fname), 'sha1': incremental.file_digest(fname)}
+    manifest = {
+        'name': name,
+        'key': run_key(params),
+        'params': params,
+        'files': files,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'host': socket.gethostname(),
+        'pid': os.getpid(),
+    }
+    with open(os.path.join(path, RUN_MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True, default=str)
+
+
+def read_manifest(path):
+    with open(os.path.join(resolve(path), RUN_MANIFEST)) as f:
+        return json.load(f)
+
+
+def resolve(path):
+    """
+    The run directory a name currently points to. Read every file of a run through
+    the resolved path so a concurrent publish can't mix two runs.
+    """
+    return os.path.realpath(path)
+
+
+def _publish(tmp, final):
+    os.chmod(tmp, 0o755)
+    try:
+        os.rename(tmp, final)
+    except OSError as e:
+        if e.errno not in (errno.EEXIST, errno.ENOTEMPTY) or not os.path.isfile(os.path.join(final, RUN_MANIFEST)):
+            raise
+        ## an identical run was published first
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def check_links(saved_objects_path, names):
+    """
+    Raise FileExistsError if any of `names` in saved_objects_path exists and is not
+    a link to a run, before any work is done for them
+    """
+    blocked = [os.path.join(saved_objects_path, name) for name in names
+               if os.path.lexists(os.path.join(saved_objects_path, name))
+               and not os.path.islink(os.path.join(saved_objects_path, name))]
+    if blocked:
+        raise FileExistsError(
+            'not replacing {}: not a link to a run directory, and may hold published results. '
+            'Move it aside (e.g. out of SavedObjects) to write new runs under that name.'.format(', '.join(blocked)))
+
+
+def point_link(link, target):
+    """
+    Atomically (re)point the symlink `link` at `target`. Anything at `link` other than
+    a symlink is left alone and FileExistsError raised (see check_links).
+    """
+    head, tail = os.path.split(link)
+    check_links(head, [tail])
+    tmp = os.path.join(head, '.{}.{}.tmp'.format(tail, uuid.uuid4().hex[:8]))
+    os.symlink(os.path.relpath(target, head), tmp)
+    try:
+        ## os.replace would swap out a real file; refuse that too if one appeared meanwhile
+        check_links(head, [tail])
+        os.replace(tmp, link)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return link
+
+
+@contextlib.contextmanager
+def atomic_run(saved_objects_path, name, params, link=True):
+    """
+    Yield a temporary directory to write a run into. On success it is published as
+    runs/<name>-<key> with a run.json manifest and, with `link`, saved_objects_path/<name>
+    is pointed at it. On failure nothing is published.
+    """
+    if link:
+        check_links(saved_objects_path, [name])
+    final = run_path(saved_objects_path, name, params)
+    os.makedirs(os.path.dirname(final), exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix='.{}.'.format(os.path.basename(final)), suffix='.tmp',
+                           dir=os.path.dirname(final))
+    try:
+        yield tmp
+        write_manifest(tmp, name, params)
+        _publish(tmp, final)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    if link:
+        point_link(os.path.join(saved_objects_path, name), final)
+
+
+@contextlib.contextmanager
+def atomic_file(fname):
+    """
+    Yield a temporary file name next to `fname` (same extension) that replaces
+    `fname` in one step once written
+    """
+    head, tail = os.path.split(fname)
+    root, ext = os.path.splitext(tail)
+    tmp = os.path.join(head, '.{}.{}{}'.format(root, uuid.uuid4().hex[:8], ext))
+    try:
+        yield tmp
+        os.replace(tmp, fname)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
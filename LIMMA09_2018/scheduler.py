@@ -0,0 +1,117 @@
+import os, json, shutil, tempfile
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+import numpy, pandas
+import limma_stats, shared_dct, instrument
+
+"""
+Run the comparison grid (treatment x group x cell line pair) across a process pool.
+
+Each comparison is an independent task. Tasks are grouped into chunks so that a
+worker still gets the benefit of the batched fit in limma_stats, results are put
+back in grid order regardless of completion order, and a chunk that raises is
+resubmitted up to `retries` times before the run is declared failed. Retries are
+returned with the result for the caller to report. A worker that
+dies outright breaks its pool; the chunks that were in it are resubmitted to a new
+pool, each charged one attempt.
+
+Workers don't receive the data itself. The delta Ct matrix is written once with
+shared_dct and every worker opens it as a read-only memory map, so N workers
+cost one copy of the data in RAM rather than N.
+
+"""
+
+_DATA = {}
+
+
+def _init_worker(path):
+    _DATA['dct'], _DATA['factors'] = shared_dct.open_dct(path)
+
+
+def _fit_chunk(chunk):
+    indices, grid = zip(*chunk)
+    with instrument.stage('fit_chunk', comparisons=len(grid)):
+        adj = limma_stats.fit_comparisons(_DATA['dct'], _DATA['factors'], grid=list(grid))
+    return list(indices), adj.values, instrument.drain()
+
+
+def _pool(path, workers):
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(path,))
+
+
+def chunk_grid(grid, n_chunks):
+    """
+    Split the grid into at most n_chunks contiguous chunks of (index, task) tuples
+    """
+    tasks = list(enumerate(grid))
+    n_chunks = max(1, min(n_chunks, len(tasks)))
+    bounds = numpy.linspace(0, len(tasks), n_chunks + 1).astype(int)
+    return [tasks[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def run_grid(dct, factors, grid=None, workers=None, retries=1, chunks_per_worker=2):
+    """
+    limma_stats.fit_comparisons computed on `workers` processes (default:
+    os.cpu_count()), plus the retried chunks (see `run_shared_grid`). The data is
+    shared with the workers through a temporary shared_dct directory.
+    """
+    path = tempfile.mkdtemp(prefix='wafergen_dct_')
+    try:
+        shared_dct.write_dct(dct, factors, path)
+        return run_shared_grid(path, grid=grid, workers=workers, retries=retries,
+                               chunks_per_worker=chunks_per_worker)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def run_shared_grid(path, grid=None, workers=None, retries=1, chunks_per_worker=2):
+    """
+    Fit the comparison grid over the shared_dct arrays in `path` on `workers`
+    processes. Returns the adj.P.Val frame and one {'comparisons', 'error'} record
+    per resubmitted chunk. Raises RuntimeError naming the comparisons that still
+    fail after `retries` resubmissions.
+    """
+    grid = limma_stats.comparison_grid() if grid is None else grid
+    workers = workers or os.cpu_count() or 1
+    with open(os.path.join(path, shared_dct.MANIFEST)) as f:
+        genes = json.load(f)['genes']
+    adj = numpy.full((len(genes), len(grid)), numpy.nan)
+
+    chunks = chunk_grid(grid, workers * chunks_per_worker)
+    attempts = {}
+    failures = {}
+    retried = []
+    pools = [_pool(path, workers)]
+    ## future -> (chunk, the pool it was submitted to)
+    pending = {pools[-1].submit(_fit_chunk, chunk): (i, pools[-1]) for i, chunk in enumerate(chunks)}
+    try:
+        while pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in done:
+                i, pool = pending.pop(future)
+                try:
+                    indices, values, events = future.result()
+                except Exception as e:
+                    if isinstance(e, BrokenProcessPool) and pool is pools[-1]:
+                        pools.append(_pool(path, workers))
+                    attempts[i] = attempts.get(i, 0) + 1
+                    if attempts[i] <= retries:
+                        retried.append({'comparisons': [task for _, task in chunks[i]], 'error': str(e)})
+                        pending[pools[-1].submit(_fit_chunk, chunks[i])] = (i, pools[-1])
+                    else:
+                        failures[i] = e
+                    continue
+                adj[:, indices] = values
+                instrument.add_events(events)
+    finally:
+        for pool in pools:
+            pool.shutdown(wait=pool is pools[-1], cancel_futures=True)
+
+    if failures:
+        failed = [task for i in sorted(failures) for _, task in chunks[i]]
+        raise RuntimeError('{} comparisons failed after {} retries: {}'.format(
+            len(failed), retries, failed))
+
+    adj_pvals = pandas.DataFrame(adj, index=pandas.Index(genes, name='gene'),
+                                 columns=limma_stats.comparison_columns(grid))
+    return adj_pvals, retried
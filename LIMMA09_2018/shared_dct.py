@@ -0,0 +1,75 @@
+import os, json
+import numpy, pandas
+import limma_stats
+
+"""
+The delta Ct matrix and sample factors as memory-mapped arrays on disk, so the
+comparison workers in scheduler.py share one copy through the page cache instead
+of each unpickling their own frame.
+
+    dct.npy        float32 (sample, gene)  genes sorted, as fit_comparisons uses them
+    treatment.npy  int8    (sample,)       codes into manifest['categories']['treatment']
+    cell_line.npy  int8    (sample,)       codes into manifest['categories']['cell_line']
+    time.npy       float32 (sample,)
+    replicate.npy  int16   (sample,)
+    manifest.json  sample and gene names, factor categories
+
+open_dct wraps the mapped arrays in frames without copying; a worker only reads the
+pages for the rows it selects.
+
+"""
+
+DCT_NAME = 'dct_store'
+MANIFEST = 'manifest.json'
+CODED = ['treatment', 'cell_line']
+
+
+def write_dct(dct, factors, path):
+    """
+    Persist a samples x genes delta Ct frame and its sample factors (from
+    ingest.ingest or limma_stats.sample_factors) to `path`
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    genes = sorted(dct.columns)
+    values = dct.values if list(dct.columns) == genes else dct[genes].values
+    numpy.save(os.path.join(path, 'dct.npy'), numpy.asarray(values, dtype=numpy.float32))
+
+    categories = {}
+    for name in CODED:
+        column = pandas.Categorical(factors[name])
+        categories[name] = [str(c) for c in column.categories]
+        numpy.save(os.path.join(path, name + '.npy'), column.codes.astype(numpy.int8))
+    numpy.save(os.path.join(path, 'time.npy'), factors['time'].values.astype(numpy.float32))
+    numpy.save(os.path.join(path, 'replicate.npy'), factors['replicate'].values.astype(numpy.int16))
+
+    manifest = {
+        'samples': [str(s) for s in dct.index],
+        'genes': [str(g) for g in genes],
+        'categories': categories,
+    }
+    with open(os.path.join(path, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return path
+
+
+def open_dct(path):
+    """
+    (dct, factors) frames backed by read-only memory maps of the arrays in `path`
+    """
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+    samples = pandas.Index(manifest['samples'], name='Sample')
+
+    def load(name):
+        return numpy.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+    dct = pandas.DataFrame(load('dct'), index=samples,
+                           columns=pandas.Index(manifest['genes'], name='Assay'), copy=False)
+    factors = pandas.DataFrame({
+        name: pandas.Categorical.from_codes(load(name), manifest['categories'][name])
+        for name in CODED
+    }, index=samples)
+    factors['time'] = load('time')
+    factors['replicate'] = load('replicate')
+    return dct, factors[limma_stats.FACTORS]
@@ -0,0 +1,71 @@
+import os
+import pytest
+import batch, benchmark
+
+"""
+Resuming a batch: which stages rerun after an interruption or a settings change.
+"""
+
+SETTINGS = {'pvals': ['0.001'], 'qc': False, 'drop_flagged': False, 'resamples': 10000, 'dpi': 350}
+
+
+@pytest.fixture
+def experiment(tmp_path):
+    os.makedirs(str(tmp_path / 'plate' / 'SavedObjects'))
+    raw = str(tmp_path / 'plate' / 'SavedObjects' / 'FullDataFrameRawCT_plate.csv')
+    benchmark.synthetic_ct(n_genes=4, seed=6).to_csv(raw, index=False)
+    return {'directory': str(tmp_path / 'plate'), 'raw_data_file': raw}
+
+
+def finish(experiment, stages, settings=SETTINGS):
+    state = batch.load_state(experiment)
+    for stage in stages:
+        state[stage] = {'fingerprint': batch.fingerprint(experiment, settings, stage)}
+    batch.save_state(experiment, state)
+
+
+def test_find_experiments(experiment, tmp_path):
+    os.makedirs(str(tmp_path / 'empty'))
+    experiments, missing = batch.find_experiments([str(tmp_path / '*'), str(tmp_path / 'plate')])
+    assert experiments == [experiment]
+    assert missing == [str(tmp_path / 'plate')]
+
+
+def test_interrupted_batch_resumes(experiment):
+    assert batch.pending_stages(experiment, SETTINGS) == batch.STAGES
+    finish(experiment, ['ingest', 'stats'])
+    assert batch.pending_stages(experiment, SETTINGS) == ['summary', 'render']
+    finish(experiment, ['summary', 'render'])
+    assert batch.pending_stages(experiment, SETTINGS) == []
+    assert batch.pending_stages(experiment, SETTINGS, restart=True) == batch.STAGES
+
+
+@pytest.mark.parametrize('setting, value, stages', [
+    ('dpi', 100, ['render']),
+    ('pvals', ['0.001', '0.0001'], ['stats', 'summary', 'render']),
+    ('resamples', 100, ['stats', 'summary', 'render']),
+    ('qc', True, batch.STAGES),
+])
+def test_settings_change_reruns_the_stages_that_read_it(experiment, setting, value, stages):
+    finish(experiment, batch.STAGES)
+    assert batch.pending_stages(experiment, dict(SETTINGS, **{setting: value})) == stages
+
+
+def test_new_raw_file_reruns_everything(experiment):
+    finish(experiment, batch.STAGES)
+    with open(experiment['raw_data_file'], 'a') as f:
+        f.write('\n')
+    assert batch.pending_stages(experiment, SETTINGS) == batch.STAGES
+
+
+def fail(saved_objects_path, experiment, settings):
+    raise ValueError('fit failed')
+
+
+def test_failed_stage_is_not_recorded(experiment, monkeypatch):
+    finish(experiment, ['ingest'])
+    monkeypatch.setitem(batch._STAGE_FUNCTIONS, 'stats', fail)
+    report = batch.run_stage(experiment, 'stats', SETTINGS)
+    assert report['error'] == 'ValueError: fit failed'
+    assert 'stats' not in batch.load_state(experiment)
+    assert batch.pending_stages(experiment, SETTINGS) == ['stats', 'summary', 'render']
@@ -0,0 +1,55 @@
+import os, shutil
+import numpy
+import pytest
+from numpy.testing import assert_array_equal
+import gene_order, run_dirs
+
+"""
+The cluster ordering is the same every time it is computed, and cached.
+"""
+
+SAVED_OBJECTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'SavedObjects')
+
+
+@pytest.fixture
+def matrix():
+    ## percentages in steps of a third, so many rows share a profile
+    return numpy.random.RandomState(5).randint(0, 4, (300, 6)).astype(numpy.float32) * 100 / 3
+
+
+@pytest.mark.parametrize('max_leaves', [gene_order.MAX_LEAVES, 40])
+def test_cluster_order_is_deterministic(matrix, max_leaves):
+    order, leaves, linkage = gene_order.cluster_order(matrix, max_leaves=max_leaves)
+    assert sorted(order) == list(range(len(matrix)))
+    ## rows sharing a profile end up side by side, leaves in leaf order
+    assert (numpy.diff(leaves[order]) >= 0).all()
+    again = gene_order.cluster_order(matrix.copy(), max_leaves=max_leaves)
+    for first, second in zip((order, leaves, linkage), again):
+        assert_array_equal(first, second)
+
+
+def test_identical_profiles_share_a_leaf(matrix):
+    order, leaves, _ = gene_order.cluster_order(matrix)
+    for row in range(len(matrix)):
+        same = (matrix == matrix[row]).all(axis=1)
+        assert (leaves[same] == leaves[row]).all()
+    assert len(numpy.unique(leaves)) == len(numpy.unique(matrix, axis=0))
+
+
+def test_build_order_is_cached(tmp_path):
+    path = str(tmp_path / 'SavedObjects')
+    for name in ['pval_less_than_0_01', 'pval_less_than_0_001']:
+        shutil.copytree(os.path.join(SAVED_OBJECTS, name), os.path.join(path, name))
+    first = gene_order.build_order(path)
+    genes = gene_order.read_order(first)
+    mtime = os.stat(os.path.join(first, gene_order.ORDER_FNAME)).st_mtime_ns
+    assert gene_order.build_order(path) == first
+    assert os.stat(os.path.join(first, gene_order.ORDER_FNAME)).st_mtime_ns == mtime
+    assert run_dirs.resolve(os.path.join(path, gene_order.ORDER_NAME)) == first
+
+    shutil.rmtree(os.path.join(path, run_dirs.RUNS_DIR))
+    os.remove(os.path.join(path, gene_order.ORDER_NAME))
+    rebuilt = gene_order.build_order(path)
+    gene_order._read_order.cache_clear()
+    assert gene_order.read_order(rebuilt) == genes
+    assert gene_order.apply_order(['NOT_A_GENE'] + genes[::-1], rebuilt) == genes + ['NOT_A_GENE']
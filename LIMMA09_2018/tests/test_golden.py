@@ -0,0 +1,97 @@
+import os, shutil
+import pandas
+import pytest
+import benchmark, golden, limma_stats, pval_thresholds, run_dirs
+
+"""
+The golden baseline has to be the published folders, never the runs the pipeline
+links under the same names. The fitting paths have no inputs in the published
+tree, so they run here on a small synthetic study.
+"""
+
+SAVED_OBJECTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'SavedObjects')
+
+
+def test_published_folders_are_golden(tmp_path):
+    os.makedirs(str(tmp_path / 'pval_less_than_0_01'))
+    os.makedirs(str(tmp_path / 'analysis_at_pval_less_than_0_05'))
+    dirs = golden.golden_dirs(str(tmp_path))
+    assert sorted(dirs) == [0.01]
+
+
+def test_run_links_are_refused(tmp_path):
+    os.makedirs(str(tmp_path / 'pval_less_than_0_01'))
+    with run_dirs.atomic_run(str(tmp_path), 'pval_less_than_0_001', {'threshold': 0.001}):
+        pass
+    with pytest.raises(ValueError, match='pipeline run'):
+        golden.golden_dirs(str(tmp_path))
+
+
+def test_folders_inside_runs_are_refused(tmp_path):
+    os.makedirs(str(tmp_path / run_dirs.RUNS_DIR / 'pval_less_than_0_01'))
+    os.symlink(run_dirs.RUNS_DIR, str(tmp_path / 'linked'))
+    with pytest.raises(ValueError, match='pipeline run'):
+        golden.golden_dirs(str(tmp_path / 'linked'))
+
+
+def test_no_folders(tmp_path):
+    with pytest.raises(ValueError, match='no pval_less_than_'):
+        golden.golden_dirs(str(tmp_path))
+
+
+@pytest.fixture(scope='module')
+def study(tmp_path_factory):
+    """
+    A small synthetic SavedObjects with a raw export, adj_pvals.npz and golden
+    folders written the way the folders were made before pval_thresholds
+    """
+    path = str(tmp_path_factory.mktemp('study') / 'SavedObjects')
+    os.makedirs(path)
+    raw = os.path.join(path, 'FullDataFrameRawCT_synthetic.csv')
+    benchmark.synthetic_ct(n_genes=24, seed=1).to_csv(raw, index=False)
+    dct = limma_stats.calc_dct(limma_stats.read_raw_ct(raw))
+    adj_pvals = limma_stats.fit_comparisons(dct, limma_stats.sample_factors(dct.index))
+    pval_thresholds.save_adj_pvals(adj_pvals, os.path.join(path, pval_thresholds.ADJ_PVALS_FNAME))
+    golden._write_reference_thresholds(adj_pvals, [0.01, 0.001], path)
+    return path
+
+
+def copy_saved_objects(source, tmp_path):
+    path = str(tmp_path / 'SavedObjects')
+    shutil.copytree(source, path)
+    return path
+
+
+def test_fitting_paths_run(study):
+    summary, mismatches = golden.check(study, paths=['thresholds', 'stats'])
+    assert 'skipped' not in summary.columns
+    assert (summary['files'] == 14).all()
+    assert (summary['candidate_mismatches'] == 0).all()
+    assert len(mismatches) == 0
+
+
+def test_changed_golden_cell_is_reported(study, tmp_path):
+    path = copy_saved_objects(study, tmp_path)
+    fname = os.path.join(path, 'pval_less_than_0_01', 'within_adult.csv')
+    table = pandas.read_csv(fname, index_col=0)
+    table.iloc[0, 0] += 1
+    limma_stats.write_r_csv(table, fname)
+    summary, mismatches = golden.check(path, paths=['thresholds', 'stats'])
+    assert (summary['reference_mismatches'] == 1).all()
+    assert (summary['candidate_mismatches'] == 1).all()
+    assert set(mismatches['file']) == {'within_adult.csv'}
+
+
+def test_counts_are_not_copied_from_golden(tmp_path):
+    path = str(tmp_path / 'SavedObjects')
+    shutil.copytree(os.path.join(SAVED_OBJECTS, 'pval_less_than_0_01'), os.path.join(path, 'pval_less_than_0_01'))
+    fname = os.path.join(path, 'pval_less_than_0_01', 'between_count_greater_than_60_percent.csv')
+    lines = open(fname).read().splitlines()
+    cells = lines[-1].split(',')
+    cells[-1] = str(int(cells[-1]) + 1)
+    lines[-1] = ','.join(cells)
+    with open(fname, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    summary, mismatches = golden.check(path, paths=['counts'])
+    assert summary['reference_mismatches'].iloc[0] == 1
+    assert summary['candidate_mismatches'].iloc[0] == 1
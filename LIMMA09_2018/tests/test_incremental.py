@@ -0,0 +1,60 @@
+import os, shutil
+import pytest
+import incremental, plot_statistics_as_bar_charts
+
+"""
+Rebuilding only the figure jobs whose inputs, arguments or outputs changed.
+"""
+
+SAVED_OBJECTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'SavedObjects')
+
+
+@pytest.fixture
+def jobs(tmp_path):
+    folder = str(tmp_path / 'pval_less_than_0_01')
+    shutil.copytree(os.path.join(SAVED_OBJECTS, 'pval_less_than_0_01'), folder)
+    jobs = plot_statistics_as_bar_charts.figure_jobs(folder, 0.01, str(tmp_path / 'figures'), dpi=20)
+    ## one chart of between_control_statistics.csv, one of within_neonatal.csv
+    return [jobs[0], jobs[4]]
+
+
+def build(jobs, tmp_path, **kwargs):
+    reports, skipped = incremental.build(jobs, str(tmp_path / incremental.MANIFEST_NAME), workers=1, **kwargs)
+    assert all(report['error'] is None for report in reports)
+    return [report['kwargs']['fname'] for report in reports], skipped
+
+
+def test_up_to_date_jobs_are_skipped(jobs, tmp_path):
+    ran, skipped = build(jobs, tmp_path)
+    assert ran == [job[2]['fname'] for job in jobs] and skipped == 0
+    assert all(os.path.isfile(job[2]['fname']) for job in jobs)
+    assert build(jobs, tmp_path) == ([], 2)
+    ran, skipped = build(jobs, tmp_path, force=True)
+    assert len(ran) == 2 and skipped == 0
+
+
+def test_changed_input_is_rebuilt(jobs, tmp_path):
+    build(jobs, tmp_path)
+    fname = jobs[0][2]['csv_fname']
+    with open(fname) as f:
+        text = f.read()
+    with open(fname, 'w') as f:
+        f.write(text.replace('77.7777777777778', '66.6666666666667', 1))
+    assert build(jobs, tmp_path) == ([jobs[0][2]['fname']], 1)
+    assert build(jobs, tmp_path) == ([], 2)
+
+
+def test_missing_output_and_changed_arguments_are_rebuilt(jobs, tmp_path):
+    build(jobs, tmp_path)
+    os.remove(jobs[1][2]['fname'])
+    assert build(jobs, tmp_path) == ([jobs[1][2]['fname']], 1)
+    module, function, kwargs = jobs[0]
+    jobs = [(module, function, dict(kwargs, dpi=30)), jobs[1]]
+    assert build(jobs, tmp_path) == ([kwargs['fname']], 1)
+
+
+def test_local_imports_are_part_of_the_source():
+    sources = incremental.local_sources('plot_stats_as_heatmap')
+    assert {'plot_stats_as_heatmap', 'results_cube', 'render'} <= set(sources)
+    assert 'numpy' not in sources
+    assert set(incremental.source_digest('plot_stats_as_heatmap')) == set(sources)
@@ -0,0 +1,49 @@
+import numpy
+from numpy.testing import assert_allclose
+import benchmark, ingest, limma_stats, pval_thresholds
+
+"""
+The float32 streaming ingest against the float64 read_raw_ct + calc_dct path. The
+two agree to float32 precision, not bit for bit, so p-values are compared on a
+log10 scale with a tolerance.
+"""
+
+## largest |log10 adj.P.Val| difference allowed; about 7e-5 is seen on synthetic data
+LOG10_TOLERANCE = 1e-3
+
+
+def raw_file(tmp_path, n_genes=120):
+    fname = str(tmp_path / 'FullDataFrameRawCT.csv')
+    benchmark.synthetic_ct(n_genes=n_genes, seed=0).to_csv(fname, index=False)
+    return fname
+
+
+def test_dct_matches_float64(tmp_path):
+    fname = raw_file(tmp_path)
+    dct, factors = ingest.ingest(fname)
+    expected = limma_stats.calc_dct(limma_stats.read_raw_ct(fname))
+    assert dct.values.dtype == numpy.float32
+    assert list(dct.index) == list(expected.index)
+    assert list(dct.columns) == list(expected.columns)
+    assert_allclose(dct.values, expected.values, rtol=1e-5)
+
+
+def test_adj_pvals_within_tolerance(tmp_path):
+    fname = raw_file(tmp_path)
+    dct, factors = ingest.ingest(fname)
+    expected_dct = limma_stats.calc_dct(limma_stats.read_raw_ct(fname))
+    adj_pvals = limma_stats.fit_comparisons(dct, factors)
+    expected = limma_stats.fit_comparisons(expected_dct, limma_stats.sample_factors(expected_dct.index))
+
+    assert (numpy.isnan(adj_pvals.values) == numpy.isnan(expected.values)).all()
+    with numpy.errstate(divide='ignore'):
+        assert_allclose(numpy.log10(adj_pvals.values), numpy.log10(expected.values),
+                        atol=LOG10_TOLERANCE, equal_nan=True)
+
+    ## indicators only differ for p-values within the tolerance of a cut-off
+    thresholds = pval_thresholds.THRESHOLDS
+    hits = pval_thresholds.threshold_hits(adj_pvals, thresholds)
+    expected_hits = pval_thresholds.threshold_hits(expected, thresholds)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        near = numpy.abs(numpy.log10(expected.values)[None] - numpy.log10(thresholds)[:, None, None]) < LOG10_TOLERANCE
+    assert ((hits == expected_hits) | near).all()
@@ -0,0 +1,92 @@
+import numpy
+from numpy.testing import assert_allclose
+from scipy import special
+from scipy.interpolate import BSpline
+import limma_stats
+
+"""
+Fixed-input checks of the limma port against R. Expected values are R's printed
+output, quoted with the call that produced them, or follow exactly from the
+definitions in limma's source.
+"""
+
+## women$height, as in the ns() examples
+WOMEN_HEIGHT = numpy.arange(58, 73, dtype=float)
+
+TIME_POINTS = [0.5, 1, 2, 3, 4, 8, 12, 24, 48, 72, 96]
+
+
+def r_ns(x, df):
+    """
+    R's splines::ns(x, df) basis: B-splines with the second derivative constrained
+    to zero at the boundary knots via the QR step in ns()
+    """
+    x = numpy.asarray(x, dtype=float)
+    interior = numpy.quantile(x, numpy.linspace(0, 1, df + 1)[1:-1])
+    boundary = [x.min(), x.max()]
+    knots = numpy.sort(numpy.concatenate([[boundary[0]] * 4, interior, [boundary[1]] * 4]))
+    n = len(knots) - 4
+    basis = BSpline.design_matrix(x, knots, 3).toarray()
+    const = numpy.column_stack([BSpline(knots, numpy.eye(n)[j], 3).derivative(2)(boundary) for j in range(n)])
+    ## intercept = FALSE drops the first B-spline
+    basis, const = basis[:, 1:], const[:, 1:]
+    q = numpy.linalg.qr(const.T, mode='complete')[0]
+    return (q.T @ basis.T).T[:, 2:]
+
+
+def test_r_ns_matches_r():
+    ## > ns(women$height, df = 3)[c(1, 15), ]
+    basis = r_ns(WOMEN_HEIGHT, 3)
+    assert_allclose(basis[0], [0, 0, 0], atol=1e-12)
+    assert_allclose(basis[-1], [-0.1428571, 0.4285714, 0.7142857], atol=1e-7)
+
+
+def test_natural_spline_basis_spans_ns():
+    ## the design's time points, two replicates each
+    x = numpy.repeat(TIME_POINTS, 2)
+    ours = numpy.column_stack([numpy.ones(len(x)), limma_stats.natural_spline_basis(x, df=4)])
+    r = r_ns(x, 4)
+    coef = numpy.linalg.lstsq(ours, r, rcond=None)[0]
+    assert_allclose(ours @ coef, r, atol=1e-10)
+    assert numpy.linalg.matrix_rank(ours) == 5
+
+
+def test_trigamma_inverse():
+    ## trigamma(1) = pi^2/6, trigamma(1/2) = pi^2/2, trigamma(3/2) = pi^2/2 - 4
+    x = numpy.array([numpy.pi ** 2 / 6, numpy.pi ** 2 / 2, numpy.pi ** 2 / 2 - 4])
+    assert_allclose(limma_stats.trigamma_inverse(x), [1, 0.5, 1.5], rtol=1e-8)
+    ## limma's asymptotic branches
+    assert_allclose(limma_stats.trigamma_inverse([1e8, 1e-7]), [1e-4, 1e7])
+    y = numpy.geomspace(0.01, 100, 9)
+    assert_allclose(limma_stats.trigamma_inverse(special.polygamma(1, y)), y, rtol=1e-7)
+
+
+def test_fit_f_dist_no_excess_variance():
+    ## > squeezeVar(rep(2, 10), df = 5)[c('var.prior', 'df.prior')]
+    ## $var.prior 2, $df.prior Inf
+    s20, d0 = limma_stats.fit_f_dist(numpy.full((1, 10), 2.0), 5)
+    assert_allclose(s20, [2.0])
+    assert numpy.isinf(d0).all()
+
+
+def test_fit_f_dist_recovers_prior():
+    ## s2 ~ s0^2 F(df, d0) is the model fitFDist's moment estimates assume
+    rng = numpy.random.default_rng(0)
+    df, d0, s0 = 6.0, 10.0, 0.5
+    s2 = s0 * rng.chisquare(df, 200000) / df / (rng.chisquare(d0, 200000) / d0)
+    s20, d0_hat = limma_stats.fit_f_dist(s2[None, :], df)
+    assert_allclose(s20, [s0], rtol=0.02)
+    assert_allclose(d0_hat, [d0], rtol=0.05)
+
+
+def test_p_adjust_bh():
+    ## > p.adjust(c(0.01, 0.04, 0.03, 0.005, 0.5), 'BH')
+    ## [1] 0.025 0.050 0.050 0.025 0.500
+    assert_allclose(limma_stats.p_adjust_bh([0.01, 0.04, 0.03, 0.005, 0.5]),
+                    [0.025, 0.05, 0.05, 0.025, 0.5])
+    ## > p.adjust(c(0.01, 0.02, 0.03, 0.04, 0.05), 'BH')
+    assert_allclose(limma_stats.p_adjust_bh([0.01, 0.02, 0.03, 0.04, 0.05]), [0.05] * 5)
+    ## NA is left out of n: p.adjust(c(0.01, NA, 0.04), 'BH') is 0.02 NA 0.04
+    assert_allclose(limma_stats.p_adjust_bh([0.01, numpy.nan, 0.04]), [0.02, numpy.nan, 0.04])
+    ## rows of a matrix are adjusted separately
+    assert_allclose(limma_stats.p_adjust_bh([[0.01, 0.04], [0.5, 0.2]]), [[0.02, 0.04], [0.5, 0.4]])
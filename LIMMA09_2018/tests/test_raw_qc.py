@@ -0,0 +1,79 @@
+import numpy
+import pytest
+from numpy.testing import assert_array_equal
+import raw_qc
+from raw_qc import MISSING, UNDETERMINED, LATE, OUTLIER, REFERENCE_FAILED
+
+"""
+Well flags, sample flags and replicate CVs on a hand-made Ct matrix.
+"""
+
+ASSAYS = ['PPIA', 'A', 'B']
+SAMPLES = ['X_1', 'X_2', 'X_3', 'Y_1', 'Y_2', 'Y_3', 'Y_4', 'Z_1']
+NAN = numpy.nan
+
+
+@pytest.fixture
+def raw():
+    matrix = numpy.array([
+        [20, NAN, 40],   # A has no row in the export, B is late
+        [20, NAN, 22],   # A is undetermined
+        [20, 24, 22],
+        [20, 25, 22],
+        [20, 25, 22],
+        [20, 25, 22],
+        [20, 28, 22],    # A is 3 cycles off its replicates
+        [40, 24, 22],    # the reference is late
+    ])
+    present = numpy.ones(matrix.shape, dtype=bool)
+    present[0, 1] = False
+    return matrix, present, ASSAYS, SAMPLES, numpy.array(['chip'] * len(SAMPLES), dtype=object)
+
+
+def test_well_flags(raw):
+    report = raw_qc.quality_control(*raw)
+    assert_array_equal(report.flags, [
+        [0, MISSING, LATE],
+        [0, UNDETERMINED, 0],
+        [0, 0, 0],
+        [0, 0, 0],
+        [0, 0, 0],
+        [0, 0, 0],
+        [0, OUTLIER, 0],
+        [LATE | REFERENCE_FAILED, REFERENCE_FAILED, REFERENCE_FAILED],
+    ])
+    wells = report.well_table().set_index(['sample', 'assay'])
+    assert wells.loc[('Z_1', 'PPIA'), ['late', 'reference', 'missing']].tolist() == [True, True, False]
+    assert len(wells) == 7
+
+
+def test_sample_flags(raw):
+    report = raw_qc.quality_control(*raw)
+    assert report.flagged_samples() == ['X_1', 'X_2', 'Y_4', 'Z_1']
+    assert report.samples['reasons'].to_dict() == {
+        'X_1': 'failed_wells', 'X_2': 'failed_wells', 'X_3': '', 'Y_1': '', 'Y_2': '', 'Y_3': '',
+        'Y_4': 'outliers', 'Z_1': 'reference;failed_wells'}
+    assert report.samples.loc['X_1', ['missing', 'undetermined', 'late']].tolist() == [1, 0, 1]
+    assert report.genes.loc['A', ['missing', 'undetermined', 'outliers']].tolist() == [1, 1, 1]
+
+
+def test_replicate_cv(raw):
+    cv = raw_qc.quality_control(*raw).cv
+    assert list(cv.index) == ['X', 'Y', 'Z']
+    assert cv.loc['X', 'B'] == 0
+    ## A in Y: three replicates at delta Ct 5, one at 8
+    quantity = numpy.exp2(-numpy.array([5., 5., 5., 8.]))
+    assert cv.loc['Y', 'A'] == pytest.approx(quantity.std(ddof=1) / quantity.mean())
+    assert numpy.isnan(cv.loc['X', 'A']) and cv.loc['Z'].isna().all()
+
+
+def test_limits(raw):
+    report = raw_qc.quality_control(*raw, max_ct=45, outlier_ct=20)
+    assert report.flags[0, 2] == 0 and report.flags[6, 1] == 0
+    assert report.flags[7, 0] == 0 and report.flags[7, 1] == 0
+    assert report.flagged_samples() == ['X_1', 'X_2']
+
+
+def test_unknown_reference(raw):
+    with pytest.raises(KeyError, match='GAPDH'):
+        raw_qc.quality_control(*raw, reference='GAPDH')
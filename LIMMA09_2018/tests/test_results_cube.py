@@ -0,0 +1,69 @@
+import os
+import pandas
+import pytest
+from pandas.testing import assert_frame_equal
+import results_cube, results_store
+
+"""
+The heatmap tables of ResultsCube against the stack/pivot reshape of the original
+plotting script, on the published folders.
+"""
+
+SAVED_OBJECTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'SavedObjects')
+FOLDERS = sorted(results_store.find_threshold_dirs(SAVED_OBJECTS).items())
+
+
+def baseline_tables(pval_path):
+    """
+    (within, between) heatmap tables the way plot_stats_as_heatmap.py made them
+    before ResultsCube
+    """
+    tables = []
+    for name in ['within_neonatal', 'within_senescent', 'within_adult']:
+        table = pandas.read_csv(os.path.join(pval_path, '{}.csv'.format(name)), index_col=0)
+        table.columns = pandas.MultiIndex.from_product([[name], list(table.columns)])
+        tables.append(table)
+    for name in ['between_control', 'between_tgfb']:
+        table = pandas.read_csv(os.path.join(pval_path, '{}_statistics.csv'.format(name)), index_col=0)
+        table = table[['sen_perc', 'ad_perc']]
+        table.columns = pandas.MultiIndex.from_product([[name], list(table.columns)])
+        tables.append(table)
+    df = pandas.DataFrame(pandas.concat(tables, axis=1).stack().stack().dropna())
+    df.index.names = ['gene', 'group1', 'group2']
+    df.columns = ['percentage']
+    df = df.reset_index()
+
+    within = df.query("group2 in ['within_adult', 'within_senescent', 'within_neonatal']")
+    within = within.assign(group=['{}_{}'.format(within['group2'].iloc[i], within['group1'].iloc[i])
+                                  for i in range(within.shape[0])])
+    within = within.pivot(index='gene', columns='group', values='percentage')
+    within.columns = ['adult_control', 'adult_tgf', 'neonatal_control', 'neonatal_tgf',
+                      'senescent_control', 'senescent_tgf']
+    within = within[['neonatal_control', 'adult_control', 'senescent_control',
+                     'neonatal_tgf', 'adult_tgf', 'senescent_tgf']]
+
+    between = df.query("group2 in ['between_control', 'between_tgfb']")
+    between = between.assign(group=['{}_{}'.format(between['group1'].iloc[i], between['group2'].iloc[i])
+                                    for i in range(between.shape[0])])
+    between = between.pivot_table(index='gene', columns='group', values='percentage')
+    between.columns = ['adult_control', 'adult_tgfb', 'senescent_control', 'senescent_tgfb']
+    between = between[['adult_control', 'senescent_control', 'adult_tgfb', 'senescent_tgfb']]
+    return within, between
+
+
+@pytest.mark.parametrize('threshold, pval_path', FOLDERS)
+def test_tables_match_the_original_reshape(threshold, pval_path):
+    cube = results_cube.ResultsCube.from_statistics(pval_path, threshold)
+    within, between = baseline_tables(pval_path)
+    for kind, expected in [('within', within), ('between', between)]:
+        assert_frame_equal(cube.table(kind), expected, check_names=False, check_index_type=False)
+
+
+def test_store_cube_matches_the_folders(tmp_path):
+    store = results_store.ResultsStore(
+        results_store.import_saved_objects(SAVED_OBJECTS, str(tmp_path / results_store.STORE_NAME)))
+    cube = results_cube.ResultsCube.from_store(store)
+    for threshold, pval_path in FOLDERS:
+        folder = results_cube.ResultsCube.from_statistics(pval_path, threshold)
+        for kind in ['within', 'between']:
+            assert_frame_equal(cube.table(kind, threshold), folder.table(kind))
@@ -0,0 +1,90 @@
+import os, io, json, shutil, threading
+from http.server import ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.request import urlopen
+import numpy, pandas
+import pytest
+from pandas.testing import assert_frame_equal
+import limma_stats, results_server, results_store
+from results_cube import ResultsCube
+
+"""
+The /genes and /table handlers over a live server, against the published tables.
+"""
+
+SAVED_OBJECTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'SavedObjects')
+
+
+def start(service):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), results_server.make_handler(service))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def get(server, path):
+    with urlopen('http://127.0.0.1:{}{}'.format(server.server_port, path)) as response:
+        return response.headers['Content-Type'], response.read().decode()
+
+
+@pytest.fixture(scope='module')
+def server(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('server') / 'SavedObjects')
+    for name in ['pval_less_than_0_01', 'pval_less_than_0_001']:
+        shutil.copytree(os.path.join(SAVED_OBJECTS, name), os.path.join(path, name))
+    server = start(results_server.ResultsService(path))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_genes(server):
+    content_type, body = get(server, '/genes?threshold=0.01&group=within_adult&treatment=tgfb&consensus=60')
+    assert content_type == 'application/json'
+    table = pandas.read_csv(os.path.join(SAVED_OBJECTS, 'pval_less_than_0_01', 'within_adult.csv'), index_col=0)
+    expected = table['tgfb_perc'][table['tgfb_perc'] >= 60].sort_index()
+    genes = json.loads(body)
+    assert sorted(g['gene'] for g in genes) == list(expected.index)
+    assert all(g['percentage'] == pytest.approx(expected[g['gene']]) for g in genes)
+    percentages = [g['percentage'] for g in genes]
+    assert percentages == sorted(percentages, reverse=True)
+
+
+def test_table(server):
+    content_type, body = get(server, '/table?kind=between&threshold=0.001')
+    assert content_type == 'text/csv'
+    expected = ResultsCube.from_statistics(os.path.join(SAVED_OBJECTS, 'pval_less_than_0_001'), 0.001)
+    assert_frame_equal(pandas.read_csv(io.StringIO(body), index_col=0),
+                       expected.table('between').dropna(how='all'), check_names=False)
+
+
+@pytest.mark.parametrize('path, status, error', [
+    ('/genes?threshold=0.01&group=adult&treatment=tgfb', 400, 'group must be one of'),
+    ('/genes?group=within_adult&treatment=tgfb', 400, 'missing query parameter threshold'),
+    ('/table?kind=within&threshold=0.05', 400, 'threshold 0.05 is not stored'),
+    ('/tables?kind=within&threshold=0.01', 404, 'unknown path'),
+])
+def test_bad_requests(server, path, status, error):
+    with pytest.raises(HTTPError) as e:
+        get(server, path)
+    assert e.value.code == status
+    assert error in json.loads(e.value.read().decode())['error']
+
+
+def test_unstored_threshold_is_computed_from_adj_pvals(tmp_path):
+    columns = limma_stats.comparison_columns()
+    genes = ['G{:02d}'.format(i) for i in range(30)]
+    values = 10 ** -numpy.random.RandomState(1).uniform(0, 5, (len(genes), len(columns)))
+    adj_pvals = pandas.DataFrame(values, index=pandas.Index(genes, name='gene'), columns=columns)
+    path = str(tmp_path / 'SavedObjects')
+    results_store.build_store(adj_pvals, os.path.join(path, results_store.STORE_NAME), [0.01])
+    server = start(results_server.ResultsService(path))
+    try:
+        _, body = get(server, '/genes?threshold=0.001&group=between_senescent&treatment=control&consensus=50')
+    finally:
+        server.shutdown()
+        server.server_close()
+    sen = adj_pvals.loc[:, adj_pvals.columns.droplevel('pair') == ('between', 'Control', 'sen')]
+    expected = (sen < 0.001).mean(axis=1) * 100
+    expected = expected[expected >= 50]
+    assert len(expected)
+    assert {g['gene']: g['percentage'] for g in json.loads(body)} == pytest.approx(expected.to_dict())
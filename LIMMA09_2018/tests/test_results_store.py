@@ -0,0 +1,86 @@
+import os, shutil
+import numpy, pandas
+import pytest
+from numpy.testing import assert_allclose, assert_array_equal
+import limma_stats, results_store
+
+"""
+Importing the published pval_less_than_* folders into a store, and keeping the
+imported store in step with the folders.
+"""
+
+SAVED_OBJECTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'SavedObjects')
+
+
+@pytest.fixture
+def saved_objects(tmp_path):
+    path = str(tmp_path / 'SavedObjects')
+    os.makedirs(path)
+    for name in ['pval_less_than_0_01', 'pval_less_than_0_001', 'analysis_at_pval_less_than_0_05']:
+        shutil.copytree(os.path.join(SAVED_OBJECTS, name), os.path.join(path, name))
+    return path
+
+
+def test_store_round_trip(tmp_path):
+    columns = limma_stats.comparison_columns()
+    genes = ['G{:02d}'.format(i) for i in range(20)]
+    values = 10 ** -numpy.random.RandomState(0).uniform(0, 6, (len(genes), len(columns)))
+    values[3, 5] = numpy.nan
+    adj_pvals = pandas.DataFrame(values, index=pandas.Index(genes, name='gene'), columns=columns)
+    thresholds = [0.01, 0.0001]
+    store = results_store.ResultsStore(results_store.build_store(adj_pvals, str(tmp_path / 'store'), thresholds))
+
+    assert list(store.thresholds) == thresholds
+    assert list(store.genes) == genes
+    assert list(store.comparisons) == list(columns)
+    assert_array_equal(store.array('adj_pvals'), values)
+    for threshold in thresholds:
+        hits = store.hits(threshold)
+        assert_array_equal(hits.values, numpy.nan_to_num(values, nan=1) < threshold)
+        assert hits.loc['G03', columns[5]] == 0
+        percentages = store.percentages(threshold)
+        for key in percentages.columns:
+            expected = hits.loc[:, hits.columns.droplevel('pair') == key].mean(axis=1) * 100
+            assert_allclose(percentages[key].values, expected.values)
+    assert_array_equal(store.counts(60).values, [(store.percentages(t) > 60).sum().values for t in thresholds])
+
+
+def test_import_matches_published_tables(saved_objects):
+    store = results_store.ResultsStore(results_store.import_saved_objects(saved_objects))
+    assert list(store.thresholds) == [0.01, 0.001]
+    for threshold, name in [(0.01, 'pval_less_than_0_01'), (0.001, 'pval_less_than_0_001')]:
+        folder = os.path.join(SAVED_OBJECTS, name)
+        for treatment, fname in [('Control', 'control'), ('TGFb', 'tgfb')]:
+            table = pandas.read_csv(os.path.join(folder, 'between_{}_statistics.csv'.format(fname)), index_col=0)
+            for group, column in [('adult', 'ad_perc'), ('sen', 'sen_perc')]:
+                percentages = store.percentages(threshold, kind='between', treatment=treatment, group=group)
+                assert_allclose(percentages.iloc[:, 0].values, table.loc[store.genes, column].values)
+                hits = store.hits(threshold, kind='between', treatment=treatment, group=group)
+                columns = ['{}.{}'.format(group, pair) for pair in hits.columns.get_level_values('pair')]
+                assert_array_equal(hits.values, table.loc[store.genes, columns].values)
+        for group in limma_stats.WITHIN_GROUPS:
+            table = pandas.read_csv(os.path.join(folder, 'within_{}.csv'.format(group)), index_col=0)
+            for treatment, column in [('Control', 'ctrl_perc'), ('TGFb', 'tgfb_perc')]:
+                percentages = store.percentages(threshold, kind='within', treatment=treatment, group=group)
+                assert_allclose(percentages.iloc[:, 0].values, table.loc[store.genes, column].values)
+        assert (store.hits(threshold, kind='within').values == -1).all()
+
+
+def test_legacy_folders_are_opt_in(saved_objects):
+    assert list(results_store.open_store(saved_objects).thresholds) == [0.01, 0.001]
+    path = results_store.import_saved_objects(saved_objects, os.path.join(saved_objects, 'legacy'), legacy=True)
+    assert list(results_store.ResultsStore(path).thresholds) == [0.05, 0.01, 0.001]
+
+
+def test_store_is_reimported_when_folders_change(saved_objects):
+    store = results_store.open_store(saved_objects)
+    assert results_store.open_store(saved_objects).path == store.path
+
+    shutil.copytree(os.path.join(SAVED_OBJECTS, 'pval_less_than_0_0001'),
+                    os.path.join(saved_objects, 'pval_less_than_0_0001'))
+    added = results_store.open_store(saved_objects)
+    assert list(added.thresholds) == [0.01, 0.001, 0.0001]
+
+    fname = os.path.join(saved_objects, 'pval_less_than_0_0001', 'within_adult.csv')
+    os.utime(fname, ns=(0, os.stat(fname).st_mtime_ns + 1))
+    assert results_store.open_store(saved_objects).path != added.path
@@ -0,0 +1,95 @@
+import os
+import numpy
+import pytest
+from numpy.testing import assert_allclose, assert_array_equal
+import benchmark, limma_stats, scheduler
+
+"""
+The process pool fit against the in-process one, including workers that fail.
+"""
+
+_fit_chunk = scheduler._fit_chunk
+
+
+def die_once(chunk):
+    ## the first chunk to get here kills its worker, and with it the pool
+    marker = os.environ['SCHEDULER_TEST_MARKER']
+    try:
+        os.close(os.open(marker, os.O_CREAT | os.O_EXCL))
+    except FileExistsError:
+        return _fit_chunk(chunk)
+    os._exit(1)
+
+
+def raise_once(chunk):
+    marker = os.environ['SCHEDULER_TEST_MARKER']
+    try:
+        os.close(os.open(marker, os.O_CREAT | os.O_EXCL))
+    except FileExistsError:
+        return _fit_chunk(chunk)
+    raise ValueError('first chunk fails')
+
+
+def always_raise(chunk):
+    raise ValueError('chunk fails')
+
+
+@pytest.fixture(scope='module')
+def data(tmp_path_factory):
+    fname = str(tmp_path_factory.mktemp('scheduler') / 'FullDataFrameRawCT.csv')
+    benchmark.synthetic_ct(n_genes=12, seed=2).to_csv(fname, index=False)
+    dct = limma_stats.calc_dct(limma_stats.read_raw_ct(fname))
+    factors = limma_stats.sample_factors(dct.index)
+    return dct, factors, limma_stats.fit_comparisons(dct, factors)
+
+
+def test_chunks_cover_the_grid_in_order():
+    grid = limma_stats.comparison_grid()
+    chunks = scheduler.chunk_grid(grid, 7)
+    assert len(chunks) == 7
+    assert [task for chunk in chunks for task in chunk] == list(enumerate(grid))
+    assert len(scheduler.chunk_grid(grid[:3], 8)) == 3
+
+
+def test_results_are_in_grid_order(data):
+    dct, factors, _ = data
+    ## a partial grid in reverse order, so chunks finish out of grid order
+    grid = limma_stats.comparison_grid()[::-5]
+    adj_pvals, retried = scheduler.run_grid(dct, factors, grid=grid, workers=3, chunks_per_worker=3)
+    expected = limma_stats.fit_comparisons(dct, factors, grid=grid)
+    assert retried == []
+    assert list(adj_pvals.columns) == list(limma_stats.comparison_columns(grid))
+    assert list(adj_pvals.index) == list(expected.index)
+    assert_allclose(adj_pvals.values, expected.values, rtol=1e-5)
+
+
+def test_failed_chunk_is_retried(data, tmp_path, monkeypatch):
+    dct, factors, expected = data
+    monkeypatch.setenv('SCHEDULER_TEST_MARKER', str(tmp_path / 'raised'))
+    monkeypatch.setattr(scheduler, '_fit_chunk', raise_once)
+    adj_pvals, retried = scheduler.run_grid(dct, factors, workers=2)
+    assert len(retried) == 1
+    assert retried[0]['error'] == 'first chunk fails'
+    assert retried[0]['comparisons']
+    assert_allclose(adj_pvals.values, expected.values, rtol=1e-5)
+
+
+def test_chunk_failing_every_retry_raises(data, monkeypatch):
+    dct, factors, _ = data
+    monkeypatch.setattr(scheduler, '_fit_chunk', always_raise)
+    grid = limma_stats.comparison_grid()[:4]
+    with pytest.raises(RuntimeError, match='4 comparisons failed after 1 retries'):
+        scheduler.run_grid(dct, factors, grid=grid, workers=1, chunks_per_worker=1)
+
+
+def test_dead_worker_is_retried_on_a_new_pool(data, tmp_path, monkeypatch):
+    dct, factors, expected = data
+    monkeypatch.setenv('SCHEDULER_TEST_MARKER', str(tmp_path / 'died'))
+    monkeypatch.setattr(scheduler, '_fit_chunk', die_once)
+    adj_pvals, retried = scheduler.run_grid(dct, factors, workers=2)
+    assert os.path.exists(str(tmp_path / 'died'))
+    assert retried and all('terminated abruptly' in r['error'] for r in retried)
+    assert list(adj_pvals.columns) == list(expected.columns)
+    assert_array_equal(numpy.isnan(adj_pvals.values), numpy.isnan(expected.values))
+    ## the workers read the float32 shared_dct copy
+    assert_allclose(adj_pvals.values, expected.values, rtol=1e-5)
@@ -0,0 +1,48 @@
+import numpy
+import pytest
+from numpy.testing import assert_allclose, assert_array_equal
+import benchmark, limma_stats, shared_dct
+
+"""
+Writing the delta Ct matrix and its factors as memory maps and reading them back.
+"""
+
+
+@pytest.fixture(scope='module')
+def data(tmp_path_factory):
+    fname = str(tmp_path_factory.mktemp('shared_dct') / 'FullDataFrameRawCT.csv')
+    benchmark.synthetic_ct(n_genes=10, seed=3).to_csv(fname, index=False)
+    dct = limma_stats.calc_dct(limma_stats.read_raw_ct(fname))
+    ## genes out of order, the store sorts them
+    return dct[list(reversed(dct.columns))], limma_stats.sample_factors(dct.index)
+
+
+def test_round_trip(data, tmp_path):
+    dct, factors = data
+    path = shared_dct.write_dct(dct, factors, str(tmp_path / shared_dct.DCT_NAME))
+    shared, shared_factors = shared_dct.open_dct(path)
+
+    assert list(shared.columns) == sorted(dct.columns)
+    assert list(shared.index) == list(dct.index)
+    assert shared.values.dtype == numpy.float32
+    assert_allclose(shared.values, dct[sorted(dct.columns)].values, rtol=1e-6)
+    assert list(shared_factors.columns) == limma_stats.FACTORS
+    for name in limma_stats.FACTORS:
+        assert_array_equal(shared_factors[name].astype(str).values, factors[name].astype(str).values)
+
+
+def test_arrays_are_read_only_maps(data, tmp_path):
+    dct, factors = data
+    shared, _ = shared_dct.open_dct(shared_dct.write_dct(dct, factors, str(tmp_path / shared_dct.DCT_NAME)))
+    assert not shared.values.flags.writeable
+    with pytest.raises(ValueError):
+        shared.values[0, 0] = 0
+
+
+def test_fit_is_unchanged(data, tmp_path):
+    dct, factors = data
+    path = shared_dct.write_dct(dct, factors, str(tmp_path / shared_dct.DCT_NAME))
+    shared, shared_factors = shared_dct.open_dct(path)
+    grid = limma_stats.comparison_grid()[::7]
+    expected = limma_stats.fit_comparisons(dct, factors, grid=grid)
+    assert_allclose(limma_stats.fit_comparisons(shared, shared_factors, grid=grid).values, expected.values, rtol=1e-5)
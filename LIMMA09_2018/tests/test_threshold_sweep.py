@@ -0,0 +1,58 @@
+import numpy, pandas
+import pytest
+from numpy.testing import assert_array_equal
+import limma_stats, results_store, threshold_sweep
+
+"""
+The counts surface against thresholding and counting every grid point directly.
+"""
+
+FDRS = [1e-6, 1e-4, 1e-3, 0.01, 0.05]
+## the exact percentages of 1 and 2 of 3 comparisons and of 6 of 9, plus the usual grid
+CONSENSUS = numpy.concatenate([threshold_sweep.CONSENSUS, [100 / 3., 200 / 3., 600 / 9., 100]])
+
+
+@pytest.fixture(scope='module')
+def adj_pvals():
+    columns = limma_stats.comparison_columns()
+    genes = ['G{:03d}'.format(i) for i in range(60)]
+    random = numpy.random.RandomState(4)
+    ## p-values on the cut-offs themselves, and missing ones, included
+    values = random.choice(FDRS + [1e-7, 1e-5, 0.02, 0.5, numpy.nan], size=(len(genes), len(columns)))
+    values[:, :5] = 10 ** -random.uniform(0, 8, (len(genes), 5))
+    return pandas.DataFrame(values, index=pandas.Index(genes, name='gene'), columns=columns)
+
+
+def brute_force(adj_pvals, key, fdr, consensus):
+    group = adj_pvals.loc[:, adj_pvals.columns.droplevel('pair') == key]
+    with numpy.errstate(invalid='ignore'):
+        percentages = (group.values < fdr).sum(axis=1) / float(group.shape[1]) * 100
+    return int((percentages > consensus).sum())
+
+
+def test_surface_matches_brute_force(adj_pvals):
+    counts, keys = threshold_sweep.surface(adj_pvals, FDRS, CONSENSUS)
+    assert keys == list(dict.fromkeys(adj_pvals.columns.droplevel('pair')))
+    assert counts.shape == (len(keys), len(FDRS), len(CONSENSUS))
+    for k, key in enumerate(keys):
+        for f, fdr in enumerate(FDRS):
+            for c, consensus in enumerate(CONSENSUS):
+                assert counts[k, f, c] == brute_force(adj_pvals, key, fdr, consensus), (key, fdr, consensus)
+
+
+def test_surface_matches_the_store(adj_pvals, tmp_path):
+    store = results_store.ResultsStore(
+        results_store.build_store(adj_pvals, str(tmp_path / results_store.STORE_NAME), FDRS))
+    counts, keys = threshold_sweep.surface(adj_pvals, FDRS, CONSENSUS)
+    from_store, store_keys = threshold_sweep.surface_from_store(store, CONSENSUS)
+    assert store_keys == keys
+    assert_array_equal(from_store, counts)
+    assert_array_equal(counts[:, :, list(CONSENSUS).index(60)], store.counts(60).values.T)
+
+
+def test_surface_table(adj_pvals):
+    counts, keys = threshold_sweep.surface(adj_pvals, FDRS[:2], [0, 60])
+    table = threshold_sweep.surface_table(counts, keys, FDRS[:2], [0, 60])
+    assert len(table) == counts.size
+    row = table.query("group == 'between_senescent' and treatment == 'tgfb' and fdr == 1e-4 and consensus == 60")
+    assert row['count'].tolist() == [brute_force(adj_pvals, ('between', 'TGFb', 'sen'), 1e-4, 60)]
@@ -0,0 +1,190 @@
+import os
+import numpy, pandas
+import pval_thresholds, results_store
+from results_cube import KEY_GROUPS, KEY_TREATMENTS
+
+"""
+Gene counts over a whole grid of FDR cut-offs x consensus percentages.
+
+A gene's percentage in a group with n comparisons is above c at FDR t exactly when
+at least r of its adjusted p-values are below t, r being the fewest hits with
+r / n * 100 > c; that is, when its r'th smallest p-value is below t. So each gene's
+p-values are sorted once per group, giving order statistics q[gene, r]; for every r
+the column q[:, r] is sorted over genes once, and the count at any t is a
+searchsorted into it. The full surface costs two sorts plus a binary search per
+grid point instead of re-thresholding and re-counting the matrix at every (t, c).
+
+Counts use the same "> consensus" rule as the *_count_greater_than_60_percent tables.
+
+    python pipeline.py surface --input-dir DIR/SavedObjects [--fdr 1e-10 0.05] [--points 50]
+
+"""
+
+CONSENSUS = numpy.arange(0, 100, 5)
+
+
+def fdr_grid(low=1e-10, high=0.05, points=50):
+    return numpy.geomspace(low, high, points)
+
+
+def order_statistics(adj_pvals):
+    """
+    {(kind, treatment, group): genes x n array of each gene's sorted p-values},
+    NaN (never significant) sorting last as +inf
+    """
+    values = numpy.where(numpy.isnan(adj_pvals.values), numpy.inf, adj_pvals.values)
+    groups = adj_pvals.columns.droplevel('pair')
+    stats = {}
+    for key in dict.fromkeys(groups):
+        mask = numpy.asarray([g == key for g in groups])
+        stats[key] = numpy.sort(values[:, mask], axis=1)
+    return stats
+
+
+def surface(adj_pvals, fdrs, consensus=CONSENSUS):
+    """
+    Counts of genes with a consensus percentage above each consensus value at each
+    FDR cut-off. Returns an int array (group, fdr, consensus) and the
+    (kind, treatment, group) keys of the first axis.
+    """
+    fdrs = numpy.asarray(fdrs, dtype=float)
+    consensus = numpy.asarray(consensus, dtype=float)
+    stats = order_statistics(adj_pvals)
+    counts = numpy.zeros((len(stats), len(fdrs), len(consensus)), dtype=int)
+    for k, (key, q) in enumerate(stats.items()):
+        n = q.shape[1]
+        ## hits needed to be above each consensus value, using the same floating point
+        ## percentages as consensus_percentages. More than n is never reached.
+        needed = numpy.searchsorted(numpy.arange(n + 1) / float(n) * 100, consensus, side='right')
+        by_rank = numpy.sort(q, axis=0)
+        for r in numpy.unique(needed[needed <= n]):
+            ## genes whose r'th smallest p-value is below t
+            column = numpy.searchsorted(by_rank[:, r - 1], fdrs, side='left')
+            counts[k][:, needed == r] = column[:, None]
+    return counts, list(stats)
+
+
+def surface_from_store(store, consensus=CONSENSUS):
+    """
+    The same surface restricted to the stored thresholds, for stores imported from
+    CSV folders that have percentages but no adj.P.Val matrix
+    """
+    consensus = numpy.asarray(consensus, dtype=float)
+    percentages = numpy.asarray(store.array('percentages'))
+    ## (threshold, gene, group) -> (group, threshold, gene), sorted over genes
+    by_gene = numpy.sort(numpy.nan_to_num(percentages, nan=-1).transpose(2, 0, 1), axis=2)
+    n_genes = by_gene.shape[2]
+    counts = numpy.empty(by_gene.shape[:2] + (len(consensus),), dtype=int)
+    for k in range(by_gene.shape[0]):
+        for t in range(by_gene.shape[1]):
+            counts[k, t] = n_genes - numpy.searchsorted(by_gene[k, t], consensus, side='right')
+    return counts, [tuple(g) for g in store.groups]
+
+
+def load_surface(saved_objects_path, fdrs=None, consensus=CONSENSUS):
+    """
+    Surface for a SavedObjects directory: over `fdrs` from adj_pvals.npz when the
+    stats step has been run, otherwise over the thresholds in the results store.
+    Returns (counts, keys, fdrs).
+    """
+    fname = os.path.join(saved_objects_path, pval_thresholds.ADJ_PVALS_FNAME)
+    if os.path.isfile(fname):
+        fdrs = fdr_grid() if fdrs is None else numpy.asarray(fdrs, dtype=float)
+        counts, keys = surface(pval_thresholds.load_adj_pvals(fname), fdrs, consensus)
+        return counts, keys, fdrs
+    store = results_store.open_store(saved_objects_path)
+    counts, keys = surface_from_store(store, consensus)
+    return counts, keys, store.thresholds
+
+
+def surface_table(counts, keys, fdrs, consensus=CONSENSUS):
+    """
+    Long (group, treatment, fdr, consensus, count) frame, group/treatment named
+    as in results_cube (within_adult, tgfb, ...)
+    """
+    n_keys, n_fdrs, n_consensus = counts.shape
+    k, f, c = numpy.meshgrid(numpy.arange(n_keys), numpy.arange(n_fdrs), numpy.arange(n_consensus),
+                             indexing='ij')
+    groups = numpy.array([KEY_GROUPS[(kind, group)] for kind, treatment, group in keys])
+    treatments = numpy.array([KEY_TREATMENTS[treatment] for kind, treatment, group in keys])
+    return pandas.DataFrame({
+        'group': groups[k.ravel()],
+        'treatment': treatments[k.ravel()],
+        'fdr': numpy.asarray(fdrs, dtype=float)[f.ravel()],
+        'consensus': numpy.asarray(consensus, dtype=float)[c.ravel()],
+        'count': counts.ravel(),
+    })
+
+
+def plot_surface(counts, keys, fdrs, consensus=CONSENSUS, fname=None):
+    """
+    One panel per group (rows) and treatment (columns): counts as a heatmap over
+    log10 FDR x consensus with contour lines
+    """
+    import matplotlib.pyplot as plt
+    groups = list(dict.fromkeys(KEY_GROUPS[(kind, group)] for kind, treatment, group in keys))
+    treatments = list(dict.fromkeys(KEY_TREATMENTS[treatment] for kind, treatment, group in keys))
+    x = numpy.log10(numpy.asarray(fdrs, dtype=float))
+    order = numpy.argsort(x)
+    fig, axes = plt.subplots(len(groups), len(treatments), sharex=True, sharey=True, squeeze=False,
+                             figsize=(6 * len(treatments), 3.5 * len(groups)))
+    vmax = max(counts.max(), 1)
+    for k, (kind, treatment, group) in enumerate(keys):
+        ax = axes[groups.index(KEY_GROUPS[(kind, group)]), treatments.index(KEY_TREATMENTS[treatment])]
+        z = counts[k][order].T
+        mesh = ax.pcolormesh(x[order], consensus, z, shading='nearest', cmap='YlGnBu', vmin=0, vmax=vmax)
+        if len(x) > 1 and len(consensus) > 1 and z.max() > z.min():
+            lines = ax.contour(x[order], consensus, z, colors='black', linewidths=0.8)
+            ax.clabel(lines, fmt='%d', fontsize=8)
+        ax.set_title('{}, {}'.format(KEY_GROUPS[(kind, group)].replace('_', ' '), KEY_TREATMENTS[treatment]))
+    for ax in axes[-1]:
+        ax.set_xlabel('log10 FDR cut-off')
+    for ax in axes[:, 0]:
+        ax.set_ylabel('consensus %')
+    fig.colorbar(mesh, ax=axes, label='genes above consensus')
+    if fname is not None:
+        fig.savefig(fname, dpi=150, bbox_inches='tight')
+        plt.close(fig)
+    return fig
+
+
+def write_surface(saved_objects_path, output_path=None, fdrs=None, consensus=CONSENSUS):
+    """
+    Write threshold_surface.csv and threshold_surface.png. Returns the files written.
+    """
+    output_path = saved_objects_path if output_path is None else output_path
+    if not os.path.isdir(output_path):
+        os.makedirs(output_path)
+    counts, keys, fdrs = load_surface(saved_objects_path, fdrs, consensus)
+    csv_fname = os.path.join(output_path, 'threshold_surface.csv')
+    surface_table(counts, keys, fdrs, consensus).to_csv(csv_fname, index=False)
+    png_fname = os.path.join(output_path, 'threshold_surface.png')
+    plot_surface(counts, keys, fdrs, consensus, fname=png_fname)
+    return [csv_fname, png_fname]
+
+
+def figure_jobs(saved_objects_path, output_path=None, fdrs=None, consensus=CONSENSUS):
+    """
+    The surface table and figure as a single figure job (see render.py)
+    """
+    kwargs = dict(saved_objects_path=saved_objects_path, output_path=output_path,
+                  fdrs=None if fdrs is None else [float(f) for f in fdrs],
+                  consensus=[float(c) for c in consensus])
+    return [('threshold_sweep', 'write_surface', kwargs)]
+
+
+def job_files(function, kwargs):
+    """
+    (input files, output files) of a figure job, for incremental.py
+    """
+    saved_objects_path = kwargs['saved_objects_path']
+    output_path = kwargs.get('output_path') or saved_objects_path
+    fname = os.path.join(saved_objects_path, pval_thresholds.ADJ_PVALS_FNAME)
+    if os.path.isfile(fname):
+        inputs = [fname]
+    else:
+        path = os.path.join(saved_objects_path, results_store.STORE_NAME)
+        inputs = [os.path.join(path, f) for f in [results_store.MANIFEST, 'percentages.npy']]
+    outputs = [os.path.join(output_path, 'threshold_surface.csv'),
+               os.path.join(output_path, 'threshold_surface.png')]
+    return inputs, outputs